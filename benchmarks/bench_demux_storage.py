@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, getsize
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+import click
+from h5py import File
+# qiita-files is not a dependency of the plugin, it is installed with Qiita
+from qiita_files.demux import fetch
+
+from qp_target_gene.split_libraries.util import (
+    parse_fastq, write_demux, DEMUX_STORAGE_PROFILES)
+
+
+@click.command()
+@click.argument('fastq_fp', type=click.Path(exists=True, dir_okay=False))
+@click.option('--reads', default=100, show_default=True,
+              help='Number of random samples and sequences read')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed used to pick the random samples and sequences')
+def benchmark(fastq_fp, reads, seed):
+    """Benchmarks the demux storage profiles over a demultiplexed FASTQ
+
+    For each profile it reports the write throughput, the size of the demux
+    file and the mean latency of reading a random sample and a random sequence
+    """
+    out_dir = mkdtemp()
+    click.echo("profile\tseqs/s\tMB/s\tsize (MB)\tsample read (ms)\t"
+               "sequence read (ms)")
+    try:
+        for storage in sorted(DEMUX_STORAGE_PROFILES):
+            demux_fp = join(out_dir, '%s.demux' % storage)
+            start = time()
+            with open(fastq_fp, 'rb') as fh, File(demux_fp, 'w') as f:
+                n = write_demux(parse_fastq(fh), f, storage)
+            write_time = time() - start
+            size = getsize(demux_fp)
+
+            rnd = Random(seed)
+            sample_time = seq_time = 0
+            with File(demux_fp, 'r') as f:
+                samples = sorted(f)
+                for _ in range(reads):
+                    sample = rnd.choice(samples)
+                    start = time()
+                    for _ in fetch(f, samples=[sample]):
+                        pass
+                    sample_time += time() - start
+
+                    grp = f[sample]
+                    idx = rnd.randrange(grp['sequence'].shape[0])
+                    start = time()
+                    grp['sequence'][idx], grp['qual'][idx]
+                    seq_time += time() - start
+
+            click.echo("%s\t%.0f\t%.2f\t%.2f\t%.3f\t%.3f" % (
+                storage, n / write_time,
+                getsize(fastq_fp) / write_time / 2 ** 20, size / 2. ** 20,
+                sample_time / reads * 1000, seq_time / reads * 1000))
+    finally:
+        rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import remove
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from gzip import GzipFile
+from multiprocessing import Process, Queue
+from resource import getrusage, RUSAGE_SELF
+from time import time
+
+import click
+import numpy as np
+
+from qp_target_gene.split_libraries.util import (
+    _open_fastq, parse_fastq, read_fastq_batches)
+
+
+def line_iterator(fp):
+    """Counts the reads and bases of `fp` creating a string per line"""
+    reads = bases = 0
+    with _open_fastq(fp) as f:
+        for _, seq, _ in parse_fastq(f):
+            reads += 1
+            bases += len(seq)
+    return reads, bases
+
+
+def batch_reader(fp):
+    """Counts the reads and bases of `fp` reading it in batches"""
+    reads = bases = 0
+    for batch in read_fastq_batches(fp):
+        reads += len(batch)
+        bases += int(batch.lengths(1).sum())
+    return reads, bases
+
+
+READERS = {'lines': line_iterator, 'batches': batch_reader}
+
+
+def _run(reader, fp, queue):
+    start = time()
+    reads, bases = READERS[reader](fp)
+    elapsed = time() - start
+    # ru_maxrss is in KB on Linux
+    queue.put((reads, bases, elapsed, getrusage(RUSAGE_SELF).ru_maxrss))
+
+
+def write_fastq_file(fp, n_reads, read_length, seed):
+    """Writes `n_reads` random reads of `read_length` bases to `fp`"""
+    rng = np.random.RandomState(seed)
+    nts = np.frombuffer(b'ACGT', dtype=np.uint8)
+    qual = b'I' * read_length
+    opener = GzipFile if fp.endswith('.gz') else open
+    with opener(fp, 'wb') as f:
+        for start in range(0, n_reads, 10000):
+            seqs = nts[rng.randint(0, 4, (min(10000, n_reads - start),
+                                          read_length))]
+            f.write(b''.join(
+                b''.join([b'@M00176:18:000000000-A0DK4:1:1:',
+                          str(start + i).encode('ascii'), b' 1:N:0:0\n',
+                          seq.tobytes(), b'\n+\n', qual, b'\n'])
+                for i, seq in enumerate(seqs)))
+
+
+@click.command()
+@click.option('--reads', '-n', default=1000000, show_default=True,
+              help='Number of reads of the FASTQ files')
+@click.option('--read-length', default=150, show_default=True,
+              help='Length of the reads')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed used to generate the reads')
+def benchmark(reads, read_length, seed):
+    """Benchmarks the FASTQ reader used by the in-process demultiplexing
+
+    For an uncompressed and a gzipped FASTQ file it reports the throughput
+    and peak resident memory of reading the file with `read_fastq_batches`
+    and with a naive line iterator. Each reader runs in its own process so
+    the peak memory is not shared
+    """
+    tmp_dir = mkdtemp()
+    try:
+        click.echo("file\treader\treads/s\tpeak RSS (MB)")
+        for fname in ['reads.fastq', 'reads.fastq.gz']:
+            fp = join(tmp_dir, fname)
+            write_fastq_file(fp, reads, read_length, seed)
+            for reader in ['lines', 'batches']:
+                queue = Queue()
+                proc = Process(target=_run, args=(reader, fp, queue))
+                proc.start()
+                n, _, elapsed, rss = queue.get()
+                proc.join()
+                click.echo("%s\t%s\t%.0f\t%.1f"
+                           % (fname, reader, n / elapsed, rss / 1024.))
+            remove(fp)
+    finally:
+        rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    benchmark()
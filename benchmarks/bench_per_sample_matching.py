@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import close, remove
+from random import Random
+from tempfile import mkstemp
+from time import time
+
+import click
+
+from qp_target_gene.split_libraries.split_libraries_fastq import (
+    get_per_sample_fastq_samples)
+
+
+@click.command()
+@click.option('--samples', '-n', multiple=True, type=int,
+              default=[10000, 50000], show_default=True,
+              help='Number of samples (can be given multiple times)')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed used to shuffle the file names')
+def benchmark(samples, seed):
+    """Benchmarks matching the per-sample FASTQ files to their samples
+
+    For each number of samples it writes a mapping file with one run_prefix
+    per sample and reports the time needed to match the (shuffled) file
+    names, half of them prefixed by a study id, to their samples
+    """
+    click.echo("samples\tseconds\tfiles/s")
+    for n in samples:
+        fd, mapping_fp = mkstemp()
+        close(fd)
+        try:
+            with open(mapping_fp, 'w') as f:
+                f.write("#SampleID\tBarcodeSequence\tLinkerPrimerSequence\t"
+                        "run_prefix\tDescription\n")
+                for i in range(n):
+                    f.write("1.sample.%d\t\t\tsample_%d_S%d_L001\tdesc\n"
+                            % (i, i, i))
+            forward_seqs = [
+                "%ssample_%d_S%d_L001_R1_001.fastq.gz"
+                % ('1_' if i % 2 else '', i, i) for i in range(n)]
+            Random(seed).shuffle(forward_seqs)
+
+            start = time()
+            get_per_sample_fastq_samples(forward_seqs, [], mapping_fp)
+            elapsed = time() - start
+            click.echo("%d\t%.3f\t%.0f" % (n, elapsed, n / elapsed))
+        finally:
+            remove(mapping_fp)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import mkdir
+from os.path import join, basename
+from shutil import rmtree
+from tarfile import open as taropen
+from tempfile import mkdtemp
+from time import time
+
+import click
+import numpy as np
+
+from qp_target_gene.pick_otus import generate_sortmerna_tgz, _dir_size
+
+
+def tarfile_tgz(out_dir):
+    """Archives sortmerna_picked_otus with the single threaded tarfile gzip"""
+    to_tgz = join(out_dir, 'sortmerna_picked_otus')
+    with taropen(to_tgz + '.tgz', "w:gz") as tar:
+        tar.add(to_tgz, arcname=basename(to_tgz))
+
+
+def write_otu_map(fp, n_reads, n_otus, seed):
+    """Writes an OTU map of `n_reads` reads assigned to `n_otus` OTUs"""
+    rng = np.random.RandomState(seed)
+    otus = rng.randint(0, n_otus, n_reads)
+    with open(fp, 'w') as f:
+        for otu in range(n_otus):
+            reads = np.flatnonzero(otus == otu)
+            if len(reads):
+                f.write("%d\t%s\n" % (otu, '\t'.join(
+                    'sample%d_%d' % (read % 96, read) for read in reads)))
+
+
+@click.command()
+@click.option('--reads', '-n', default=10000000, show_default=True,
+              help='Number of reads of the OTU map')
+@click.option('--otus', default=20000, show_default=True,
+              help='Number of OTUs of the OTU map')
+@click.option('--jobs', default=4, show_default=True,
+              help='Number of threads compressing the archive')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed used to generate the OTU map')
+def benchmark(reads, otus, jobs, seed):
+    """Benchmarks archiving the sortmerna_picked_otus directory
+
+    It reports the throughput of the single threaded tarfile gzip archive and
+    of the BGZF archive compressed in parallel
+    """
+    tmp_dir = mkdtemp()
+    try:
+        otus_dir = join(tmp_dir, 'sortmerna_picked_otus')
+        mkdir(otus_dir)
+        write_otu_map(join(otus_dir, 'seqs_otus.txt'), reads, otus, seed)
+        implementations = [
+            ('tarfile gzip', tarfile_tgz),
+            ('%d threads gzip' % jobs,
+             lambda d: generate_sortmerna_tgz(d, num_jobs=jobs))]
+        click.echo("implementation\tMB/s\tseconds")
+        size = _dir_size(otus_dir) / 1048576.
+        for name, func in implementations:
+            start = time()
+            func(tmp_dir)
+            elapsed = time() - start
+            click.echo("%s\t%.1f\t%.1f" % (name, size / elapsed, elapsed))
+    finally:
+        rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    benchmark()
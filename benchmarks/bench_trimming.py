@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from functools import partial
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+import click
+import numpy as np
+from h5py import File
+# qiita-files is not a dependency of the plugin, it is installed with Qiita
+from qiita_files.demux import fetch
+from qiita_files.format.fasta import format_fasta_record
+from qiita_files.format.fastq import format_fastq_record
+
+from qp_target_gene.split_libraries.util import (DemuxWriter,
+                                                 generate_demux_file)
+from qp_target_gene.trimming import (generate_trimming,
+                                     generate_multiple_trimming)
+
+
+def per_record_trimming(filepaths, out_dir, parameters):
+    """Trims formatting each record with the qiita_files formatters
+
+    The demux file is created afterwards, parsing seqs.fastq
+    """
+    length = int(parameters['length'])
+    id_fmt = (b"%(sample)s_%(idx)d orig_bc=%(bc_ori)s new_bc=%(bc_cor)s "
+              b"bc_diffs=%(bc_diff)d")
+    with open(join(out_dir, 'seqs.fna'), 'wb') as ffh, \
+            open(join(out_dir, 'seqs.fastq'), 'wb') as qfh:
+        for fp in filepaths:
+            with File(fp, 'r') as fh:
+                for samp, idx, seq, qual, bc_ori, bc_cor, bc_err in fetch(fh):
+                    if len(seq) < length or len(qual) < length:
+                        continue
+                    seq_id = id_fmt % {b'sample': samp, b'idx': idx,
+                                       b'bc_ori': bc_ori, b'bc_cor': bc_cor,
+                                       b'bc_diff': bc_err}
+                    ffh.write(format_fasta_record(seq_id, seq[:length],
+                                                  qual[:length]))
+                    qfh.write(format_fastq_record(seq_id, seq[:length],
+                                                  qual[:length]))
+    generate_demux_file(out_dir)
+
+
+IMPLEMENTATIONS = {'per-record': per_record_trimming,
+                   'chunked': partial(generate_trimming, num_jobs=1)}
+
+
+def write_demux_file(fp, n_reads, n_samples, seed):
+    """Writes a demux file of `n_reads` random reads of 100 to 150 bases"""
+    rng = np.random.RandomState(seed)
+    nts = np.frombuffer(b'ACGT', dtype=np.uint8)
+    with File(fp, 'w') as f:
+        writer = DemuxWriter(f)
+        for start in range(0, n_reads, 10000):
+            n = min(10000, n_reads - start)
+            seqs = nts[rng.randint(0, 4, (n, 150))]
+            quals = rng.randint(35, 74, (n, 150)).astype(np.uint8)
+            lengths = rng.randint(100, 151, n)
+            samples = rng.randint(0, n_samples, n)
+            for i in range(n):
+                header = (b'1.sample%d_%d orig_bc=AAAAAAAAAAAA '
+                          b'new_bc=AAAAAAAAAAAA bc_diffs=0'
+                          % (samples[i], start + i))
+                writer.write(header, seqs[i, :lengths[i]].tobytes(),
+                             quals[i, :lengths[i]].tobytes())
+        writer.close()
+
+
+@click.command()
+@click.option('--reads', '-n', default=10000000, show_default=True,
+              help='Number of reads of the demux file')
+@click.option('--samples', default=96, show_default=True,
+              help='Number of samples of the demux file')
+@click.option('--length', default=120, show_default=True,
+              help='Trimming length')
+@click.option('--lengths', default='90,100,150', show_default=True,
+              help='Comma separated lengths of the multiple lengths trimming')
+@click.option('--jobs', default=4, show_default=True,
+              help='Number of processes of the parallel trimming')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed used to generate the reads')
+def benchmark(reads, samples, length, lengths, jobs, seed):
+    """Benchmarks the Trimming over a random demux file
+
+    For each implementation it reports the throughput of trimming the demux
+    file to the seqs.fna, seqs.fastq and seqs.demux files. It also compares
+    trimming to several lengths one at a time and in a single pass, and
+    trimming the samples in a pool of processes
+    """
+    tmp_dir = mkdtemp()
+    try:
+        demux_fp = join(tmp_dir, 'seqs.demux')
+        write_demux_file(demux_fp, reads, samples, seed)
+        click.echo("implementation\treads/s\tseconds")
+        for name in sorted(IMPLEMENTATIONS):
+            out_dir = mkdtemp(dir=tmp_dir)
+            start = time()
+            IMPLEMENTATIONS[name]([demux_fp], out_dir, {'length': length})
+            elapsed = time() - start
+            click.echo("%s\t%.0f\t%.1f" % (name, reads / elapsed, elapsed))
+        start = time()
+        generate_trimming([demux_fp], mkdtemp(dir=tmp_dir), {'length': length},
+                          num_jobs=jobs)
+        elapsed = time() - start
+        click.echo("%d processes\t%.0f\t%.1f"
+                   % (jobs, reads / elapsed, elapsed))
+
+        lengths = [int(length) for length in lengths.split(',')]
+        click.echo("\n%s lengths\tseconds" % len(lengths))
+        start = time()
+        for length in lengths:
+            generate_trimming([demux_fp], mkdtemp(dir=tmp_dir),
+                              {'length': length}, num_jobs=1)
+        click.echo("one at a time\t%.1f" % (time() - start))
+        start = time()
+        generate_multiple_trimming([demux_fp], mkdtemp(dir=tmp_dir), lengths,
+                                   num_jobs=1)
+        click.echo("single pass\t%.1f" % (time() - start))
+    finally:
+        rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -10,7 +10,7 @@ from qiita_client import QiitaPlugin, QiitaCommand
 
 from .split_libraries import split_libraries, split_libraries_fastq
 from .pick_otus import pick_closed_reference_otus
-from .trimming import trimming
+from .trimming import trimming, MULTIPLE_TRIMMING_LENGTHS
 
 # Initialize the plugin
 plugin = QiitaPlugin(
@@ -20,6 +20,8 @@ plugin = QiitaPlugin(
 req_params = {'input_data': ('artifact', ['FASTA', 'FASTA_Sanger', 'SFF'])}
 opt_params = {
     'barcode_type': ['string', 'golay_12'],
+    'demux_storage': [
+        'choice:["gzip", "gzip_shuffle", "lzf", "none"]', 'gzip'],
     'disable_bc_correction': ['boolean', 'False'],
     'disable_primers': ['boolean', 'False'],
     'max_ambig': ['integer', '6'],
@@ -44,7 +46,7 @@ dflt_param_set = {
         'min_seq_len': 200, 'truncate_ambi_bases': False, 'max_ambig': 6,
         'min_qual_score': 25, 'trim_seq_length': False, 'max_seq_len': 1000,
         'max_primer_mismatch': 0, 'max_homopolymer': 6, 'qual_score_window': 0,
-        'barcode_type': 'golay_12'},
+        'barcode_type': 'golay_12', 'demux_storage': 'gzip'},
     'Defaults with Hamming 8 barcodes': {
         'reverse_primers': 'disable', 'reverse_primer_mismatches': 0,
         'disable_bc_correction': False, 'max_barcode_errors': 1.5,
@@ -52,7 +54,7 @@ dflt_param_set = {
         'truncate_ambi_bases': False, 'max_ambig': 6, 'min_qual_score': 25,
         'trim_seq_length': False, 'max_seq_len': 1000,
         'max_primer_mismatch': 0, 'max_homopolymer': 6, 'qual_score_window': 0,
-        'barcode_type': 'hamming_8'}}
+        'barcode_type': 'hamming_8', 'demux_storage': 'gzip'}}
 sl_cmd = QiitaCommand(
     "Split libraries",
     "Demultiplexes and applies quality control to FASTA data",
@@ -63,6 +65,10 @@ plugin.register_command(sl_cmd)
 req_params = {'input_data': ('artifact', ['FASTQ', 'per_sample_FASTQ'])}
 opt_params = {
     'barcode_type': ['string', 'golay_12'],
+    'compress_outputs': ['boolean', 'False'],
+    'demux_engine': ['choice:["qiime", "native"]', 'qiime'],
+    'demux_storage': [
+        'choice:["gzip", "gzip_shuffle", "lzf", "none"]', 'gzip'],
     'max_bad_run_length': ['integer', '3'],
     'max_barcode_errors': ['float', '1.5'],
     'min_per_read_length_fraction': ['float', '0.75'],
@@ -78,62 +84,83 @@ dflt_param_set = {
         'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': False,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'Defaults with reverse complement mapping file barcodes': {
         'max_barcode_errors': 1.5, 'barcode_type': 'golay_12',
         'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': True,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'barcode_type 8, defaults': {
         'max_barcode_errors': 1.5, 'barcode_type': '8',
         'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': False,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'barcode_type 8, reverse complement mapping file barcodes': {
         'max_barcode_errors': 1.5, 'barcode_type': '8',
         'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': True,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'barcode_type 6, defaults': {
         'max_barcode_errors': 1.5, 'barcode_type': '6',
         'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': False,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'barcode_type 6, reverse complement mapping file barcodes': {
         'max_barcode_errors': 1.5, 'barcode_type': '6',
         'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': True,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'per sample FASTQ defaults': {
         'max_barcode_errors': 1.5, 'barcode_type': 'not-barcoded',
         'max_bad_run_length': 3, 'phred_offset': 'auto', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': False,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'per sample FASTQ defaults, phred_offset 33': {
         'max_barcode_errors': 1.5, 'barcode_type': 'not-barcoded',
         'max_bad_run_length': 3, 'phred_offset': '33', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': False,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0},
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False},
     'per sample FASTQ defaults, phred_offset 64': {
         'max_barcode_errors': 1.5, 'barcode_type': 'not-barcoded',
         'max_bad_run_length': 3, 'phred_offset': '64', 'rev_comp': False,
         'phred_quality_threshold': 3, 'rev_comp_barcode': False,
         'rev_comp_mapping_barcodes': False,
-        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0}}
+        'min_per_read_length_fraction': 0.75, 'sequence_max_n': 0,
+        'demux_storage': 'gzip', 'demux_engine': 'qiime',
+        'compress_outputs': False}}
 sl_fastq_cmd = QiitaCommand(
     "Split libraries FASTQ",
     "Demultiplexes and applies quality control to FASTQ data",
     split_libraries_fastq, req_params, opt_params, outputs, dflt_param_set)
 plugin.register_command(sl_fastq_cmd)
 
-# Define the pick OTUs command
+# Define the pick OTUs command. If dereplicate is set, only the OTUs of the
+# unique sequences are picked, and the ones of the sequences already picked by
+# other jobs are taken from the cache (see QP_TARGET_GENE_CACHE_DIR). Otherwise
+# all the sequences are picked and the cache is not used
 req_params = {'input_data': ('artifact', ['Demultiplexed'])}
 opt_params = {
     'reference-seq': ['string', '/databases/gg/13_8/rep_set/97_otus.fasta'],
@@ -141,14 +168,17 @@ opt_params = {
         'string', '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt'],
     'similarity': ['float', '0.97'], 'sortmerna_coverage': ['float', '0.97'],
     'sortmerna_e_value': ['float', '1'],
-    'sortmerna_max_pos': ['integer', '10000'], 'threads': ['integer', '1']}
+    'sortmerna_max_pos': ['integer', '10000'], 'threads': ['integer', '1'],
+    'shards': ['integer', '1'], 'shard_by_sample': ['boolean', 'False'],
+    'dereplicate': ['boolean', 'False']}
 outputs = {'OTU table': 'BIOM'}
 dflt_param_set = {
     'Defaults': {
         'reference-seq': '/databases/gg/13_8/rep_set/97_otus.fasta',
         'reference-tax': '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt',
         'similarity': 0.97, 'sortmerna_e_value': 1, 'sortmerna_max_pos': 10000,
-        'threads': 1, 'sortmerna_coverage': 0.97}}
+        'threads': 1, 'sortmerna_coverage': 0.97, 'shards': 1,
+        'shard_by_sample': False, 'dereplicate': False}}
 po_cmd = QiitaCommand(
     "Pick closed-reference OTUs",
     "OTU picking using a closed reference approach",
@@ -158,14 +188,35 @@ plugin.register_command(po_cmd)
 
 # Define the trimming command
 req_params = {'input_data': ('artifact', ['Demultiplexed'])}
-opt_params = {'length': ['integer', '100']}
+opt_params = {
+    'demux_storage': [
+        'choice:["gzip", "gzip_shuffle", "lzf", "none"]', 'gzip'],
+    'length': ['integer', '100']}
 outputs = {'Trimmed Demultiplexed': 'Demultiplexed'}
 dflt_param_set = {
-    'Trimming 90': {'length': 90},
-    'Trimming 100': {'length': 100},
-    'Trimming 150': {'length': 150}
+    'Trimming 90': {'length': 90, 'demux_storage': 'gzip'},
+    'Trimming 100': {'length': 100, 'demux_storage': 'gzip'},
+    'Trimming 150': {'length': 150, 'demux_storage': 'gzip'}
 }
 trim_cmd = QiitaCommand(
     "Trimming", "Trimming sequences to the same length",
     trimming, req_params, opt_params, outputs, dflt_param_set)
 plugin.register_command(trim_cmd)
+
+# Define the trimming multiple lengths command
+req_params = {'input_data': ('artifact', ['Demultiplexed'])}
+opt_params = {
+    'demux_storage': [
+        'choice:["gzip", "gzip_shuffle", "lzf", "none"]', 'gzip'],
+    'lengths': ['mchoice:[90, 100, 150]', '[90, 100, 150]']}
+outputs = {'Trimmed Demultiplexed %d' % length: 'Demultiplexed'
+           for length in MULTIPLE_TRIMMING_LENGTHS}
+dflt_param_set = {
+    'Trimming 90, 100 and 150': {'lengths': [90, 100, 150],
+                                 'demux_storage': 'gzip'}
+}
+trim_multiple_cmd = QiitaCommand(
+    "Trimming multiple lengths",
+    "Trimming sequences to several lengths in a single pass",
+    trimming, req_params, opt_params, outputs, dflt_param_set)
+plugin.register_command(trim_multiple_cmd)
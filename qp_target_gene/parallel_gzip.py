@@ -0,0 +1,434 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from io import RawIOBase, BufferedReader
+from collections import deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from struct import pack, unpack
+import zlib
+
+from qp_target_gene.util import get_num_jobs
+
+# Maximum number of uncompressed bytes of a BGZF block, so the compressed
+# block never exceeds the 64KB limit of the format
+BGZF_BLOCK_SIZE = 0xff00
+
+# The empty block that marks the end of a BGZF file
+BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+# Number of uncompressed bytes compressed or decompressed by each task
+GZIP_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The fixed part of the header of a gzip member
+_GZIP_HEADER_SIZE = 12
+_FEXTRA = 4
+
+
+def compress_bgzf(data, compresslevel=6):
+    """Compresses `data` into BGZF blocks
+
+    Parameters
+    ----------
+    data : bytes
+        The data to compress
+    compresslevel : int, optional
+        The zlib compression level
+
+    Returns
+    -------
+    bytes
+        The BGZF blocks. Each block is a complete gzip member, so they can be
+        concatenated to any gzip file
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        chunk = data[start:start + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        cdata = compressor.compress(chunk) + compressor.flush()
+        blocks.append(b''.join([
+            # ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN, SI1, SI2, SLEN, BSIZE
+            pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, _FEXTRA, 0, 0, 0xff, 6,
+                 ord('B'), ord('C'), 2, len(cdata) + 25),
+            cdata,
+            pack('<2I', zlib.crc32(chunk) & 0xffffffff,
+                 len(chunk) & 0xffffffff)]))
+    return b''.join(blocks)
+
+
+def _bgzf_block_size(header):
+    """Returns the size of a BGZF block from its header
+
+    Parameters
+    ----------
+    header : bytes
+        The first bytes of the block, including the extra field
+
+    Returns
+    -------
+    int or None
+        The total size of the block, None if it is not a BGZF block
+    """
+    if (len(header) < _GZIP_HEADER_SIZE or header[:3] != b'\x1f\x8b\x08' or
+            not bytearray(header[3:4])[0] & _FEXTRA):
+        return None
+    xlen = unpack('<H', header[10:12])[0]
+    extra = header[_GZIP_HEADER_SIZE:_GZIP_HEADER_SIZE + xlen]
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen = unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b'BC' and slen == 2:
+            return unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + slen
+    return None
+
+
+def is_bgzf(fp):
+    """Checks if a gzip file is BGZF compressed
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+
+    Returns
+    -------
+    bool
+        Whether the first block of the file is a BGZF block
+    """
+    with open(fp, 'rb') as f:
+        return _bgzf_block_size(f.read(18)) is not None
+
+
+def _bgzf_chunks(f):
+    """Yields the BGZF blocks of a file, in groups of ~`GZIP_CHUNK_SIZE`
+
+    Parameters
+    ----------
+    f : file
+        The BGZF file, opened in binary mode
+
+    Yields
+    ------
+    list of bytes
+        The blocks
+
+    Raises
+    ------
+    IOError
+        If a block is not a BGZF block
+    """
+    blocks = []
+    size = 0
+    while True:
+        header = f.read(18)
+        if not header:
+            break
+        block_size = _bgzf_block_size(header)
+        if block_size is None:
+            raise IOError("Not a BGZF block at position %d"
+                          % (f.tell() - len(header)))
+        blocks.append(header + f.read(block_size - len(header)))
+        # Blocks usually compress ~4x
+        size += 4 * block_size
+        if size >= GZIP_CHUNK_SIZE:
+            yield blocks
+            blocks = []
+            size = 0
+    if blocks:
+        yield blocks
+
+
+def _decompress_blocks(blocks):
+    """Decompresses a list of gzip members
+
+    Parameters
+    ----------
+    blocks : list of bytes
+        The gzip members
+
+    Returns
+    -------
+    bytes
+        The decompressed data
+    """
+    return b''.join(zlib.decompress(block, 31) for block in blocks)
+
+
+class _Inflater(object):
+    """Decompresses a (multi-member) gzip stream fed in chunks"""
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(31)
+
+    def decompress(self, data):
+        """Decompresses the next chunk of the stream
+
+        Parameters
+        ----------
+        data : bytes or None
+            The compressed chunk. None marks the end of the stream
+
+        Returns
+        -------
+        bytes
+            The decompressed data
+
+        Raises
+        ------
+        EOFError
+            If the stream ends in the middle of a gzip member
+        """
+        if data is None:
+            if not getattr(self._decompressor, 'eof', True):
+                raise EOFError("Compressed file ended before the "
+                               "end-of-stream marker was reached")
+            return b''
+        out = [self._decompressor.decompress(data)]
+        while self._decompressor.unused_data:
+            data = self._decompressor.unused_data
+            if not data.strip(b'\x00'):
+                # Some tools pad the files with zeros, as GzipFile we
+                # ignore them
+                break
+            self._decompressor = zlib.decompressobj(31)
+            out.append(self._decompressor.decompress(data))
+        return b''.join(out)
+
+
+def _ordered_imap(pool, func, items, max_pending):
+    """Applies `func` to `items` in `pool`, yielding the results in order
+
+    Parameters
+    ----------
+    pool : multiprocessing.pool.ThreadPool
+        The pool
+    func : callable
+        The function to apply
+    items : iterable
+        The arguments of each call
+    max_pending : int
+        The maximum number of calls submitted and not yet yielded, so `items`
+        is not consumed faster than the results
+
+    Yields
+    ------
+    object
+        The results of the calls
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class _GzipReader(RawIOBase):
+    """Raw stream of the decompressed data of a gzip file
+
+    Parameters
+    ----------
+    fp : str
+        The gzip filepath
+    num_jobs : int
+        The number of threads decompressing the file
+
+    Notes
+    -----
+    The blocks of BGZF files are decompressed in parallel by `num_jobs`
+    threads. Other gzip files are decompressed by a single thread, ahead of
+    the reader
+    """
+    def __init__(self, fp, num_jobs):
+        self.name = fp
+        self._f = open(fp, 'rb')
+        if is_bgzf(fp):
+            self._pool = ThreadPool(num_jobs)
+            results = _ordered_imap(self._pool, _decompress_blocks,
+                                    _bgzf_chunks(self._f), 2 * num_jobs)
+        else:
+            # The members can't be located without decompressing them
+            self._pool = ThreadPool(1)
+            chunks = iter(partial(self._f.read, GZIP_CHUNK_SIZE), b'')
+            results = _ordered_imap(
+                self._pool, _Inflater().decompress,
+                (chunk for chunks in [chunks, [None]] for chunk in chunks), 2)
+        self._results = results
+        self._buffer = b''
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._buffer):
+            try:
+                self._buffer = next(self._results)
+            except StopIteration:
+                return 0
+            self._pos = 0
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._results.close()
+            self._pool.terminate()
+            self._pool.join()
+            self._f.close()
+        super(_GzipReader, self).close()
+
+
+class GzipWriter(object):
+    """Writes a BGZF compressed file, compressing it in parallel
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath
+    num_jobs : int, optional
+        The number of threads compressing the data. Defaults to the value
+        returned by `get_num_jobs`
+    compresslevel : int, optional
+        The zlib compression level
+
+    Notes
+    -----
+    The output is a valid (multi-member) gzip file, so it can be read by any
+    gzip reader, and `open_gzip` decompresses it in parallel
+    """
+    def __init__(self, fp, num_jobs=None, compresslevel=6):
+        self._num_jobs = get_num_jobs(num_jobs)
+        self._f = open(fp, 'wb')
+        self._pool = ThreadPool(self._num_jobs)
+        self._compress = partial(compress_bgzf, compresslevel=compresslevel)
+        self._pending = deque()
+        self._buffer = []
+        self._size = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        """Writes `data` to the file
+
+        Parameters
+        ----------
+        data : bytes
+            The data to write
+        """
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= GZIP_CHUNK_SIZE:
+            self._submit()
+
+    def _submit(self):
+        """Compresses the buffered data, writing the compressed chunks"""
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self._pending.append(self._pool.apply_async(self._compress, (data,)))
+        while len(self._pending) > 2 * self._num_jobs:
+            self._f.write(self._pending.popleft().get())
+
+    def close(self):
+        """Writes the pending data and closes the file"""
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit()
+            while self._pending:
+                self._f.write(self._pending.popleft().get())
+            self._f.write(BGZF_EOF)
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+            self._f.close()
+            self.closed = True
+
+
+def open_gzip(fp, mode='rb', num_jobs=None, compresslevel=6):
+    """Opens a gzip file, compressing or decompressing it in parallel
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    mode : {'rb', 'wb'}, optional
+        Whether the file is opened for reading or writing
+    num_jobs : int, optional
+        The number of threads used. Defaults to the value returned by
+        `get_num_jobs`
+    compresslevel : int, optional
+        The zlib compression level, used when writing
+
+    Returns
+    -------
+    file
+        The open file
+
+    Raises
+    ------
+    ValueError
+        If the mode is not supported
+    """
+    if mode == 'rb':
+        return BufferedReader(_GzipReader(fp, get_num_jobs(num_jobs)),
+                              GZIP_CHUNK_SIZE)
+    if mode == 'wb':
+        return GzipWriter(fp, num_jobs, compresslevel)
+    raise ValueError("Mode not supported: %s" % mode)
+
+
+def compress_file(in_fp, out_fp, num_jobs=None, compresslevel=6):
+    """Compresses a file in parallel
+
+    Parameters
+    ----------
+    in_fp : str
+        The input filepath
+    out_fp : str
+        The output (BGZF compressed) filepath
+    num_jobs : int, optional
+        The number of threads used. Defaults to the value returned by
+        `get_num_jobs`
+    compresslevel : int, optional
+        The zlib compression level
+    """
+    with open(in_fp, 'rb') as in_f, \
+            GzipWriter(out_fp, num_jobs, compresslevel) as out_f:
+        for chunk in iter(partial(in_f.read, GZIP_CHUNK_SIZE), b''):
+            out_f.write(chunk)
+
+
+def decompress_file(in_fp, out_fp, num_jobs=None):
+    """Decompresses a gzip file, in parallel if it is BGZF compressed
+
+    Parameters
+    ----------
+    in_fp : str
+        The gzip filepath
+    out_fp : str
+        The output filepath
+    num_jobs : int, optional
+        The number of threads used. Defaults to the value returned by
+        `get_num_jobs`
+    """
+    with open_gzip(in_fp, num_jobs=num_jobs) as in_f, \
+            open(out_fp, 'wb') as out_f:
+        for chunk in iter(partial(in_f.read, GZIP_CHUNK_SIZE), b''):
+            out_f.write(chunk)
@@ -6,14 +6,56 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os.path import join, basename
+from os import makedirs, listdir, rename, utime, walk
+from os.path import (join, basename, dirname, exists, getmtime, getsize,
+                     splitext)
+from shutil import rmtree
+from tempfile import mkdtemp
 from functools import partial
 from glob import glob
+from heapq import heapify, heappush, heappop
+from collections import OrderedDict
+from hashlib import md5
+from contextlib import contextmanager
 from tarfile import open as taropen
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_NB, LOCK_UN
+from time import strftime, time
+from multiprocessing.pool import ThreadPool
+import sqlite3
 
 from qiita_client import ArtifactInfo
 
-from qp_target_gene.util import system_call
+from qp_target_gene.util import (streaming_system_call, parallel_system_call,
+                                 system_call, get_cache_dir, get_cache_size)
+from qp_target_gene.parallel_gzip import (decompress_file, open_gzip,
+                                          GzipWriter)
+from qp_target_gene.split_libraries.util import concatenate_files
+from qp_target_gene.split_libraries.demultiplexing import _file_md5
+
+# Size of the chunks read when counting the records of a FASTA file
+FASTA_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Directory of the cache directory where the SortMeRNA indexes are stored
+SORTMERNA_INDEX_DIR = 'sortmerna_indexes'
+
+# File written in the directory of an index once it is complete. Its
+# modification time is the last time the index was used
+SORTMERNA_INDEX_MARKER = 'complete'
+
+# Prefix of the files of the cached indexes, as the same index is used for
+# references with the same contents and different names
+SORTMERNA_INDEX_PREFIX = 'reference'
+
+# Name of the SQLite database of the cache directory that stores the OTU of
+# the sequences already picked
+OTU_CACHE_DB = 'otu_assignments.sqlite'
+
+# Number of sequences looked up in the OTU cache at once, below the limit of
+# variables of a SQLite statement
+OTU_CACHE_BATCH_SIZE = 500
+
+# Number of seconds a job waits for another job writing to the OTU cache
+OTU_CACHE_TIMEOUT = 600
 
 
 def write_parameters_file(fp, parameters):
@@ -32,6 +74,175 @@ def write_parameters_file(fp, parameters):
         f.write("pick_otus:otu_picking_method\tsortmerna\n")
         for p in params:
             f.write("pick_otus:%s\t%s\n" % (p, parameters[p]))
+        if parameters.get('sortmerna_db'):
+            f.write("pick_otus:sortmerna_db\t%s\n"
+                    % parameters['sortmerna_db'])
+
+
+def _dir_size(path):
+    """Returns the size in bytes of the files in `path`"""
+    return sum(getsize(join(root, fname))
+               for root, _, fnames in walk(path) for fname in fnames)
+
+
+def build_sortmerna_index(reference_fp, max_pos, db_prefix):
+    """Builds the SortMeRNA index of a reference as QIIME does
+
+    Parameters
+    ----------
+    reference_fp : str
+        The reference sequences filepath
+    max_pos : int
+        The maximum number of positions stored per seed
+    db_prefix : str
+        The prefix of the index files, to be used as sortmerna_db
+
+    Raises
+    ------
+    RuntimeError
+        If indexdb_rna fails
+    """
+    std_out, std_err, return_value = system_call(
+        "indexdb_rna --ref %s,%s --max_pos %d --tmpdir %s"
+        % (reference_fp, db_prefix, int(max_pos), dirname(db_prefix)))
+    if return_value != 0:
+        raise RuntimeError("Error building the SortMeRNA index:\nStd out: "
+                           "%s\nStd err: %s" % (std_out, std_err))
+
+
+def evict_sortmerna_indexes(index_root, max_size, keep=None):
+    """Removes the least recently used indexes until they fit in `max_size`
+
+    Parameters
+    ----------
+    index_root : str
+        The directory of the cached indexes
+    max_size : int
+        The maximum size in bytes of the indexes
+    keep : str, optional
+        The name of an index that is never removed, e.g. the one in use by the
+        caller
+
+    Notes
+    -----
+    The indexes used by other jobs are locked, so they are never removed.
+    """
+    entries = []
+    for name in listdir(index_root):
+        marker = join(index_root, name, SORTMERNA_INDEX_MARKER)
+        if exists(marker):
+            entries.append((getmtime(marker), name))
+    sizes = {name: _dir_size(join(index_root, name)) for _, name in entries}
+    total = sum(sizes.values())
+    for _, name in sorted(entries):
+        if total <= max_size:
+            break
+        if name == keep:
+            continue
+        with open(join(index_root, '%s.lock' % name), 'a') as lock:
+            try:
+                flock(lock, LOCK_EX | LOCK_NB)
+            except IOError:
+                # In use
+                continue
+            if exists(join(index_root, name)):
+                rmtree(join(index_root, name))
+                total -= sizes[name]
+
+
+def _build_cached_index(reference_fp, max_pos, index_root, index_dir):
+    """Builds the index of a reference in `index_dir`
+
+    The index is built in a temporary directory that is renamed once
+    complete, so a failed build never leaves an index in the cache
+    """
+    tmp_dir = mkdtemp(dir=index_root, suffix='.tmp')
+    try:
+        build_sortmerna_index(reference_fp, max_pos,
+                              join(tmp_dir, SORTMERNA_INDEX_PREFIX))
+        open(join(tmp_dir, SORTMERNA_INDEX_MARKER), 'w').close()
+        if exists(index_dir):
+            rmtree(index_dir)
+        rename(tmp_dir, index_dir)
+    finally:
+        rmtree(tmp_dir, ignore_errors=True)
+
+
+@contextmanager
+def cached_sortmerna_index(reference_fp, max_pos, cache_dir=None,
+                           max_size=None):
+    """Returns the prefix of the SortMeRNA index of a reference in the cache
+
+    Parameters
+    ----------
+    reference_fp : str
+        The reference sequences filepath
+    max_pos : int
+        The maximum number of positions stored per seed
+    cache_dir : str, optional
+        The directory where the indexes are stored. Defaults to the value
+        returned by `get_cache_dir`
+    max_size : int, optional
+        The maximum size in bytes of the cached indexes. Defaults to the value
+        returned by `get_cache_size`
+
+    Yields
+    ------
+    str or None
+        The index prefix, to be used as sortmerna_db. None if there is no
+        cache directory, in which case QIIME builds the index of each job
+
+    Raises
+    ------
+    RuntimeError
+        If the index can't be built
+
+    Notes
+    -----
+    The indexes are keyed by the md5 of the reference and by `max_pos`. The
+    first job using a reference builds the index while holding an exclusive
+    lock, so jobs running at the same time wait for it instead of building it
+    again. The index is locked (shared) until the context exits, so it is not
+    evicted while in use by this or other jobs. Then the least recently used
+    indexes are evicted if the cache is larger than `max_size`.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if cache_dir is None:
+        yield None
+        return
+    if max_size is None:
+        max_size = get_cache_size()
+
+    index_root = join(cache_dir, SORTMERNA_INDEX_DIR)
+    if not exists(index_root):
+        try:
+            makedirs(index_root)
+        except OSError:
+            # Created by another job
+            if not exists(index_root):
+                raise
+    name = '%s_%d' % (_file_md5(reference_fp), int(max_pos))
+    index_dir = join(index_root, name)
+    marker = join(index_dir, SORTMERNA_INDEX_MARKER)
+
+    with open(join(index_root, '%s.lock' % name), 'a') as lock:
+        flock(lock, LOCK_SH)
+        try:
+            if not exists(marker):
+                flock(lock, LOCK_UN)
+                flock(lock, LOCK_EX)
+                # Another job may have built it while waiting for the lock
+                if not exists(marker):
+                    _build_cached_index(reference_fp, max_pos, index_root,
+                                        index_dir)
+                flock(lock, LOCK_SH)
+            utime(marker, None)
+            if max_size is not None:
+                evict_sortmerna_indexes(index_root, max_size, keep=name)
+            yield join(index_dir, SORTMERNA_INDEX_PREFIX)
+        finally:
+            flock(lock, LOCK_UN)
 
 
 def generate_pick_closed_reference_otus_cmd(filepaths, out_dir, parameters):
@@ -51,9 +262,19 @@ def generate_pick_closed_reference_otus_cmd(filepaths, out_dir, parameters):
     str, str
         The pick_closed_reference_otus.py command
         The output directory
+
+    Notes
+    -----
+    If the preprocessed fasta file is gzipped, it is decompressed to
+    `out_dir`
     """
     # It should be only a single preprocessed fasta file
     seqs_fp = filepaths['preprocessed_fasta'][0]
+    if seqs_fp.endswith('.gz'):
+        # pick_closed_reference_otus.py doesn't read gzipped files
+        fna_fp = join(out_dir, 'seqs.fna')
+        decompress_file(seqs_fp, fna_fp)
+        seqs_fp = fna_fp
 
     output_dir = join(out_dir, 'cr_otus')
     param_fp = join(out_dir, 'cr_params.txt')
@@ -68,23 +289,712 @@ def generate_pick_closed_reference_otus_cmd(filepaths, out_dir, parameters):
     return cmd, output_dir
 
 
-def generate_sortmerna_tgz(out_dir):
-    """Generates the sortmerna failures tgz command
+def _open_fasta(fp):
+    """Opens a (gzipped) FASTA file in binary mode"""
+    if fp.endswith('.gz'):
+        return open_gzip(fp)
+    return open(fp, 'rb')
+
+
+def _header_sample(header):
+    """Returns the sample of a FASTA header, e.g. b'>sample_0 orig_bc=...'"""
+    return header[1:].split(None, 1)[0].rsplit(b'_', 1)[0]
+
+
+def count_fasta_records(fp):
+    """Counts the records of a FASTA file
+
+    Parameters
+    ----------
+    fp : str
+        The (gzipped) FASTA filepath
+
+    Returns
+    -------
+    int
+        The number of records
+    """
+    count = 0
+    # The file starts at a line start, so a leading '>' is also counted
+    last = b'\n'
+    with _open_fasta(fp) as f:
+        for chunk in iter(partial(f.read, FASTA_CHUNK_SIZE), b''):
+            count += (last + chunk).count(b'\n>')
+            last = chunk[-1:]
+    return count
+
+
+def count_sample_records(fp):
+    """Counts the records of each sample of a FASTA file
+
+    Parameters
+    ----------
+    fp : str
+        The (gzipped) FASTA filepath, with the sample as the prefix of the
+        sequence ids
+
+    Returns
+    -------
+    OrderedDict of {bytes: int}
+        The number of records, keyed by sample in order of appearance
+    """
+    counts = OrderedDict()
+    with _open_fasta(fp) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                sample = _header_sample(line)
+                counts[sample] = counts.get(sample, 0) + 1
+    return counts
+
+
+def assign_samples(counts, num_shards):
+    """Assigns whole samples to shards, balancing the records of each shard
+
+    Parameters
+    ----------
+    counts : OrderedDict of {bytes: int}
+        The number of records of each sample
+    num_shards : int
+        The number of shards
+
+    Returns
+    -------
+    dict of {bytes: int}
+        The shard of each sample
+
+    Notes
+    -----
+    The samples are assigned from the largest to the smallest to the shard
+    with the fewest records so far. Ties are broken by the order of the
+    samples and the shards, so the assignment is deterministic.
+    """
+    shards = [(0, i) for i in range(num_shards)]
+    heapify(shards)
+    assignment = {}
+    # sorted is stable, so samples with the same count keep their order
+    for sample in sorted(counts, key=lambda s: -counts[s]):
+        load, shard = heappop(shards)
+        assignment[sample] = shard
+        heappush(shards, (load + counts[sample], shard))
+    return assignment
+
+
+def split_fasta(fp, out_fps, by_sample=False):
+    """Splits a FASTA file into record-balanced shards
+
+    Parameters
+    ----------
+    fp : str
+        The (gzipped) FASTA filepath
+    out_fps : list of str
+        The filepaths of the shards
+    by_sample : bool, optional
+        Whether all the records of a sample are written to the same shard
+
+    Returns
+    -------
+    list of int
+        The number of records of each shard
+
+    Notes
+    -----
+    By default the shards are consecutive runs of records, so concatenating
+    them gives back the input file. With `by_sample` the samples are
+    distributed among the shards as `assign_samples` does, keeping the order
+    of the records within each shard.
+    """
+    num_shards = len(out_fps)
+    if by_sample:
+        assignment = assign_samples(count_sample_records(fp), num_shards)
+
+        def shard_of(header, idx):
+            return assignment[_header_sample(header)]
+    else:
+        total = count_fasta_records(fp)
+        # The records before bounds[i] and not before bounds[i - 1] are in
+        # the shard i
+        bounds = [(i + 1) * total // num_shards for i in range(num_shards)]
+        current = [0]
+
+        def shard_of(header, idx):
+            while idx >= bounds[current[0]]:
+                current[0] += 1
+            return current[0]
+
+    counts = [0] * num_shards
+    outs = [open(out_fp, 'wb') for out_fp in out_fps]
+    try:
+        out = None
+        idx = 0
+        with _open_fasta(fp) as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    shard = shard_of(line, idx)
+                    out = outs[shard]
+                    counts[shard] += 1
+                    idx += 1
+                out.write(line)
+    finally:
+        for out in outs:
+            out.close()
+    return counts
+
+
+def generate_sharded_pick_otus_cmds(filepaths, out_dir, parameters):
+    """Generates a pick_closed_reference_otus.py command per shard
 
     Parameters
     ----------
+    filepaths : list of (str, str)
+        The artifact's filepaths and their types
     out_dir : str
         The job output directory
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Returns
+    -------
+    list of str, list of str, str
+        The pick_closed_reference_otus.py commands
+        The output directory of each command
+        The output directory of the merged results
+
+    Notes
+    -----
+    The preprocessed fasta file is split in `parameters['shards']` shards,
+    each of them in its own directory in `out_dir`/shards. The shards keep
+    the name of the input file, so their outputs have the same names as the
+    ones of a single command. Empty shards are not picked. If there is no
+    `parameters['sortmerna_db']`, the SortMeRNA index of the reference is
+    built in `out_dir`/shards and used by all the shards.
+
+    Raises
+    ------
+    RuntimeError
+        If the SortMeRNA index can't be built
+    """
+    seqs_fp = filepaths['preprocessed_fasta'][0]
+    fname = basename(seqs_fp)
+    if fname.endswith('.gz'):
+        fname = fname[:-3]
+    num_shards = int(parameters['shards'])
+    shard_dirs = [join(out_dir, 'shards', str(i)) for i in range(num_shards)]
+    for shard_dir in shard_dirs:
+        makedirs(shard_dir)
+    # The ids of the dereplicated sequences have no sample
+    counts = split_fasta(seqs_fp, [join(d, fname) for d in shard_dirs],
+                         parameters['shard_by_sample'] and
+                         not parameters['dereplicate'])
+
+    # Empty shards are skipped, unless all of them are empty
+    picked = [i for i, count in enumerate(counts) if count] or [0]
+
+    param_fp = join(out_dir, 'cr_params.txt')
+    reference_fp = parameters.pop('reference-seq')
+    taxonomy_fp = parameters.pop('reference-tax')
+    if len(picked) > 1 and not parameters.get('sortmerna_db'):
+        # Without an index, each shard would build the index of the whole
+        # reference, so it is built once and shared by all of them
+        index_dir = join(out_dir, 'shards', SORTMERNA_INDEX_DIR)
+        makedirs(index_dir)
+        parameters['sortmerna_db'] = join(index_dir, SORTMERNA_INDEX_PREFIX)
+        build_sortmerna_index(reference_fp, parameters['sortmerna_max_pos'],
+                              parameters['sortmerna_db'])
+    write_parameters_file(param_fp, parameters)
+
+    cmds = []
+    outputs = []
+    for i in picked:
+        shard_dir = shard_dirs[i]
+        outputs.append(join(shard_dir, 'cr_otus'))
+        cmds.append(str(
+            "pick_closed_reference_otus.py -i %s -r %s -o %s -p %s -t %s"
+            % (join(shard_dir, fname), reference_fp, outputs[-1], param_fp,
+               taxonomy_fp)))
+    return cmds, outputs, join(out_dir, 'cr_otus')
+
+
+def merge_otu_maps(fps, out_fp):
+    """Merges OTU maps
+
+    Parameters
+    ----------
+    fps : list of str
+        The OTU map filepaths, in order
+    out_fp : str
+        The merged OTU map filepath
+
+    Notes
+    -----
+    The sequences of each OTU are listed in the order of the maps, so if the
+    maps come from consecutive shards of a file they are in the order of the
+    file. The OTUs are listed in order of appearance.
+    """
+    otus = OrderedDict()
+    for fp in fps:
+        with open(fp, 'rb') as f:
+            for line in f:
+                fields = line.rstrip(b'\r\n').split(b'\t')
+                if fields[0]:
+                    otus.setdefault(fields[0], []).extend(fields[1:])
+    with open(out_fp, 'wb') as f:
+        for otu, seqs in otus.items():
+            f.write(b'\t'.join([otu] + seqs) + b'\n')
+
+
+def generate_merge_shards_cmd(shard_outs, output_dir, taxonomy_fp):
+    """Merges the outputs of the shards, generating the OTU table command
+
+    Parameters
+    ----------
+    shard_outs : list of str
+        The pick_closed_reference_otus.py output directories, in order
+    output_dir : str
+        The output directory of the merged results
+    taxonomy_fp : str
+        The reference taxonomy filepath
 
     Returns
     -------
     str
-        The sortmerna failures tgz command
+        The make_otu_table.py command that generates the OTU table of the
+        merged OTU map
+
+    Notes
+    -----
+    The OTU maps of sortmerna_picked_otus are merged with `merge_otu_maps`,
+    the rest of its files (failures and logs) and the workflow logs are
+    concatenated. The OTU table is created from the merged map with the same
+    make_otu_table.py call that pick_closed_reference_otus.py does, so it is
+    the same table that a single command creates.
+    """
+    otus_dir = join(output_dir, 'sortmerna_picked_otus')
+    makedirs(otus_dir)
+    map_fp = None
+    for fname in sorted(listdir(join(shard_outs[0], 'sortmerna_picked_otus'))):
+        fps = [join(d, 'sortmerna_picked_otus', fname) for d in shard_outs]
+        if fname.endswith('_otus.txt'):
+            map_fp = join(otus_dir, fname)
+            merge_otu_maps(fps, map_fp)
+        else:
+            concatenate_files(fps, join(otus_dir, fname))
+
+    log_fps = [sorted(glob(join(d, 'log_*.txt')))[0] for d in shard_outs]
+    concatenate_files(log_fps, join(output_dir, basename(log_fps[0])))
+
+    return _make_otu_table_cmd(map_fp, taxonomy_fp, output_dir)
+
+
+def _make_otu_table_cmd(map_fp, taxonomy_fp, output_dir):
+    """Generates the make_otu_table.py command of the OTU picking workflow"""
+    return str("make_otu_table.py -i %s -t %s -o %s"
+               % (map_fp, taxonomy_fp, join(output_dir, 'otu_table.biom')))
+
+
+def _parse_fasta(f):
+    """Yields the id and sequence of the records of a FASTA file
+
+    Parameters
+    ----------
+    f : file
+        The FASTA file, opened in binary mode
+
+    Yields
+    ------
+    bytes, bytes
+        The sequence id (the header up to the first space) and the sequence
+    """
+    read_id = None
+    seq = []
+    for line in f:
+        if line.startswith(b'>'):
+            if read_id is not None:
+                yield read_id, b''.join(seq)
+            read_id = line[1:].split(None, 1)[0]
+            seq = []
+        else:
+            seq.append(line.strip())
+    if read_id is not None:
+        yield read_id, b''.join(seq)
+
+
+def dereplicate_fasta(fp, out_fp, derep_map_fp):
+    """Collapses the identical sequences of a FASTA file
+
+    Parameters
+    ----------
+    fp : str
+        The (gzipped) FASTA filepath
+    out_fp : str
+        The filepath where the unique sequences are written. Their ids are
+        derep_<index>, in order of first appearance
+    derep_map_fp : str
+        The filepath of the dereplication map: the unique sequence id and the
+        sequence id of each record of `fp`, in order
+
+    Returns
+    -------
+    int, int
+        The number of sequences and of unique sequences
+
+    Notes
+    -----
+    The unique sequences are keyed by the md5 digest of the sequence, so only
+    16 bytes per unique sequence are kept in memory. The sequence ids carry
+    the sample, so the map holds the per-sample counts of each unique
+    sequence.
+    """
+    uniques = {}
+    n_seqs = 0
+    with _open_fasta(fp) as f, open(out_fp, 'wb') as out_f, \
+            open(derep_map_fp, 'wb') as map_f:
+        for read_id, seq in _parse_fasta(f):
+            key = md5(seq).digest()
+            idx = uniques.get(key)
+            if idx is None:
+                idx = uniques[key] = len(uniques)
+                out_f.write(b'>derep_%d\n%s\n' % (idx, seq))
+            map_f.write(b'derep_%d\t%s\n' % (idx, read_id))
+            n_seqs += 1
+    return n_seqs, len(uniques)
+
+
+def expand_otu_map(otu_map_fp, failures_fp, derep_map_fp, cached=None):
+    """Replaces the unique sequences of an OTU map by their sequences
+
+    Parameters
+    ----------
+    otu_map_fp : str
+        The OTU map of the unique sequences. It is overwritten
+    failures_fp : str or None
+        The unique sequences that failed to hit the reference. If provided, it
+        is overwritten
+    derep_map_fp : str
+        The dereplication map, as written by `dereplicate_fasta`
+    cached : dict of {bytes: bytes or None}, optional
+        The OTU of the unique sequences that were not picked, as returned by
+        `filter_cached_sequences`
+
+    Notes
+    -----
+    The OTUs keep their order, followed by the ones only found in `cached`.
+    The sequences of each OTU and the failures are in the order of the
+    dereplicated file, as if it was picked as is.
+    """
+    otus = OrderedDict()
+    otu_of = {}
+    with open(otu_map_fp, 'rb') as f:
+        for line in f:
+            fields = line.rstrip(b'\r\n').split(b'\t')
+            if fields[0]:
+                otus[fields[0]] = []
+                otu_of.update((unique, fields[0]) for unique in fields[1:])
+    if cached:
+        otu_of.update((unique, otu) for unique, otu in cached.items()
+                      if otu is not None)
+
+    failures = []
+    with open(derep_map_fp, 'rb') as f:
+        for line in f:
+            unique, seq_id = line.rstrip(b'\n').split(b'\t')
+            otu = otu_of.get(unique)
+            if otu is None:
+                failures.append(seq_id)
+            else:
+                otus.setdefault(otu, []).append(seq_id)
+
+    with open(otu_map_fp, 'wb') as f:
+        for otu, seqs in otus.items():
+            f.write(b'\t'.join([otu] + seqs) + b'\n')
+    if failures_fp is not None:
+        with open(failures_fp, 'wb') as f:
+            f.writelines(seq_id + b'\n' for seq_id in failures)
+
+
+def generate_expand_otus_cmd(pick_out, derep_map_fp, taxonomy_fp,
+                             derep_counts, cached=None):
+    """Expands the OTUs of the unique sequences, generating the table command
+
+    Parameters
+    ----------
+    pick_out : str
+        The pick_closed_reference_otus.py output directory of the unique
+        sequences
+    derep_map_fp : str
+        The dereplication map, as written by `dereplicate_fasta`
+    taxonomy_fp : str
+        The reference taxonomy filepath
+    derep_counts : (int, int)
+        The number of sequences and of unique sequences
+    cached : dict of {bytes: bytes or None}, optional
+        The OTU of the unique sequences found in the OTU cache
+
+    Returns
+    -------
+    str
+        The make_otu_table.py command that generates the OTU table of the
+        expanded OTU map, replacing the one of the unique sequences
+    """
+    otus_dir = join(pick_out, 'sortmerna_picked_otus')
+    map_fp = glob(join(otus_dir, '*_otus.txt'))[0]
+    failures_fp = glob(join(otus_dir, '*_failures.txt'))
+    expand_otu_map(map_fp, failures_fp[0] if failures_fp else None,
+                   derep_map_fp, cached)
+    _append_to_log(pick_out, "Dereplicated %d sequences into %d unique "
+                             "sequences" % derep_counts)
+    return _make_otu_table_cmd(map_fp, taxonomy_fp, pick_out)
+
+
+def _append_to_log(pick_out, msg):
+    """Appends a message to the pick_closed_reference_otus.py log"""
+    log_fp = sorted(glob(join(pick_out, 'log_*.txt')))[0]
+    with open(log_fp, 'a') as f:
+        f.write("\n%s\n" % msg)
+
+
+class OTUCache(object):
+    """Persistent cache of the OTU of the sequences picked against a reference
+
+    Parameters
+    ----------
+    db_fp : str
+        The SQLite database filepath
+    reference_fp : str
+        The reference sequences filepath
+    parameters : dict
+        The command's parameters, keyed by parameter name
+
+    Attributes
+    ----------
+    context : str
+        The key of the reference and of the SortMeRNA parameters. The OTUs
+        are only shared among jobs with the same context
+
+    Notes
+    -----
+    The sequences are keyed by their md5 digest, as `dereplicate_fasta` does.
+    The failures are also stored, with a NULL OTU. SQLite locks the database
+    while it is written, so it can be shared by jobs running at the same time.
+    """
+    PARAMETERS = ('similarity', 'sortmerna_coverage', 'sortmerna_e_value',
+                  'sortmerna_max_pos')
+
+    def __init__(self, db_fp, reference_fp, parameters):
+        key = [_file_md5(reference_fp)]
+        key.extend('%s=%s' % (p, parameters[p]) for p in self.PARAMETERS)
+        self.context = md5('\t'.join(key).encode('ascii')).hexdigest()
+        self._conn = sqlite3.connect(db_fp, timeout=OTU_CACHE_TIMEOUT)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS assignments ("
+                "context TEXT NOT NULL, digest BLOB NOT NULL, otu BLOB, "
+                "PRIMARY KEY (context, digest))")
+
+    def lookup(self, digests):
+        """Returns the cached OTUs of the sequences
+
+        Parameters
+        ----------
+        digests : list of bytes
+            The md5 digests of the sequences
+
+        Returns
+        -------
+        dict of {bytes: bytes or None}
+            The OTU of the cached sequences, keyed by digest. None if the
+            sequence failed to hit the reference
+        """
+        found = {}
+        for i in range(0, len(digests), OTU_CACHE_BATCH_SIZE):
+            batch = digests[i:i + OTU_CACHE_BATCH_SIZE]
+            rows = self._conn.execute(
+                "SELECT digest, otu FROM assignments WHERE context = ? AND "
+                "digest IN (%s)" % ', '.join('?' * len(batch)),
+                [self.context] + [sqlite3.Binary(d) for d in batch])
+            found.update((bytes(digest), None if otu is None else bytes(otu))
+                         for digest, otu in rows)
+        return found
+
+    def store(self, assignments):
+        """Stores the OTUs of the sequences
+
+        Parameters
+        ----------
+        assignments : iterable of (bytes, bytes or None)
+            The md5 digest and the OTU (None for failures) of each sequence
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO assignments VALUES (?, ?, ?)",
+                ((self.context, sqlite3.Binary(digest),
+                  None if otu is None else sqlite3.Binary(otu))
+                 for digest, otu in assignments))
+
+    def close(self):
+        """Closes the database"""
+        self._conn.close()
+
+
+def get_otu_cache(parameters, cache_dir=None):
+    """Opens the OTU cache of the reference of a job
+
+    Parameters
+    ----------
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    cache_dir : str, optional
+        The directory of the cache. Defaults to the value returned by
+        `get_cache_dir`
+
+    Returns
+    -------
+    OTUCache or None
+        The cache, None if there is no cache directory
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    return OTUCache(join(cache_dir, OTU_CACHE_DB), parameters['reference-seq'],
+                    parameters)
+
+
+def _fasta_batches(fp):
+    """Yields the (id, sequence) records of a FASTA file in batches"""
+    batch = []
+    with open(fp, 'rb') as f:
+        for record in _parse_fasta(f):
+            batch.append(record)
+            if len(batch) == OTU_CACHE_BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def filter_cached_sequences(fp, out_fp, cache):
+    """Writes the sequences without an OTU in the cache
+
+    Parameters
+    ----------
+    fp : str
+        The unique sequences FASTA filepath
+    out_fp : str
+        The filepath where the sequences not found in `cache` are written
+    cache : OTUCache
+        The OTU cache
+
+    Returns
+    -------
+    dict of {bytes: bytes or None}
+        The OTU of the sequences found in the cache (None for failures),
+        keyed by sequence id
+    """
+    cached = {}
+    with open(out_fp, 'wb') as out_f:
+        for batch in _fasta_batches(fp):
+            digests = [md5(seq).digest() for _, seq in batch]
+            found = cache.lookup(digests)
+            for (seq_id, seq), digest in zip(batch, digests):
+                if digest in found:
+                    cached[seq_id] = found[digest]
+                else:
+                    out_f.write(b'>%s\n%s\n' % (seq_id, seq))
+    return cached
+
+
+def cache_otu_assignments(fp, otu_map_fp, failures_fp, cache):
+    """Stores the OTUs of the picked sequences in the cache
+
+    Parameters
+    ----------
+    fp : str
+        The FASTA filepath of the picked sequences
+    otu_map_fp : str
+        The OTU map of the picked sequences
+    failures_fp : str or None
+        The sequences that failed to hit the reference
+    cache : OTUCache
+        The OTU cache
+    """
+    otu_of = {}
+    with open(otu_map_fp, 'rb') as f:
+        for line in f:
+            fields = line.rstrip(b'\r\n').split(b'\t')
+            otu_of.update((seq_id, fields[0]) for seq_id in fields[1:])
+    if failures_fp is not None:
+        with open(failures_fp, 'rb') as f:
+            otu_of.update((line.strip(), None) for line in f)
+
+    def assignments():
+        for batch in _fasta_batches(fp):
+            for seq_id, seq in batch:
+                if seq_id in otu_of:
+                    yield md5(seq).digest(), otu_of[seq_id]
+    cache.store(assignments())
+
+
+def _write_cached_pick_out(pick_out, fname):
+    """Creates the pick_closed_reference_otus.py outputs of nothing picked"""
+    otus_dir = join(pick_out, 'sortmerna_picked_otus')
+    makedirs(otus_dir)
+    prefix = splitext(fname)[0]
+    for suffix in ['_otus.txt', '_failures.txt']:
+        open(join(otus_dir, prefix + suffix), 'w').close()
+    with open(join(pick_out, 'log_%s.txt' % strftime('%Y%m%d%H%M%S')),
+              'w') as f:
+        f.write("All the sequences were found in the OTU cache\n")
+
+
+def generate_sortmerna_tgz(out_dir, num_jobs=None):
+    """Archives the sortmerna_picked_otus directory
+
+    Parameters
+    ----------
+    out_dir : str
+        The job output directory
+    num_jobs : int, optional
+        The number of threads compressing the archive. Defaults to the value
+        returned by `get_num_jobs`
+
+    Returns
+    -------
+    int, int, float
+        The number of bytes archived, the size of the archive and the seconds
+        spent archiving
+
+    Notes
+    -----
+    The tar stream is BGZF compressed in parallel, so the archive can still be
+    decompressed by any gzip reader
     """
     to_tgz = join(out_dir, 'sortmerna_picked_otus')
     tgz = to_tgz + '.tgz'
-    with taropen(tgz, "w:gz") as tar:
-        tar.add(to_tgz, arcname=basename(to_tgz))
+    start = time()
+    with GzipWriter(tgz, num_jobs) as out_f:
+        with taropen(fileobj=out_f, mode='w|') as tar:
+            tar.add(to_tgz, arcname=basename(to_tgz))
+    elapsed = time() - start
+    return _dir_size(to_tgz), getsize(tgz), elapsed
+
+
+def _start_sortmerna_tgz(out_dir):
+    """Starts archiving the sortmerna_picked_otus directory in a thread
+
+    Parameters
+    ----------
+    out_dir : str
+        The job output directory
+
+    Returns
+    -------
+    multiprocessing.pool.AsyncResult
+        The result of `generate_sortmerna_tgz`
+    """
+    pool = ThreadPool(1)
+    result = pool.apply_async(generate_sortmerna_tgz, (out_dir,))
+    pool.close()
+    return result
 
 
 def generate_artifact_info(pick_out):
@@ -108,6 +1018,143 @@ def generate_artifact_info(pick_out):
     return [ArtifactInfo('OTU table', 'BIOM', filepaths)]
 
 
+def _pick_otus(qclient, job_id, fps, out_dir, parameters, otu_cache=None):
+    """Executes the OTU picking, over shards and unique sequences if requested
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    fps : dict of {str: list of str}
+        The artifact's filepaths, keyed by type
+    out_dir : str
+        The path to the job's output directory
+    parameters : dict
+        The command's parameters, keyed by parameter name
+    otu_cache : OTUCache, optional
+        The OTU cache. Only used if the sequences are dereplicated, in which
+        case only the unique sequences not found in the cache are picked
+
+    Returns
+    -------
+    str, multiprocessing.pool.AsyncResult, str
+        The pick_closed_reference_otus.py output directory
+        The result of archiving the sortmerna_picked_otus directory, if it
+        was started while generating the OTU table, None otherwise
+        The error message, "" if there is no error
+    """
+    # If requested, the OTUs of the unique sequences are picked and expanded
+    # afterwards
+    taxonomy_fp = parameters['reference-tax']
+    derep_map_fp = None
+    cached = None
+    if parameters['dereplicate']:
+        qclient.update_job_step(
+            job_id,
+            "Step 2 of 4: Generating command (dereplicating sequences)")
+        seqs_fp = fps['preprocessed_fasta'][0]
+        fname = basename(seqs_fp)
+        if fname.endswith('.gz'):
+            fname = fname[:-3]
+        derep_dir = join(out_dir, 'dereplicated')
+        makedirs(derep_dir)
+        derep_map_fp = join(derep_dir, 'dereplication_map.txt')
+        if otu_cache is None:
+            derep_counts = dereplicate_fasta(seqs_fp, join(derep_dir, fname),
+                                             derep_map_fp)
+        else:
+            uniques_fp = join(derep_dir, 'uniques.fna')
+            derep_counts = dereplicate_fasta(seqs_fp, uniques_fp,
+                                             derep_map_fp)
+            cached = filter_cached_sequences(
+                uniques_fp, join(derep_dir, fname), otu_cache)
+        fps = dict(fps)
+        fps['preprocessed_fasta'] = [join(derep_dir, fname)]
+
+    # If more than one shard is requested, the sequences are split in shards
+    # that are picked in parallel and merged afterwards. If all the sequences
+    # are in the OTU cache, there is nothing to pick
+    if cached is not None and len(cached) == derep_counts[1]:
+        pick_out = join(out_dir, 'cr_otus')
+        _write_cached_pick_out(pick_out, fname)
+        commands, shard_outs = [], None
+    elif int(parameters['shards']) > 1:
+        commands, shard_outs, pick_out = generate_sharded_pick_otus_cmds(
+            fps, out_dir, parameters)
+    else:
+        command, pick_out = generate_pick_closed_reference_otus_cmd(
+            fps, out_dir, parameters)
+        commands, shard_outs = [command], None
+
+    step = "Step 3 of 4: Executing OTU picking"
+    qclient.update_job_step(job_id, step)
+    if shard_outs is None:
+        results = []
+        if commands:
+            std_out, std_err, return_value = streaming_system_call(
+                commands[0], log_prefix=join(out_dir, 'pick_otus'),
+                progress_callback=lambda line: qclient.update_job_step(
+                    job_id, "%s (%s)" % (step, line)))
+            results.append((0, std_out, std_err, return_value))
+    else:
+        results = parallel_system_call(commands)
+    try:
+        for done, result in enumerate(results, 1):
+            i, std_out, std_err, return_value = result
+            if return_value != 0:
+                error_msg = ("Error running OTU picking:\nStd out: %s\n"
+                             "Std err: %s" % (std_out, std_err))
+                return None, None, error_msg
+            if shard_outs is not None:
+                qclient.update_job_step(
+                    job_id, "%s (%d of %d shards done)"
+                    % (step, done, len(commands)))
+    finally:
+        # Kills the shards still running if one of them failed
+        if shard_outs is not None:
+            results.close()
+
+    # The OTU table is generated once, from the merged and expanded OTU map
+    table_cmd = None
+    if shard_outs is not None:
+        qclient.update_job_step(job_id, "%s (merging shards)" % step)
+        table_cmd = generate_merge_shards_cmd(shard_outs, pick_out,
+                                              taxonomy_fp)
+    if cached is not None:
+        otus_dir = join(pick_out, 'sortmerna_picked_otus')
+        failures_fp = glob(join(otus_dir, '*_failures.txt'))
+        cache_otu_assignments(fps['preprocessed_fasta'][0],
+                              glob(join(otus_dir, '*_otus.txt'))[0],
+                              failures_fp[0] if failures_fp else None,
+                              otu_cache)
+        _append_to_log(
+            pick_out, "OTU cache hits: %d of %d unique sequences (%.1f%%)"
+            % (len(cached), derep_counts[1],
+               100. * len(cached) / max(derep_counts[1], 1)))
+    if derep_map_fp is not None:
+        qclient.update_job_step(
+            job_id, "%s (expanding unique sequences)" % step)
+        table_cmd = generate_expand_otus_cmd(pick_out, derep_map_fp,
+                                             taxonomy_fp, derep_counts,
+                                             cached)
+    # The OTU map is complete, so it is archived while the table is generated
+    archive = None
+    if table_cmd is not None:
+        archive = _start_sortmerna_tgz(pick_out)
+        std_out, std_err, return_value = streaming_system_call(
+            table_cmd, log_prefix=join(out_dir, 'make_otu_table'))
+        if return_value != 0:
+            error_msg = ("Error generating the OTU table:\nStd out: "
+                         "%s\nStd err: %s" % (std_out, std_err))
+            return None, None, error_msg
+    rmtree(join(out_dir, 'shards'), ignore_errors=True)
+    rmtree(join(out_dir, 'dereplicated'), ignore_errors=True)
+
+    return pick_out, archive, ""
+
+
 def pick_closed_reference_otus(qclient, job_id, parameters, out_dir):
     """Run split libraries fastq with the given parameters
 
@@ -137,24 +1184,45 @@ def pick_closed_reference_otus(qclient, job_id, parameters, out_dir):
     a_info = qclient.get("/qiita_db/artifacts/%s/" % artifact_id)
     fps = a_info['files']
 
+    # The SortMeRNA index of the reference is taken from the cache, if there is
+    # one, and kept locked while the OTUs are picked. If the sequences are
+    # dereplicated, the OTUs of the unique sequences already picked are also
+    # taken from the cache
     qclient.update_job_step(job_id, "Step 2 of 4: Generating command")
-    command, pick_out = generate_pick_closed_reference_otus_cmd(
-        fps, out_dir, parameters)
-
-    qclient.update_job_step(job_id, "Step 3 of 4: Executing OTU picking")
-    std_out, std_err, return_value = system_call(command)
-    if return_value != 0:
-        error_msg = ("Error running OTU picking:\nStd out: %s\nStd err: %s"
-                     % (std_out, std_err))
+    otu_cache = None
+    if parameters['dereplicate']:
+        otu_cache = get_otu_cache(parameters)
+    try:
+        with cached_sortmerna_index(
+                parameters['reference-seq'],
+                parameters['sortmerna_max_pos']) as sortmerna_db:
+            if sortmerna_db is not None:
+                parameters['sortmerna_db'] = sortmerna_db
+            pick_out, archive, error_msg = _pick_otus(
+                qclient, job_id, fps, out_dir, parameters, otu_cache)
+    except RuntimeError as e:
+        return False, None, str(e)
+    finally:
+        if otu_cache is not None:
+            otu_cache.close()
+    if error_msg:
         return False, None, error_msg
 
     qclient.update_job_step(job_id,
                             "Step 4 of 4: Generating tgz sortmerna folder")
     try:
-        generate_sortmerna_tgz(pick_out)
+        if archive is not None:
+            archived, archive_size, elapsed = archive.get()
+        else:
+            archived, archive_size, elapsed = generate_sortmerna_tgz(pick_out)
     except Exception as e:
         error_msg = ("Error while tgz failures:\nError: %s" % str(e))
         return False, None, error_msg
+    _append_to_log(
+        pick_out, "Archived %d bytes of sortmerna_picked_otus into %d bytes "
+        "in %.1f seconds (%.1f MB/s)"
+        % (archived, archive_size, elapsed,
+           archived / 1048576. / max(elapsed, 1e-6)))
 
     artifacts_info = generate_artifact_info(pick_out)
 
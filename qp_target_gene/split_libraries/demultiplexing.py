@@ -0,0 +1,1195 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import makedirs, fdopen, rename, remove
+from os.path import join, exists
+from tempfile import mkstemp
+from itertools import combinations
+from functools import partial
+from collections import Counter
+from hashlib import md5
+
+from future.moves.itertools import zip_longest
+
+import numpy as np
+import pandas as pd
+
+from qp_target_gene.util import get_cache_dir
+from .util import (_open_fastq, read_fastq_batches, write_fastq, open_output,
+                   COPY_BUFFER_SIZE)
+
+# Number of reads quality filtered at once
+DEMUX_BATCH_SIZE = 10000
+
+# The barcode types supported by `demultiplex_fastq`. Besides these, the
+# barcode type can be the length of barcodes that are not error corrected.
+# As in split_libraries_fastq.py, hamming_8 barcodes are not error corrected
+SUPPORTED_BARCODE_TYPES = ('golay_12', 'hamming_8')
+
+# Maximum number of observed barcodes whose assignment is remembered by a
+# `BarcodeTable`, besides the ones precomputed from the mapping file
+BARCODE_TABLE_MAX_MISSES = 2 ** 20
+
+# The barcode assigned to the reads of per-sample FASTQ files
+PER_SAMPLE_BARCODE = b'AAAAAAAAAAAA'
+
+# The quality filter counts of the split_libraries_fastq.py log, and the
+# `DemuxStats` attribute holding each of them. Reads with an Illumina quality
+# digit of 0 are not filtered, so that count is always 0
+LOG_COUNTS = [("Total number of input sequences", 'input_sequence_count'),
+              ("Barcode not in mapping file", 'barcode_not_in_map'),
+              ("Read too short after quality truncation", 'too_short'),
+              ("Count of N characters exceeds limit", 'too_many_n'),
+              ("Illumina quality digit = 0", None),
+              ("Barcode errors exceed max", 'barcode_errors_exceed_max')]
+
+# Golay (24, 12) code as used by QIIME. Each nucleotide is encoded with 2 bits
+GOLAY_NT_TO_BITS = {'A': '11', 'C': '00', 'T': '10', 'G': '01'}
+GOLAY_P = np.array([
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+    [1, 1, 1, 0, 1, 1, 1, 0, 0, 0, 1, 0],
+    [1, 1, 0, 1, 1, 1, 0, 0, 0, 1, 0, 1],
+    [1, 0, 1, 1, 1, 0, 0, 0, 1, 0, 1, 1],
+    [1, 1, 1, 1, 0, 0, 0, 1, 0, 1, 1, 0],
+    [1, 1, 1, 0, 0, 0, 1, 0, 1, 1, 0, 1],
+    [1, 1, 0, 0, 0, 1, 0, 1, 1, 0, 1, 1],
+    [1, 0, 0, 0, 1, 0, 1, 1, 0, 1, 1, 1],
+    [1, 0, 0, 1, 0, 1, 1, 0, 1, 1, 1, 0],
+    [1, 0, 1, 0, 1, 1, 0, 1, 1, 1, 0, 0],
+    [1, 1, 0, 1, 1, 0, 1, 1, 1, 0, 0, 0],
+    [1, 0, 1, 1, 0, 1, 1, 1, 0, 0, 0, 1]])
+GOLAY_H = np.concatenate((np.identity(12, dtype=int), GOLAY_P.T), axis=1)
+# Number of bit errors that the Golay code can correct
+GOLAY_MAX_ERRORS = 3
+
+_COMPLEMENT = bytearray(range(256))
+for _nt, _comp in zip(bytearray(b'ACGTNacgtn'), bytearray(b'TGCANtgcan')):
+    _COMPLEMENT[_nt] = _comp
+_COMPLEMENT = bytes(_COMPLEMENT)
+_COMPLEMENT_ARRAY = np.frombuffer(_COMPLEMENT, dtype=np.uint8)
+
+
+def reverse_complement(seq):
+    """Returns the reverse complement of a DNA sequence
+
+    Parameters
+    ----------
+    seq : bytes
+        The DNA sequence
+
+    Returns
+    -------
+    bytes
+        The reverse complement of `seq`
+    """
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def _golay_syndrome_tables():
+    """Builds the tables used to decode the Golay barcodes
+
+    Returns
+    -------
+    list of dict of {int: int}, dict of {int: int}
+        The syndrome of each nucleotide at each position of the barcode
+        The error pattern of each syndrome, for up to `GOLAY_MAX_ERRORS`
+        errors
+
+    Notes
+    -----
+    The bit vectors are stored as integers, being the first bit of the barcode
+    the most significant one
+    """
+    columns = [int(''.join(map(str, col)), 2) for col in GOLAY_H.T]
+    nt_syndromes = []
+    for pos in range(12):
+        nt_syndromes.append({})
+        for nt, bits in GOLAY_NT_TO_BITS.items():
+            syndrome = 0
+            for i, bit in enumerate(bits):
+                if bit == '1':
+                    syndrome ^= columns[2 * pos + i]
+            nt_syndromes[pos][ord(nt)] = syndrome
+
+    errors = {}
+    for n_errors in range(GOLAY_MAX_ERRORS + 1):
+        for bits in combinations(range(24), n_errors):
+            syndrome = 0
+            pattern = 0
+            for bit in bits:
+                syndrome ^= columns[bit]
+                pattern |= 1 << (23 - bit)
+            errors[syndrome] = pattern
+    return nt_syndromes, errors
+
+
+_GOLAY_NT_SYNDROMES, _GOLAY_ERRORS = _golay_syndrome_tables()
+_GOLAY_NT_FROM_BITS = {int(bits, 2): nt.encode('ascii')
+                       for nt, bits in GOLAY_NT_TO_BITS.items()}
+_GOLAY_BITS_TO_NT = np.array(
+    [ord(_GOLAY_NT_FROM_BITS[bits]) for bits in range(4)], dtype=np.uint8)
+
+
+def decode_golay_12(barcode):
+    """Corrects the errors of a Golay 12 barcode
+
+    Parameters
+    ----------
+    barcode : bytes
+        The 12 nucleotides barcode
+
+    Returns
+    -------
+    bytes or None, int
+        The corrected barcode, or None if it can't be corrected
+        The number of bit errors corrected (4 if it can't be corrected)
+
+    Raises
+    ------
+    ValueError
+        If the barcode is not 12 nucleotides long or it has characters other
+        than A, C, G or T
+
+    Notes
+    -----
+    Equivalent to `qiime.golay.decode`, so the number of errors is the number
+    of bits (2 per nucleotide) that are wrong
+    """
+    if len(barcode) != 12:
+        raise ValueError("Golay 12 barcodes must be 12 nucleotides long: %s"
+                         % barcode)
+    syndrome = 0
+    received = 0
+    try:
+        for pos, nt in enumerate(bytearray(barcode)):
+            syndrome ^= _GOLAY_NT_SYNDROMES[pos][nt]
+            received = (received << 2) | int(GOLAY_NT_TO_BITS[chr(nt)], 2)
+    except KeyError:
+        raise ValueError("Golay 12 barcodes can only have A, C, G or T: %s"
+                         % barcode)
+    pattern = _GOLAY_ERRORS.get(syndrome)
+    if pattern is None:
+        return None, GOLAY_MAX_ERRORS + 1
+    corrected = received ^ pattern
+    return (b''.join(_GOLAY_NT_FROM_BITS[(corrected >> (22 - 2 * i)) & 3]
+                     for i in range(12)),
+            bin(pattern).count('1'))
+
+
+def golay_12_variants(codeword, max_errors):
+    """Returns the barcodes that are decoded to a Golay 12 codeword
+
+    Parameters
+    ----------
+    codeword : bytes
+        The Golay 12 codeword
+    max_errors : int
+        The maximum number of bit errors of the barcodes
+
+    Returns
+    -------
+    list of (list of bytes, int)
+        The barcodes with each number of bit errors, from 1 to `max_errors`
+        (at most `GOLAY_MAX_ERRORS`)
+
+    Notes
+    -----
+    The Golay code is perfect, so all the barcodes with up to
+    `GOLAY_MAX_ERRORS` bit errors are decoded to `codeword`
+    """
+    bits = 0
+    for nt in bytearray(codeword):
+        bits = (bits << 2) | int(GOLAY_NT_TO_BITS[chr(nt)], 2)
+    shifts = np.arange(22, -1, -2)
+    variants = []
+    for n_errors in range(1, min(max_errors, GOLAY_MAX_ERRORS) + 1):
+        patterns = np.array([sum(1 << (23 - b) for b in flipped)
+                             for flipped in combinations(range(24), n_errors)])
+        words = bits ^ patterns
+        nts = _GOLAY_BITS_TO_NT[(words[:, None] >> shifts) & 3]
+        variants.append((nts.view('S12').ravel().tolist(), n_errors))
+    return variants
+
+
+# The functions correcting the barcodes, keyed by barcode type, as in
+# split_libraries_fastq.py
+BARCODE_DECODERS = {'golay_12': decode_golay_12}
+
+
+def is_barcode_type_supported(barcode_type):
+    """Checks if the in-process demultiplexing supports a barcode type
+
+    Parameters
+    ----------
+    barcode_type : str
+        The barcode type
+
+    Returns
+    -------
+    bool
+        Whether the barcode type is supported
+    """
+    return (barcode_type in SUPPORTED_BARCODE_TYPES or
+            str(barcode_type).isdigit())
+
+
+def is_casava_v180_or_later(header):
+    """Checks if a FASTQ header was generated by CASAVA 1.8.0 or later
+
+    Parameters
+    ----------
+    header : bytes
+        The FASTQ header, without the leading '@'
+
+    Returns
+    -------
+    bool
+        Whether the header is in the CASAVA 1.8.0 or later format
+    """
+    fields = header.split(b':')
+    return len(fields) == 10 and fields[7] in (b'Y', b'N')
+
+
+def check_header_match_pre180(header1, header2):
+    """Checks that two pre CASAVA 1.8.0 headers belong to the same read
+
+    Parameters
+    ----------
+    header1, header2 : bytes
+        The FASTQ headers
+
+    Returns
+    -------
+    bool
+        Whether the headers match, ignoring the read number (last character)
+    """
+    return header1[:-1] == header2[:-1]
+
+
+def check_header_match_180_or_later(header1, header2):
+    """Checks that two CASAVA 1.8.0 or later headers belong to the same read
+
+    Parameters
+    ----------
+    header1, header2 : bytes
+        The FASTQ headers
+
+    Returns
+    -------
+    bool
+        Whether the headers match, ignoring the read number
+    """
+    for e1, e2 in zip(header1.split(b':'), header2.split(b':')):
+        if e1.split(b' ')[0] != e2.split(b' ')[0]:
+            return False
+    return True
+
+
+def _reverse_rows(matrix, lengths):
+    """Reverses the first `lengths` values of each row of a matrix
+
+    Parameters
+    ----------
+    matrix : np.array
+        The matrix, padded with zeros
+    lengths : np.array of int
+        The number of values of each row
+
+    Returns
+    -------
+    np.array
+        The matrix with the values of each row reversed, padded with zeros
+    """
+    idx = lengths[:, None] - 1 - np.arange(matrix.shape[1])
+    rows = np.arange(len(matrix))[:, None]
+    return np.where(idx >= 0, matrix[rows, np.maximum(idx, 0)], 0).astype(
+        matrix.dtype)
+
+
+def _mask_read_number_pre180(headers, lengths):
+    """Blanks the read number (last character) of pre CASAVA 1.8.0 headers
+
+    Parameters
+    ----------
+    headers : np.array of np.uint8
+        The headers, one per row
+    lengths : np.array of int
+        The length of each header
+
+    Returns
+    -------
+    np.array of np.uint8
+        The headers without the read number
+    """
+    headers = headers.copy()
+    rows = np.flatnonzero(lengths)
+    headers[rows, lengths[rows] - 1] = 0
+    return headers
+
+
+def _mask_read_number_180_or_later(headers, lengths):
+    """Blanks the read number of CASAVA 1.8.0 or later headers
+
+    Parameters
+    ----------
+    headers : np.array of np.uint8
+        The headers, one per row
+    lengths : np.array of int
+        The length of each header
+
+    Returns
+    -------
+    np.array of np.uint8
+        The headers without the text between a space and the next ':', as
+        ignored by `check_header_match_180_or_later`
+    """
+    spaces = np.cumsum(headers == ord(' '), axis=1)
+    at_last_colon = np.maximum.accumulate(
+        np.where(headers == ord(':'), spaces, 0), axis=1)
+    return np.where(spaces > at_last_colon, 0, headers)
+
+
+_READ_NUMBER_MASKS = {
+    check_header_match_pre180: _mask_read_number_pre180,
+    check_header_match_180_or_later: _mask_read_number_180_or_later}
+
+
+def quality_truncation(quals, lengths, max_bad_run_length,
+                       phred_quality_threshold):
+    """Returns the length of the reads after the quality truncation
+
+    Parameters
+    ----------
+    quals : np.array of int
+        The PHRED scores of the reads, one read per row
+    lengths : np.array of int
+        The length of each read
+    max_bad_run_length : int
+        The maximum number of consecutive low quality base calls allowed
+    phred_quality_threshold : int
+        The maximum PHRED score considered low quality
+
+    Returns
+    -------
+    np.array of int
+        The truncated length of each read
+
+    Notes
+    -----
+    Reads are truncated before the first run of more than
+    `max_bad_run_length` consecutive low quality base calls, as done by
+    `qiime.split_libraries_fastq.read_qual_score_filter`
+    """
+    n, width = quals.shape
+    pos = np.arange(width)
+    good = (quals > phred_quality_threshold) | (pos >= lengths[:, None])
+    last_good = np.maximum.accumulate(np.where(good, pos, -1), axis=1)
+    bad_runs = (pos - last_good) > max_bad_run_length
+    truncated = bad_runs.any(axis=1)
+    first_bad_run = bad_runs.argmax(axis=1)
+    return np.where(truncated,
+                    last_good[np.arange(n), first_bad_run] + 1, lengths)
+
+
+def count_ns(seqs, lengths):
+    """Counts the N characters of each of the (truncated) reads
+
+    Parameters
+    ----------
+    seqs : np.array of np.uint8
+        The sequences of the reads, one read per row
+    lengths : np.array of int
+        The (truncated) length of each read
+
+    Returns
+    -------
+    np.array of int
+        The number of N characters in each read
+    """
+    pos = np.arange(seqs.shape[1])
+    return ((seqs == ord('N')) & (pos < lengths[:, None])).sum(axis=1)
+
+
+def get_barcode_to_sample_id(mapping_fp, rev_comp_mapping_barcodes=False):
+    """Returns the sample of each of the barcodes of a mapping file
+
+    Parameters
+    ----------
+    mapping_fp : str
+        The QIIME-compliant mapping file
+    rev_comp_mapping_barcodes : bool, optional
+        Whether the mapping file barcodes should be reverse complemented
+
+    Returns
+    -------
+    dict of {bytes: str}
+        The sample ids keyed by barcode
+    """
+    mf = pd.read_csv(mapping_fp, delimiter='\t', dtype=str, encoding='utf-8')
+    barcode_to_sample_id = {}
+    for sample_id, barcode in zip(mf['#SampleID'], mf['BarcodeSequence']):
+        barcode = barcode.upper().encode('ascii')
+        if rev_comp_mapping_barcodes:
+            barcode = reverse_complement(barcode)
+        barcode_to_sample_id[barcode] = sample_id
+    return barcode_to_sample_id
+
+
+def _is_golay_12_codeword(barcode):
+    """Checks if a barcode is a valid Golay 12 codeword
+
+    Parameters
+    ----------
+    barcode : bytes
+        The barcode
+
+    Returns
+    -------
+    bool
+        Whether the barcode is a Golay 12 codeword
+    """
+    try:
+        return decode_golay_12(barcode)[1] == 0
+    except ValueError:
+        return False
+
+
+class BarcodeTable(object):
+    """Assigns the observed barcodes to their samples
+
+    Parameters
+    ----------
+    barcode_to_sample_id : dict of {bytes: str}
+        The sample ids keyed by barcode
+    barcode_type : str or None
+        The barcode type. If None, the barcodes are not error corrected
+    max_barcode_errors : float
+        The maximum number of errors of the barcodes assigned to a sample
+    table : dict of {bytes: (str, bytes, int)}, optional
+        The precomputed `table`. If not provided, it is built
+
+    Attributes
+    ----------
+    barcode_length : int or None
+        The length of the barcodes of the mapping file, None if they don't
+        have the same length
+    table : dict of {bytes: (str, bytes, int)}
+        The sample id, corrected barcode and number of errors of the barcodes
+        of the mapping file and, if the barcodes are error corrected, of all
+        the barcodes corrected to them within `max_barcode_errors`
+
+    Raises
+    ------
+    ValueError
+        If the barcode type is golay_12 and some of the barcodes are not valid
+        Golay codewords
+
+    Notes
+    -----
+    Assigning a barcode is a single lookup in `table`. The barcodes that are
+    not in it (e.g. they have too many errors or are not in the mapping file)
+    are assigned as split_libraries_fastq.py does and the result is
+    remembered, so each distinct barcode is only corrected once.
+    """
+    def __init__(self, barcode_to_sample_id, barcode_type,
+                 max_barcode_errors, table=None):
+        lengths = set(len(bc) for bc in barcode_to_sample_id)
+        self.barcode_length = lengths.pop() if len(lengths) == 1 else None
+        self._barcode_to_sample_id = barcode_to_sample_id
+        self._correct = BARCODE_DECODERS.get(barcode_type)
+        self._misses = {}
+        if table is None:
+            table = self._build_table(barcode_type, max_barcode_errors)
+        self.table = table
+
+    def _build_table(self, barcode_type, max_barcode_errors):
+        """Builds the table of the barcodes within the error budget
+
+        Parameters
+        ----------
+        barcode_type : str
+            The barcode type
+        max_barcode_errors : float
+            The maximum number of errors of the barcodes assigned to a sample
+
+        Returns
+        -------
+        dict of {bytes: (str, bytes, int)}
+            The sample id, corrected barcode and number of errors keyed by
+            barcode
+        """
+        table = {}
+        if barcode_type == 'golay_12':
+            invalid = [bc.decode('ascii')
+                       for bc in sorted(self._barcode_to_sample_id)
+                       if not _is_golay_12_codeword(bc)]
+            if invalid:
+                raise ValueError(
+                    "Some or all barcodes are not valid golay codes. Do they "
+                    "need to be reverse complemented? Invalid codes: %s"
+                    % ' '.join(invalid))
+            max_errors = int(max_barcode_errors)
+            for codeword, sample_id in self._barcode_to_sample_id.items():
+                for variants, n_errors in golay_12_variants(
+                        codeword, max_errors):
+                    entry = (sample_id, codeword, n_errors)
+                    for variant in variants:
+                        table[variant] = entry
+        # The barcodes of the mapping file are never corrected
+        for barcode, sample_id in self._barcode_to_sample_id.items():
+            table[barcode] = (sample_id, barcode, 0)
+        return table
+
+    def assign(self, barcode):
+        """Assigns a barcode to its sample
+
+        Parameters
+        ----------
+        barcode : bytes
+            The observed barcode
+
+        Returns
+        -------
+        str or None, bytes or None, int
+            The sample id, None if the barcode is not assigned to a sample
+            The corrected barcode, None if it can't be corrected
+            The number of errors of the barcode
+        """
+        entry = self.table.get(barcode)
+        if entry is None:
+            entry = self._misses.get(barcode)
+        if entry is None:
+            corrected, n_errors = barcode, 0
+            if self._correct is not None and b'N' not in barcode:
+                corrected, n_errors = self._correct(barcode)
+            entry = (self._barcode_to_sample_id.get(corrected), corrected,
+                     n_errors)
+            if len(self._misses) < BARCODE_TABLE_MAX_MISSES:
+                self._misses[barcode] = entry
+        return entry
+
+
+def get_barcode_table(barcode_to_sample_id, barcode_type, max_barcode_errors,
+                      cache_dir=None):
+    """Returns the `BarcodeTable` of the barcodes of a mapping file
+
+    Parameters
+    ----------
+    barcode_to_sample_id : dict of {bytes: str}
+        The sample ids keyed by barcode
+    barcode_type : str
+        The barcode type
+    max_barcode_errors : float
+        The maximum number of errors of the barcodes assigned to a sample
+    cache_dir : str, optional
+        The directory where the tables are stored, so the table of a mapping
+        file is only built once. Defaults to the value returned by
+        `get_cache_dir`. If there is no cache directory, the table is always
+        built
+
+    Returns
+    -------
+    BarcodeTable
+        The barcode table
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return BarcodeTable(barcode_to_sample_id, barcode_type,
+                            max_barcode_errors)
+
+    checksum = md5()
+    for barcode, sample_id in sorted(barcode_to_sample_id.items()):
+        checksum.update(barcode + b'\t' + sample_id.encode('utf-8') + b'\n')
+    checksum.update(('%s\t%s' % (barcode_type, max_barcode_errors)).encode(
+        'ascii'))
+    table_dir = join(cache_dir, 'barcode_tables')
+    table_fp = join(table_dir, '%s.tsv' % checksum.hexdigest())
+    if exists(table_fp):
+        table = _read_barcode_table(table_fp, barcode_to_sample_id)
+        if table is not None:
+            return BarcodeTable(barcode_to_sample_id, barcode_type,
+                                max_barcode_errors, table=table)
+
+    barcode_table = BarcodeTable(barcode_to_sample_id, barcode_type,
+                                 max_barcode_errors)
+    if not exists(table_dir):
+        makedirs(table_dir)
+    # The table is written to a temporary file that is renamed once complete,
+    # so jobs running at the same time never read a partial table
+    fd, tmp_fp = mkstemp(dir=table_dir, suffix='.tmp')
+    try:
+        with fdopen(fd, 'wb') as f:
+            _write_barcode_table(f, barcode_table.table)
+        rename(tmp_fp, table_fp)
+    except Exception:
+        remove(tmp_fp)
+        raise
+    return barcode_table
+
+
+def _write_barcode_table(f, table):
+    """Writes a barcode table as tab separated values
+
+    Parameters
+    ----------
+    f : file
+        The output file, opened in binary mode
+    table : dict of {bytes: (str, bytes, int)}
+        The `BarcodeTable.table`
+
+    Notes
+    -----
+    The first line is the number of barcodes, so truncated files are detected.
+    Each barcode is followed by its corrected barcode and number of errors;
+    the sample ids are taken from the mapping file when it is read
+    """
+    f.write(b'%d\n' % len(table))
+    for barcode, (_, corrected, n_errors) in sorted(table.items()):
+        f.write(b'%s\t%s\t%d\n' % (barcode, corrected, n_errors))
+
+
+def _read_barcode_table(fp, barcode_to_sample_id):
+    """Reads a barcode table written by `_write_barcode_table`
+
+    Parameters
+    ----------
+    fp : str
+        The table filepath
+    barcode_to_sample_id : dict of {bytes: str}
+        The sample ids keyed by barcode
+
+    Returns
+    -------
+    dict of {bytes: (str, bytes, int)} or None
+        The barcode table, None if the file can't be read or is not a
+        complete table of the barcodes of `barcode_to_sample_id`
+    """
+    table = {}
+    try:
+        with open(fp, 'rb') as f:
+            n_barcodes = int(f.readline())
+            for line in f:
+                barcode, corrected, n_errors = line.rstrip(b'\n').split(b'\t')
+                table[barcode] = (barcode_to_sample_id[corrected], corrected,
+                                  int(n_errors))
+    except (EnvironmentError, ValueError, KeyError):
+        return None
+    if len(table) != n_barcodes:
+        return None
+    return table
+
+
+class DemuxStats(object):
+    """Counts of the reads of a lane, as reported by split_libraries_fastq.py
+
+    Attributes
+    ----------
+    input_sequence_count : int
+        The number of reads in the lane
+    barcode_not_in_map : int
+        The number of reads whose barcode is not in the mapping file
+    too_short : int
+        The number of reads that are too short after the quality truncation
+    too_many_n : int
+        The number of reads that have too many N characters
+    barcode_errors_exceed_max : int
+        The number of reads whose barcode has too many errors
+    sequence_lengths : collections.Counter
+        The number of written reads, keyed by their length
+    seqs_per_sample : collections.Counter
+        The number of written reads, keyed by sample id
+    """
+    def __init__(self, sample_ids):
+        self.input_sequence_count = 0
+        self.barcode_not_in_map = 0
+        self.too_short = 0
+        self.too_many_n = 0
+        self.barcode_errors_exceed_max = 0
+        self.sequence_lengths = Counter()
+        self.seqs_per_sample = Counter({sid: 0 for sid in sample_ids})
+
+    def median_length(self):
+        """Returns the median length of the written reads
+
+        Returns
+        -------
+        float
+            The median length, NaN if no read was written
+        """
+        total = sum(self.sequence_lengths.values())
+        if not total:
+            return float('nan')
+        lengths = sorted(self.sequence_lengths.items())
+        middle = [(total - 1) // 2, total // 2]
+        values = []
+        seen = 0
+        for length, count in lengths:
+            seen += count
+            while middle and middle[0] < seen:
+                values.append(length)
+                middle.pop(0)
+        return sum(values) / 2.
+
+    def format_log(self):
+        """Formats the counts as split_libraries_fastq.py does in its log
+
+        Returns
+        -------
+        str
+            The log lines
+        """
+        log = ["Quality filter results"]
+        log.extend('%s: %d' % (label, getattr(self, attr) if attr else 0)
+                   for label, attr in LOG_COUNTS)
+        log.extend(["",
+                    "Result summary (after quality filtering)",
+                    "Median sequence length: %1.2f" % self.median_length()])
+        counts = sorted(((c, s) for s, c in self.seqs_per_sample.items()),
+                        reverse=True)
+        log.extend('%s\t%d' % (s, c) for c, s in counts)
+        log.append('\nTotal number seqs written\t%d'
+                   % sum(self.sequence_lengths.values()))
+        return '\n'.join(log)
+
+
+def _file_md5(fp):
+    """Returns the hex md5 of a file
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+
+    Returns
+    -------
+    str
+        The md5 of the file
+    """
+    checksum = md5()
+    with open(fp, 'rb') as f:
+        for block in iter(partial(f.read, COPY_BUFFER_SIZE), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _format_log_header(read_fp, barcode_fp, mapping_fp):
+    """Formats the input file paths as split_libraries_fastq.py does in its log
+
+    Parameters
+    ----------
+    read_fp : str
+        The reads filepath
+    barcode_fp : str or None
+        The barcodes filepath
+    mapping_fp : str or None
+        The mapping filepath
+
+    Returns
+    -------
+    str
+        The log lines
+    """
+    header = "Input file paths\n"
+    if mapping_fp is not None:
+        header += ('Mapping filepath: %s (md5: %s)\n'
+                   % (mapping_fp, _file_md5(mapping_fp)))
+    header += ('Sequence read filepath: %s (md5: %s)\n'
+               % (read_fp, _file_md5(read_fp)))
+    if barcode_fp is not None:
+        header += ('Barcode read filepath: %s (md5: %s)\n'
+                   % (barcode_fp, _file_md5(barcode_fp)))
+    return header + '\n'
+
+
+def _barcodes_of(batch, barcode_length, rev_comp_barcode):
+    """Returns the barcodes of a batch of barcode reads
+
+    Parameters
+    ----------
+    batch : FastqBatch
+        The barcode reads
+    barcode_length : int or None
+        The number of bases of the barcode reads that are the barcode. If
+        None, the whole barcode reads are used
+    rev_comp_barcode : bool
+        Whether the barcodes should be reverse complemented
+
+    Returns
+    -------
+    list of bytes
+        The barcodes
+    """
+    barcodes, lengths = batch.matrix(1, width=barcode_length)
+    if not barcodes.shape[1]:
+        return [b''] * len(batch)
+    if rev_comp_barcode:
+        barcodes = _reverse_rows(_COMPLEMENT_ARRAY[barcodes], lengths)
+    return barcodes.view('S%d' % barcodes.shape[1]).ravel().tolist()
+
+
+def _headers_match(check_header_match, barcode_batch, read_batch):
+    """Checks that the headers of the reads and their barcodes match
+
+    Parameters
+    ----------
+    check_header_match : callable
+        Function checking that the headers of a read and its barcode match
+    barcode_batch, read_batch : FastqBatch
+        The barcode reads and the reads
+
+    Returns
+    -------
+    int or None
+        The index of the first record whose headers don't match, None if all
+        of them match
+
+    Notes
+    -----
+    The headers are first compared with NumPy, ignoring the read number.
+    Only the headers that differ are compared with `check_header_match`
+    """
+    mask = _READ_NUMBER_MASKS.get(check_header_match)
+    candidates = np.arange(len(read_batch))
+    if mask is not None:
+        width = max(barcode_batch.lengths(0).max(),
+                    read_batch.lengths(0).max())
+        bc_headers, bc_lengths = barcode_batch.matrix(0, width=width)
+        headers, lengths = read_batch.matrix(0, width=width)
+        same = ((bc_lengths == lengths) &
+                (mask(bc_headers, bc_lengths) ==
+                 mask(headers, lengths)).all(axis=1))
+        candidates = np.flatnonzero(~same)
+    for i in candidates:
+        if not check_header_match(barcode_batch.get(0, i),
+                                  read_batch.get(0, i)):
+            return i
+    return None
+
+
+def demultiplex_lane(reads, barcodes, barcode_table, parameters,
+                     start_seq_id, stats, check_header_match=None,
+                     offset=33):
+    """Demultiplexes and quality filters the reads of a lane
+
+    Parameters
+    ----------
+    reads : iterable of FastqBatch
+        The reads
+    barcodes : iterable of FastqBatch or None
+        The barcode reads, in batches of the same size as `reads`. If None,
+        all the reads get `PER_SAMPLE_BARCODE` as barcode
+    barcode_table : BarcodeTable
+        The table assigning the barcodes to their samples
+    parameters : dict
+        The split libraries parameters
+    start_seq_id : int
+        The index of the first written read
+    stats : DemuxStats
+        The counts of the lane, updated as the reads are processed
+    check_header_match : callable, optional
+        Function checking that the headers of a read and its barcode match.
+        If not provided, the headers are not checked
+    offset : int, optional
+        The PHRED offset of the qualities
+
+    Yields
+    ------
+    bytes, bytes, bytes
+        The header, sequence and quality (offset 33) of the written reads
+
+    Raises
+    ------
+    ValueError
+        If the headers of a read and its barcode don't match
+        If the reads and barcode files have a different number of records
+
+    Notes
+    -----
+    Only the barcodes and the headers of the written reads are copied out of
+    the batches; the quality filtering works on the batch buffers.
+    """
+    if barcodes is None:
+        batches = ((batch, None) for batch in reads)
+    else:
+        batches = zip_longest(reads, barcodes)
+    # As split_libraries_fastq.py does, if all the barcodes of the mapping
+    # file have the same length only that many bases of the barcode reads
+    # are used
+    barcode_length = barcode_table.barcode_length
+    max_barcode_errors = float(parameters['max_barcode_errors'])
+    min_fraction = float(parameters['min_per_read_length_fraction'])
+    sequence_max_n = int(parameters['sequence_max_n'])
+    max_bad_run_length = int(parameters['max_bad_run_length'])
+    phred_quality_threshold = int(parameters['phred_quality_threshold'])
+    rev_comp = parameters['rev_comp']
+    rev_comp_barcode = parameters['rev_comp_barcode']
+    to_ascii = (np.arange(256) - offset + 33).clip(0, 255).astype(np.uint8)
+
+    seq_id = start_seq_id
+    for read_batch, barcode_batch in batches:
+        if read_batch is None or (barcodes is not None and (
+                barcode_batch is None or
+                len(barcode_batch) != len(read_batch))):
+            raise ValueError("The reads and barcodes files have a "
+                             "different number of records")
+        stats.input_sequence_count += len(read_batch)
+
+        # Assign the reads to their samples
+        if barcode_batch is None:
+            bcs = [PER_SAMPLE_BARCODE] * len(read_batch)
+        else:
+            if check_header_match is not None:
+                i = _headers_match(check_header_match, barcode_batch,
+                                   read_batch)
+                if i is not None:
+                    raise ValueError(
+                        "Headers of barcode and read do not match: %s != %s"
+                        % (barcode_batch.get(0, i), read_batch.get(0, i)))
+            bcs = _barcodes_of(barcode_batch, barcode_length,
+                               rev_comp_barcode)
+        assignments = []
+        rows = []
+        for i, bc in enumerate(bcs):
+            sample_id, corrected, n_errors = barcode_table.assign(bc)
+            if n_errors > max_barcode_errors:
+                stats.barcode_errors_exceed_max += 1
+            elif sample_id is None:
+                stats.barcode_not_in_map += 1
+            else:
+                rows.append(i)
+                assignments.append((sample_id, bc, corrected, n_errors))
+        if not rows:
+            continue
+
+        # Quality filter the assigned reads
+        rows = np.array(rows)
+        seqs, lengths = read_batch.matrix(1, rows=rows)
+        quals, _ = read_batch.matrix(3, width=seqs.shape[1], rows=rows)
+        if rev_comp:
+            seqs = _reverse_rows(_COMPLEMENT_ARRAY[seqs], lengths)
+            quals = _reverse_rows(quals, lengths)
+        truncated = quality_truncation(
+            quals.astype(int) - offset, lengths, max_bad_run_length,
+            phred_quality_threshold)
+        too_short = truncated < min_fraction * lengths
+        too_many_n = ~too_short & (count_ns(seqs, truncated) >
+                                   sequence_max_n)
+        stats.too_short += int(too_short.sum())
+        stats.too_many_n += int(too_many_n.sum())
+        quals = to_ascii[quals]
+        for j in np.flatnonzero(~too_short & ~too_many_n):
+            sample_id, bc, corrected, n_errors = assignments[j]
+            length = int(truncated[j])
+            stats.seqs_per_sample[sample_id] += 1
+            stats.sequence_lengths[length] += 1
+            yield (b''.join([sample_id.encode('utf-8'), b'_',
+                             str(seq_id).encode('ascii'), b' ',
+                             read_batch.get(0, rows[j]), b' orig_bc=', bc,
+                             b' new_bc=', corrected, b' bc_diffs=',
+                             str(n_errors).encode('ascii')]),
+                   seqs[j, :length].tobytes(), quals[j, :length].tobytes())
+            seq_id += 1
+
+
+def _get_phred_offset(read_fp, phred_offset):
+    """Returns the PHRED offset and header check of a FASTQ file
+
+    Parameters
+    ----------
+    read_fp : str
+        The reads filepath
+    phred_offset : str
+        The PHRED offset parameter: 'auto', '33' or '64'
+
+    Returns
+    -------
+    int, callable
+        The PHRED offset
+        The function that checks that the headers of a read and its barcode
+        match
+    """
+    with _open_fastq(read_fp) as f:
+        header = f.readline()[1:].rstrip(b'\r\n')
+    if is_casava_v180_or_later(header):
+        offset, check = 33, check_header_match_180_or_later
+    else:
+        offset, check = 64, check_header_match_pre180
+    if phred_offset != 'auto':
+        offset = int(phred_offset)
+    return offset, check
+
+
+def demultiplex_fastq(lanes, out_dir, parameters, compress=False):
+    """Demultiplexes and quality filters FASTQ files in-process
+
+    Parameters
+    ----------
+    lanes : list of (str, str, str, str)
+        The reads filepath, barcodes filepath, mapping filepath and sample id
+        of each of the lanes. For per-sample FASTQ files the barcodes and
+        mapping filepaths are None, and the sample id is the sample of the
+        file. Otherwise, the sample id is None.
+    out_dir : str
+        The output directory
+    parameters : dict
+        The split libraries FASTQ parameters
+    compress : bool, optional
+        Whether seqs.fna and seqs.fastq are written gzipped, as seqs.fna.gz
+        and seqs.fastq.gz
+
+    Returns
+    -------
+    generator of (bytes, bytes, bytes)
+        The demultiplexed FASTQ records, as they are written to
+        `out_dir`/seqs.fastq
+
+    Raises
+    ------
+    ValueError
+        If there are barcodes and their type is not supported
+        If the barcodes are golay_12 and some of the barcodes of a mapping
+        file are not valid Golay codewords
+
+    Notes
+    -----
+    This is an in-process equivalent of split_libraries_fastq.py
+    --store_demultiplexed_fastq: seqs.fna, seqs.fastq and
+    split_library_log.txt are written to `out_dir` as the returned records
+    are consumed, with the same contents as the QIIME script. The quality
+    filtering is done on batches of reads with NumPy.
+    """
+    barcode_type = parameters['barcode_type']
+    barcoded = any(bc_fp is not None for _, bc_fp, _, _ in lanes)
+    if barcoded and not is_barcode_type_supported(barcode_type):
+        raise ValueError("Barcode type not supported by the in-process "
+                         "demultiplexing: %s" % barcode_type)
+
+    ext = '.gz' if compress else ''
+
+    def records():
+        seq_id = 0
+        with open_output(join(out_dir, 'seqs.fna' + ext)) as fna, \
+                open(join(out_dir, 'split_library_log.txt'), 'w') as log:
+            for read_fp, barcode_fp, mapping_fp, sample_id in lanes:
+                log.write(_format_log_header(read_fp, barcode_fp, mapping_fp))
+
+                offset, check = _get_phred_offset(
+                    read_fp, parameters['phred_offset'])
+                if sample_id is None:
+                    barcode_to_sample_id = get_barcode_to_sample_id(
+                        mapping_fp, parameters['rev_comp_mapping_barcodes'])
+                    barcode_table = get_barcode_table(
+                        barcode_to_sample_id, barcode_type,
+                        float(parameters['max_barcode_errors']))
+                else:
+                    # as split_libraries_fastq.py does, the reads of
+                    # per-sample FASTQ files get a fake barcode
+                    barcode_to_sample_id = {PER_SAMPLE_BARCODE: sample_id}
+                    barcode_table = BarcodeTable(barcode_to_sample_id, None, 0)
+                    check = None
+                stats = DemuxStats(barcode_to_sample_id.values())
+
+                barcodes = None
+                if barcode_fp is not None:
+                    barcodes = read_fastq_batches(barcode_fp,
+                                                  DEMUX_BATCH_SIZE)
+                for header, seq, qual in demultiplex_lane(
+                        read_fastq_batches(read_fp, DEMUX_BATCH_SIZE),
+                        barcodes, barcode_table, parameters, seq_id, stats,
+                        check, offset):
+                    fna.write(b''.join([b'>', header, b'\n', seq, b'\n']))
+                    seq_id += 1
+                    yield header, seq, qual
+
+                log.write(stats.format_log())
+                log.write('\n---\n\n')
+
+    return write_fastq(records(), join(out_dir, 'seqs.fastq' + ext))
+
+
+def _parse_log(fp):
+    """Parses the split_library_log.txt of a single input file
+
+    Parameters
+    ----------
+    fp : str
+        The log filepath
+
+    Returns
+    -------
+    str or None, DemuxStats
+        The mapping filepath of the log, and its quality filter and per-sample
+        counts. The sequence lengths are not in the log, so they are not set
+    """
+    with open(fp) as f:
+        lines = f.read().splitlines()
+    mapping_fp = None
+    for line in lines[:lines.index("Quality filter results")]:
+        if line.startswith("Mapping filepath: "):
+            mapping_fp = line[len("Mapping filepath: "):].rsplit(
+                ' (md5: ', 1)[0]
+
+    stats = DemuxStats([])
+    counts = dict(line.rsplit(': ', 1) for line in lines
+                  if line.startswith(tuple(label for label, _ in LOG_COUNTS)))
+    for label, attr in LOG_COUNTS:
+        if attr is not None:
+            setattr(stats, attr, int(counts[label]))
+    start = lines.index("Result summary (after quality filtering)") + 2
+    for line in lines[start:lines.index('', start)]:
+        sample_id, count = line.rsplit('\t', 1)
+        stats.seqs_per_sample[sample_id] += int(count)
+    return mapping_fp, stats
+
+
+def merge_split_library_logs(runs, out_fp):
+    """Merges the split_library_log.txt of several split_libraries_fastq.py
+
+    Parameters
+    ----------
+    runs : list of (str or None, str or None, list of str)
+        The reads filepath, the barcodes filepath and the split libraries
+        output directories of each of the input files, in order. The reads and
+        barcodes filepaths are only used for the input files that were split
+        in chunks, processed each in one of the output directories
+    out_fp : str
+        The merged log filepath
+
+    Notes
+    -----
+    split_libraries_fastq.py writes a log section for each of its input files,
+    so the sections of the files processed at once are copied as they are. The
+    counts of the chunks of a file are summed in a single section, with the
+    median sequence length of all the sequences they wrote, so the merged log
+    is the one of a single run over all the input files.
+    """
+    with open(out_fp, 'w') as out_f:
+        for read_fp, barcode_fp, in_dirs in runs:
+            if len(in_dirs) == 1:
+                with open(join(in_dirs[0], 'split_library_log.txt')) as f:
+                    out_f.write(f.read())
+                continue
+
+            stats = DemuxStats([])
+            for in_dir in in_dirs:
+                mapping_fp, counts = _parse_log(
+                    join(in_dir, 'split_library_log.txt'))
+                for _, attr in LOG_COUNTS:
+                    if attr is not None:
+                        setattr(stats, attr,
+                                getattr(stats, attr) + getattr(counts, attr))
+                stats.seqs_per_sample.update(counts.seqs_per_sample)
+                with open(join(in_dir, 'seqs.fna')) as f:
+                    stats.sequence_lengths.update(
+                        len(line.rstrip('\r\n')) for line in f
+                        if not line.startswith('>'))
+
+            out_f.write(_format_log_header(read_fp, barcode_fp, mapping_fp))
+            out_f.write(stats.format_log())
+            out_f.write('\n---\n\n')
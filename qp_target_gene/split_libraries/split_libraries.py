@@ -7,10 +7,12 @@
 # -----------------------------------------------------------------------------
 
 from os.path import join, basename, splitext
+from contextlib import closing
 
-from qp_target_gene.util import system_call
+from qp_target_gene.util import parallel_system_call
 from .util import (get_artifact_information, split_mapping_file,
-                   generate_demux_file, generate_artifact_info)
+                   generate_demux_file, generate_artifact_info, merge_files,
+                   parse_fastaqual, write_fastq)
 
 
 def generate_parameters_string(parameters):
@@ -207,70 +209,84 @@ def split_libraries(qclient, job_id, parameters, out_dir):
     elif seqs:
         seqs = sorted(seqs)
         quals = sorted(quals)
+        sff_cmds = []
     else:
-        cmds, seqs, quals = generate_process_sff_commands(sffs, out_dir)
-        len_cmds = len(cmds)
-        for i, cmd in enumerate(cmds):
-            qclient.update_job_step(
-                job_id,
-                "Step 2 of 4: preparing files (processing sff file %d of %d)"
-                % (i, len_cmds))
-            std_out, std_err, return_value = system_call(cmd)
-            if return_value != 0:
-                raise RuntimeError(
-                    "Error processing sff file:\nStd output: %s\n Std error:%s"
-                    % (std_out, std_err))
+        sff_cmds, seqs, quals = generate_process_sff_commands(sffs, out_dir)
 
     output_dir = join(out_dir, 'sl_out')
 
-    commands, sl_outs = generate_split_libraries_cmd(
+    sl_cmds, sl_outs = generate_split_libraries_cmd(
         seqs, quals, mapping_file, output_dir, parameters)
 
-    # Step 3 execute split libraries
+    # Step 3 process the sff files and execute split libraries. Each
+    # run_prefix is demultiplexed independently (the sequence ids don't
+    # overlap thanks to the -n offsets), so all the commands run at the same
+    # time and each split_libraries.py starts as soon as the sff files it
+    # needs are processed: all of them if there is a single split_libraries.py
+    # command, or the one at its same position otherwise
+    len_sffs = len(sff_cmds)
+    requires = {}
+    if sff_cmds:
+        for i in range(len(sl_cmds)):
+            requires[len_sffs + i] = (
+                range(len_sffs) if len(sl_cmds) == 1 else [i])
+    commands = sff_cmds + sl_cmds
     cmd_len = len(commands)
-    for i, cmd in enumerate(commands):
-        qclient.update_job_step(
-            job_id,
-            "Step 3 of 4: Executing demultiplexing and quality control "
-            "(%d of %d)" % (i, cmd_len))
-        std_out, std_err, return_value = system_call(cmd)
-        if return_value != 0:
-            raise RuntimeError(
-                "Error running split libraries:\nStd output: %s\nStd error:%s"
-                % (std_out, std_err))
+    qclient.update_job_step(
+        job_id,
+        "Step 3 of 4: Executing demultiplexing and quality control "
+        "(0 of %d done)" % cmd_len)
+    # Closing the results kills the commands still running if one fails
+    results = parallel_system_call(commands, requires=requires)
+    with closing(results):
+        for done, result in enumerate(results, 1):
+            i, std_out, std_err, return_value = result
+            if return_value != 0:
+                if i < len_sffs:
+                    raise RuntimeError(
+                        "Error processing sff file:\nStd output: %s\n "
+                        "Std error:%s" % (std_out, std_err))
+                raise RuntimeError(
+                    "Error running split libraries:\nStd output: %s\n"
+                    "Std error:%s" % (std_out, std_err))
+            qclient.update_job_step(
+                job_id,
+                "Step 3 of 4: Executing demultiplexing and quality control "
+                "(%d of %d done)" % (done, cmd_len))
 
     # Step 4 merging results
-    if cmd_len > 1:
+    if len(sl_cmds) > 1:
         qclient.update_job_step(
             job_id,
             "Step 4 of 4: Merging results (concatenating files)")
         to_cat = ['split_library_log.txt', 'seqs.fna']
         if quals:
             to_cat.append('seqs_filtered.qual')
-        for tc in to_cat:
-            files = [join(x, tc) for x in sl_outs]
-            cmd = "cat %s > %s" % (' '.join(files), join(output_dir, tc))
-            std_out, std_err, return_value = system_call(cmd)
-            if return_value != 0:
-                raise RuntimeError(
-                    "Error concatenating %s files:\nStd output: %s\n"
-                    "Std error:%s" % (tc, std_out, std_err))
+        try:
+            sizes = merge_files(sl_outs, output_dir, to_cat)
+        except EnvironmentError as e:
+            raise RuntimeError("Error concatenating files:\n%s" % str(e))
+        qclient.update_job_step(
+            job_id,
+            "Step 4 of 4: Merging results (concatenated %s)"
+            % ', '.join('%s: %d bytes' % (tc, sizes[tc]) for tc in to_cat))
     if quals:
+        # The fastq records are passed to the demux writer as they are
+        # written, so both files are generated in a single pass
         qclient.update_job_step(
             job_id,
-            "Step 4 of 4: Merging results (converting fastqual to fastq)")
-        cmd = ("convert_fastaqual_fastq.py -f %s -q %s -o %s -F"
-               % (join(output_dir, 'seqs.fna'),
-                  join(output_dir, 'seqs_filtered.qual'),
-                  output_dir))
-        std_out, std_err, return_value = system_call(cmd)
-        if return_value != 0:
-            raise RuntimeError(
-                "Error converting the fasta/qual files to fastq")
-    qclient.update_job_step(
-        job_id, "Step 4 of 4: Merging results (generating demux file)")
+            "Step 4 of 4: Merging results (converting fastqual to fastq and "
+            "generating demux file)")
+        records = write_fastq(
+            parse_fastaqual(join(output_dir, 'seqs.fna'),
+                            join(output_dir, 'seqs_filtered.qual')),
+            join(output_dir, 'seqs.fastq'))
+    else:
+        qclient.update_job_step(
+            job_id, "Step 4 of 4: Merging results (generating demux file)")
+        records = None
 
-    generate_demux_file(output_dir)
+    generate_demux_file(output_dir, records, parameters['demux_storage'])
 
     artifacts_info = generate_artifact_info(output_dir)
 
@@ -6,14 +6,25 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os.path import join, basename
+from os.path import join, basename, getsize, exists
+from os import makedirs
+from shutil import rmtree
+from multiprocessing.pool import ThreadPool
 import re
 
 import pandas as pd
 
-from qp_target_gene.util import system_call
+from qp_target_gene.util import (streaming_system_call, parallel_system_call,
+                                 get_num_jobs)
 from .util import (get_artifact_information, split_mapping_file,
-                   generate_demux_file, generate_artifact_info)
+                   generate_demux_file, generate_artifact_info,
+                   merge_demultiplexed_files, split_fastq_pair)
+from .demultiplexing import (demultiplex_fastq, is_barcode_type_supported,
+                             merge_split_library_logs)
+
+# Minimum size, in bytes, of the (compressed) forward reads file of a lane
+# for it to be demultiplexed in chunks
+FASTQ_CHUNK_MIN_SIZE = 256 * 1024 * 1024
 
 
 def generate_parameters_string(parameters):
@@ -81,30 +92,22 @@ def get_sample_names_by_run_prefix(mapping_file):
     return samples
 
 
-def generate_per_sample_fastq_command(forward_seqs, reverse_seqs, barcode_fps,
-                                      mapping_file, output_dir, params_str):
-    """Generates the per-sample FASTQ split_libraries_fastq.py command
+def get_per_sample_fastq_samples(forward_seqs, barcode_fps, mapping_file):
+    """Returns the sample of each of the per-sample FASTQ files
 
     Parameters
     ----------
     forward_seqs : list of str
         The list of forward seqs filepaths
-    reverse_seqs : list of str
-        The list of reverse seqs filepaths
     barcode_fps : list of str
         The list of barcode filepaths
     mapping_file : str
         The path to the mapping file
-    output_dir : str
-        The path to the split libraries output directory
-    params_str : str
-        The string containing the parameters to pass to
-        split_libraries_fastq.py
 
     Returns
     -------
-    str
-        The CLI to execute
+    list of str
+        The sample names, in the same order as `forward_seqs`
 
     Raises
     ------
@@ -117,6 +120,15 @@ def generate_per_sample_fastq_command(forward_seqs, reverse_seqs, barcode_fps,
         raise ValueError('per_sample_FASTQ can not have barcodes: %s'
                          % (', '.join(basename(b) for b in barcode_fps)))
     sn_by_rp = get_sample_names_by_run_prefix(mapping_file)
+    # The run prefixes of a file name are looked up by their length, so each
+    # file is matched with a few dictionary lookups instead of comparing it
+    # with all the run prefixes
+    prefix_lengths = sorted(set(len(rp) for rp in sn_by_rp))
+
+    def prefixes(name):
+        return [name[:length] for length in prefix_lengths
+                if length <= len(name) and name[:length] in sn_by_rp]
+
     samples = []
     errors = []
     for fname in forward_seqs:
@@ -127,12 +139,12 @@ def generate_per_sample_fastq_command(forward_seqs, reverse_seqs, barcode_fps,
             f = fn[:fn.lower().rindex('.fastq')]
         else:
             f = fn
-        m = [v for v in sn_by_rp if f.startswith(v)]
+        m = prefixes(f)
 
         # removing study_id, in case it's present
         if re.match("^[0-9]+\_.*", f):
             f = basename(fn).split('_', 1)[1]
-        mi = [v for v in sn_by_rp if f.startswith(v)]
+        mi = prefixes(f)
 
         # the matches is the largest between m/mi, if they are the same size
         # we are gonna use m
@@ -151,6 +163,44 @@ def generate_per_sample_fastq_command(forward_seqs, reverse_seqs, barcode_fps,
     if errors:
         raise ValueError('Errors found:\n%s' % '\n'.join(errors))
 
+    return samples
+
+
+def generate_per_sample_fastq_command(forward_seqs, reverse_seqs, barcode_fps,
+                                      mapping_file, output_dir, params_str):
+    """Generates the per-sample FASTQ split_libraries_fastq.py command
+
+    Parameters
+    ----------
+    forward_seqs : list of str
+        The list of forward seqs filepaths
+    reverse_seqs : list of str
+        The list of reverse seqs filepaths
+    barcode_fps : list of str
+        The list of barcode filepaths
+    mapping_file : str
+        The path to the mapping file
+    output_dir : str
+        The path to the split libraries output directory
+    params_str : str
+        The string containing the parameters to pass to
+        split_libraries_fastq.py
+
+    Returns
+    -------
+    str
+        The CLI to execute
+
+    Raises
+    ------
+    ValueError
+        - If barcode_fps is not an empty list
+        - If there are run prefixes in the mapping file that do not match
+        the sample names
+    """
+    samples = get_per_sample_fastq_samples(
+        forward_seqs, barcode_fps, mapping_file)
+
     cmd = str("split_libraries_fastq.py --store_demultiplexed_fastq "
               "-i %s --sample_ids %s -o %s %s"
               % (','.join(forward_seqs), ','.join(samples),
@@ -221,6 +271,238 @@ def generate_split_libraries_fastq_cmd(filepaths, mapping_file, atype,
     return cmd, output_dir
 
 
+def get_num_chunks(forward_seqs, num_jobs):
+    """Returns the number of chunks each lane should be split into
+
+    Parameters
+    ----------
+    forward_seqs : list of str
+        The forward reads filepaths, one per lane
+    num_jobs : int
+        The number of commands that can run at the same time
+
+    Returns
+    -------
+    int
+        The number of chunks, so there is a command for each of the jobs but
+        no chunk is (approximately) smaller than `FASTQ_CHUNK_MIN_SIZE`
+    """
+    if not forward_seqs:
+        return 1
+    num_chunks = -(-num_jobs // len(forward_seqs))
+    min_size = min(getsize(fp) for fp in forward_seqs)
+    return max(1, min(num_chunks, min_size // FASTQ_CHUNK_MIN_SIZE))
+
+
+def generate_lane_split_libraries_fastq_cmds(filepaths, mapping_file, atype,
+                                             out_dir, parameters,
+                                             num_chunks=1):
+    """Generates one split_libraries_fastq.py command per lane, chunk or sample
+
+    Parameters
+    ----------
+    filepaths : dict of {str: list of str}
+        The artifact filepaths keyed by type
+    mapping_file : str
+        The artifact QIIME-compliant mapping file
+    atype : str
+        The artifact type
+    out_dir : str
+        The job output directory
+    num_chunks : int, optional
+        The number of chunks each lane is split into. Ignored for per-sample
+        FASTQ artifacts
+
+    Returns
+    -------
+    list of str, list of str, str
+        The CLIs to execute
+        The output directory of each of the CLIs
+        The output directory of the merged results
+
+    Raises
+    ------
+    ValueError
+        If the number of barcode files and the number of sequence files do not
+        match
+        If the per-sample FASTQ files can't be matched to the samples
+
+    Notes
+    -----
+    Each of the files of a per-sample FASTQ artifact holds a single sample, so
+    each of them is processed on its own. The lanes can only be processed
+    independently if each of them has its own mapping file or all of them
+    share the same one. Otherwise, or if there is a single lane (or sample)
+    that is not split, a single command (the one returned by
+    `generate_split_libraries_fastq_cmd`) is generated. The chunks are
+    written to `out_dir`/chunks, so the lanes are split when this function
+    is called
+    """
+    forward_seqs = sorted(filepaths.get('raw_forward_seqs', []))
+    barcode_fps = sorted(filepaths.get('raw_barcodes', []))
+
+    if atype == "per_sample_FASTQ" and len(forward_seqs) > 1:
+        samples = get_per_sample_fastq_samples(
+            forward_seqs, barcode_fps, mapping_file)
+        output_dir = join(out_dir, "sl_out")
+        params_str = generate_parameters_string(parameters)
+        cmds = []
+        sample_dirs = []
+        for i, (fwd, sample) in enumerate(zip(forward_seqs, samples), 1):
+            sample_dir = join(output_dir, 'sample_%d' % i)
+            sample_dirs.append(sample_dir)
+            cmds.append(str(
+                "split_libraries_fastq.py --store_demultiplexed_fastq "
+                "-i %s --sample_ids %s -o %s %s"
+                % (fwd, sample, sample_dir, params_str)))
+        return cmds, sample_dirs, output_dir
+
+    if atype != "per_sample_FASTQ" and len(forward_seqs) * num_chunks > 1:
+        if len(barcode_fps) != len(forward_seqs):
+            raise ValueError("The number of barcode files and the number of "
+                             "sequence files should match: %d != %s"
+                             % (len(barcode_fps), len(forward_seqs)))
+
+        map_out_dir = join(out_dir, 'mappings')
+        mapping_files = sorted(split_mapping_file(mapping_file, map_out_dir))
+        if len(mapping_files) == 1:
+            mapping_files = mapping_files * len(forward_seqs)
+
+        if len(mapping_files) == len(forward_seqs):
+            output_dir = join(out_dir, "sl_out")
+            params_str = generate_parameters_string(parameters)
+
+            def split_lane(args):
+                i, fwd, bcd = args
+                if num_chunks == 1:
+                    return [(fwd, bcd)]
+                return split_fastq_pair(
+                    fwd, bcd, join(out_dir, 'chunks', 'lane_%d' % i),
+                    num_chunks)
+
+            pool = ThreadPool(len(forward_seqs))
+            try:
+                lane_chunks = pool.map(split_lane, zip(
+                    range(1, len(forward_seqs) + 1), forward_seqs,
+                    barcode_fps))
+            finally:
+                pool.close()
+                pool.join()
+
+            cmds = []
+            lane_dirs = []
+            for i, (chunks, mapping) in enumerate(
+                    zip(lane_chunks, mapping_files), 1):
+                for j, (fwd, bcd) in enumerate(chunks, 1):
+                    lane_dir = join(output_dir, 'lane_%d' % i)
+                    if len(chunks) > 1:
+                        lane_dir = '%s_chunk_%d' % (lane_dir, j)
+                    lane_dirs.append(lane_dir)
+                    cmds.append(str(
+                        "split_libraries_fastq.py --store_demultiplexed_fastq "
+                        "-i %s -b %s -m %s -o %s %s"
+                        % (fwd, bcd, mapping, lane_dir, params_str)))
+            return cmds, lane_dirs, output_dir
+
+    cmd, output_dir = generate_split_libraries_fastq_cmd(
+        filepaths, mapping_file, atype, out_dir, parameters)
+    return [cmd], [output_dir], output_dir
+
+
+def get_split_libraries_runs(filepaths, sl_outs):
+    """Groups the outputs of the commands by input file
+
+    Parameters
+    ----------
+    filepaths : dict of {str: list of str}
+        The input filepaths, keyed by filepath type
+    sl_outs : list of str
+        The output directories of the commands generated by
+        `generate_lane_split_libraries_fastq_cmds`
+
+    Returns
+    -------
+    list of (str or None, str or None, list of str)
+        The forward and barcode filepaths of each of the lanes split in
+        chunks, and the output directories of the commands that processed
+        each input file. The filepaths of the files that were not split are
+        None, as in `demultiplexing.merge_split_library_logs`
+    """
+    forward_seqs = sorted(filepaths.get('raw_forward_seqs', []))
+    barcode_fps = sorted(filepaths.get('raw_barcodes', []))
+    runs = []
+    for sl_out in sl_outs:
+        match = re.match(r'lane_(\d+)_chunk_(\d+)$', basename(sl_out))
+        if match is None:
+            runs.append((None, None, [sl_out]))
+        elif match.group(2) == '1':
+            lane = int(match.group(1)) - 1
+            runs.append((forward_seqs[lane], barcode_fps[lane], [sl_out]))
+        else:
+            runs[-1][2].append(sl_out)
+    return runs
+
+
+def generate_demultiplexing_lanes(filepaths, mapping_file, atype, out_dir):
+    """Generates the lanes to demultiplex in-process
+
+    Parameters
+    ----------
+    filepaths : dict of {str: list of str}
+        The artifact filepaths keyed by type
+    mapping_file : str
+        The artifact QIIME-compliant mapping file
+    atype : str
+        The artifact type
+    out_dir : str
+        The job output directory
+
+    Returns
+    -------
+    list of (str, str, str, str), str
+        The reads filepath, barcodes filepath, mapping filepath and sample id
+        of each lane, as expected by `demultiplex_fastq`
+        The output directory, which is created if it doesn't exist
+
+    Raises
+    ------
+    ValueError
+        If the number of barcode files and the number of sequence files do not
+        match
+        If the number of mapping files and the number of sequence files do not
+        match
+        If the per-sample FASTQ files can't be matched to the samples
+    """
+    forward_seqs = sorted(filepaths.get('raw_forward_seqs', []))
+    barcode_fps = sorted(filepaths.get('raw_barcodes', []))
+
+    if atype == "per_sample_FASTQ":
+        samples = get_per_sample_fastq_samples(
+            forward_seqs, barcode_fps, mapping_file)
+        lanes = [(fwd, None, None, sample)
+                 for fwd, sample in zip(forward_seqs, samples)]
+    else:
+        if len(barcode_fps) != len(forward_seqs):
+            raise ValueError("The number of barcode files and the number of "
+                             "sequence files should match: %d != %s"
+                             % (len(barcode_fps), len(forward_seqs)))
+        map_out_dir = join(out_dir, 'mappings')
+        mapping_files = sorted(split_mapping_file(mapping_file, map_out_dir))
+        if len(mapping_files) == 1:
+            mapping_files = mapping_files * len(forward_seqs)
+        if len(mapping_files) != len(forward_seqs):
+            raise ValueError("The number of run prefixes and the number of "
+                             "sequence files should match: %d != %d"
+                             % (len(mapping_files), len(forward_seqs)))
+        lanes = [(fwd, bcd, mapping, None) for fwd, bcd, mapping
+                 in zip(forward_seqs, barcode_fps, mapping_files)]
+
+    output_dir = join(out_dir, "sl_out")
+    if not exists(output_dir):
+        makedirs(output_dir)
+    return lanes, output_dir
+
+
 def split_libraries_fastq(qclient, job_id, parameters, out_dir):
     """Run split libraries fastq with the given parameters
 
@@ -246,24 +528,94 @@ def split_libraries_fastq(qclient, job_id, parameters, out_dir):
     filepaths, mapping_file, atype = get_artifact_information(
         qclient, artifact_id)
 
-    # Step 2 generate the split libraries fastq command
+    if parameters['demux_engine'] == 'native' and (
+            atype == "per_sample_FASTQ" or
+            is_barcode_type_supported(parameters['barcode_type'])):
+        # The reads are demultiplexed in-process, in a single pass that also
+        # writes the demux file. Other barcode types are still demultiplexed
+        # by split_libraries_fastq.py
+        qclient.update_job_step(job_id, "Step 2 of 3: Preparing files")
+        lanes, sl_out = generate_demultiplexing_lanes(
+            filepaths, mapping_file, atype, out_dir)
+        qclient.update_job_step(
+            job_id, "Step 3 of 3: Executing demultiplexing and quality "
+                    "control and generating demux file")
+        records = demultiplex_fastq(lanes, sl_out, parameters,
+                                    parameters['compress_outputs'])
+        generate_demux_file(sl_out, records, parameters['demux_storage'])
+        return True, generate_artifact_info(
+            sl_out, parameters['compress_outputs']), ""
+
+    # Step 2 generate the split libraries fastq commands. If more than one
+    # command can run at the same time, each lane (or sample, for per-sample
+    # FASTQ) is demultiplexed on its own and, if there are less lanes than
+    # jobs, large lanes are split in chunks. This is only done if
+    # QP_TARGET_GENE_NUM_JOBS is set
     qclient.update_job_step(job_id, "Step 2 of 4: Generating command")
-    command, sl_out = generate_split_libraries_fastq_cmd(
-        filepaths, mapping_file, atype, out_dir, parameters)
-
-    # Step 3 execute split libraries
-    qclient.update_job_step(
-        job_id, "Step 3 of 4: Executing demultiplexing and quality control")
-    std_out, std_err, return_value = system_call(command)
-    if return_value != 0:
-        raise RuntimeError(
-            "Error processing files:\nStd output: %s\n Std error:%s"
-            % (std_out, std_err))
-
-    # Step 4 generate the demux file
-    qclient.update_job_step(job_id, "Step 4 of 4: Generating demux file")
-    generate_demux_file(sl_out)
-
-    artifacts_info = generate_artifact_info(sl_out)
+    num_jobs = get_num_jobs(default=1)
+    if num_jobs > 1:
+        num_chunks = 1
+        if atype != "per_sample_FASTQ":
+            num_chunks = get_num_chunks(
+                filepaths.get('raw_forward_seqs', []), num_jobs)
+        commands, sl_outs, sl_out = generate_lane_split_libraries_fastq_cmds(
+            filepaths, mapping_file, atype, out_dir, parameters, num_chunks)
+    else:
+        command, sl_out = generate_split_libraries_fastq_cmd(
+            filepaths, mapping_file, atype, out_dir, parameters)
+        commands, sl_outs = [command], [sl_out]
+
+    # Step 3 execute split libraries. The output of a single command is
+    # written to disk and its last lines are forwarded to the job step
+    step = "Step 3 of 4: Executing demultiplexing and quality control"
+    qclient.update_job_step(job_id, step)
+    if len(commands) == 1:
+        std_out, std_err, return_value = streaming_system_call(
+            commands[0], log_prefix=join(out_dir, 'split_libraries_fastq'),
+            progress_callback=lambda line: qclient.update_job_step(
+                job_id, "%s (%s)" % (step, line)))
+        results = [(0, std_out, std_err, return_value)]
+    else:
+        results = parallel_system_call(commands)
+    try:
+        for done, result in enumerate(results, 1):
+            i, std_out, std_err, return_value = result
+            if return_value != 0:
+                raise RuntimeError(
+                    "Error processing files:\nStd output: %s\n Std error:%s"
+                    % (std_out, std_err))
+            if len(commands) > 1:
+                qclient.update_job_step(
+                    job_id, "%s (%d of %d done)"
+                    % (step, done, len(commands)))
+    finally:
+        # Kills the commands still running if one of them failed, and removes
+        # the uncompressed chunks of the lanes even if the job fails
+        if len(commands) > 1:
+            results.close()
+        rmtree(join(out_dir, 'chunks'), ignore_errors=True)
+
+    # Step 4 generate the demux file, merging the results of each command while
+    # it is written
+    records = None
+    if len(commands) > 1:
+        qclient.update_job_step(
+            job_id, "Step 4 of 4: Merging results and generating demux file")
+        records = merge_demultiplexed_files(sl_outs, sl_out)
+        runs = get_split_libraries_runs(filepaths, sl_outs)
+        if len(runs) < len(sl_outs):
+            merge_split_library_logs(
+                runs, join(sl_out, 'split_library_log.txt'))
+    else:
+        qclient.update_job_step(job_id, "Step 4 of 4: Generating demux file")
+    generate_demux_file(sl_out, records, parameters['demux_storage'])
+    # The outputs of each lane, chunk or sample are merged in sl_out, so they
+    # are not kept twice in the artifact directory
+    if len(commands) > 1:
+        for d in sl_outs:
+            rmtree(d, ignore_errors=True)
+
+    artifacts_info = generate_artifact_info(
+        sl_out, parameters['compress_outputs'])
 
     return True, artifacts_info, ""
@@ -0,0 +1,546 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join, exists, basename
+from shutil import rmtree
+from tempfile import mkdtemp
+from gzip import GzipFile
+from os import listdir, mkdir
+
+import numpy as np
+import numpy.testing as npt
+
+from qp_target_gene.split_libraries import demultiplexing
+from qp_target_gene.split_libraries.demultiplexing import (
+    reverse_complement, decode_golay_12, golay_12_variants,
+    is_barcode_type_supported, BarcodeTable, get_barcode_table,
+    is_casava_v180_or_later, check_header_match_pre180,
+    check_header_match_180_or_later, quality_truncation, count_ns,
+    get_barcode_to_sample_id, DemuxStats, demultiplex_fastq,
+    merge_split_library_logs)
+from qp_target_gene.split_libraries.util import split_fastq_pair
+
+
+class DemultiplexingTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.parameters = {
+            "max_bad_run_length": 3, "min_per_read_length_fraction": 0.75,
+            "sequence_max_n": 0, "rev_comp_barcode": False,
+            "rev_comp_mapping_barcodes": False, "rev_comp": False,
+            "phred_quality_threshold": 3, "barcode_type": "golay_12",
+            "max_barcode_errors": 1.5, "input_data": 1, "phred_offset": "auto"}
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def _write(self, fname, contents, gz=False):
+        fp = join(self.out_dir, fname)
+        if gz:
+            with GzipFile(fp, mode='w') as f:
+                f.write(contents.encode('ascii'))
+        else:
+            with open(fp, 'w') as f:
+                f.write(contents)
+        return fp
+
+    def _read(self, fname):
+        with open(join(self.out_dir, fname)) as f:
+            return f.read()
+
+    def test_reverse_complement(self):
+        self.assertEqual(reverse_complement(b'AACGTN'), b'NACGTT')
+        self.assertEqual(reverse_complement(b''), b'')
+
+    def test_decode_golay_12(self):
+        # codewords are not modified
+        self.assertEqual(decode_golay_12(b'TAGTCAGGCCAT'),
+                         (b'TAGTCAGGCCAT', 0))
+        self.assertEqual(decode_golay_12(b'GAGAGCTCTACG'),
+                         (b'GAGAGCTCTACG', 0))
+        # the errors are counted in bits: T -> A is one bit, A -> C two
+        self.assertEqual(decode_golay_12(b'TAGACAGGCCAT'),
+                         (b'TAGTCAGGCCAT', 1))
+        self.assertEqual(decode_golay_12(b'GAGCGCTCTACG'),
+                         (b'GAGAGCTCTACG', 2))
+        self.assertEqual(decode_golay_12(b'TAGTCAGGCCCC'),
+                         (b'TAGTCAGGCCAT', 3))
+        # more than 3 errors can't be corrected
+        self.assertEqual(decode_golay_12(b'TCGTCCGGCCAT'), (None, 4))
+
+    def test_decode_golay_12_error(self):
+        with self.assertRaises(ValueError):
+            decode_golay_12(b'TAGTCAGGCCA')
+        with self.assertRaises(ValueError):
+            decode_golay_12(b'TAGTCAGGCCAN')
+
+    def test_golay_12_variants(self):
+        self.assertEqual(golay_12_variants(b'TAGTCAGGCCAT', 0), [])
+        obs = golay_12_variants(b'TAGTCAGGCCAT', 5)
+        self.assertEqual([(len(v), n) for v, n in obs],
+                         [(24, 1), (276, 2), (2024, 3)])
+        for variants, n_errors in obs:
+            for variant in variants:
+                self.assertEqual(decode_golay_12(variant),
+                                 (b'TAGTCAGGCCAT', n_errors))
+        self.assertIn(b'TAGACAGGCCAT', obs[0][0])
+
+    def test_barcode_table(self):
+        barcode_to_sample_id = {b'TAGTCAGGCCAT': '1.s1',
+                                b'GAGAGCTCTACG': '1.s2'}
+        obs = BarcodeTable(barcode_to_sample_id, 'golay_12', 1.5)
+        self.assertEqual(obs.barcode_length, 12)
+        self.assertEqual(len(obs.table), 50)
+        self.assertEqual(obs.assign(b'TAGTCAGGCCAT'),
+                         ('1.s1', b'TAGTCAGGCCAT', 0))
+        self.assertEqual(obs.assign(b'TAGACAGGCCAT'),
+                         ('1.s1', b'TAGTCAGGCCAT', 1))
+        # the barcodes that are not in the table are corrected as
+        # split_libraries_fastq.py does
+        self.assertEqual(obs.assign(b'GAGCGCTCTACG'),
+                         ('1.s2', b'GAGAGCTCTACG', 2))
+        self.assertEqual(obs.assign(b'AAAAAAAAAAAA'),
+                         (None, b'AAAAAAAAAAAA', 0))
+        self.assertEqual(obs.assign(b'TCGTCCGGCCAT'), (None, None, 4))
+        self.assertEqual(obs.assign(b'TAGTCAGGCCAN'),
+                         (None, b'TAGTCAGGCCAN', 0))
+
+    def test_barcode_table_not_corrected(self):
+        barcode_to_sample_id = {b'AACCATGC': '1.s1', b'TCGTAGCAA': '1.s2'}
+        obs = BarcodeTable(barcode_to_sample_id, 'hamming_8', 1.5)
+        self.assertIsNone(obs.barcode_length)
+        self.assertEqual(len(obs.table), 2)
+        self.assertEqual(obs.assign(b'AACCATGC'), ('1.s1', b'AACCATGC', 0))
+        self.assertEqual(obs.assign(b'AACCATGA'), (None, b'AACCATGA', 0))
+
+    def test_barcode_table_error(self):
+        with self.assertRaises(ValueError):
+            BarcodeTable({b'TAGTCAGGCCAA': '1.s1'}, 'golay_12', 1.5)
+        with self.assertRaises(ValueError):
+            BarcodeTable({b'TAGTCAGGCCA': '1.s1'}, 'golay_12', 1.5)
+
+    def test_get_barcode_table(self):
+        barcode_to_sample_id = {b'TAGTCAGGCCAT': '1.s1',
+                                b'GAGAGCTCTACG': '1.s2'}
+        obs = get_barcode_table(barcode_to_sample_id, 'golay_12', 1.5,
+                                cache_dir=self.out_dir)
+        table_dir = join(self.out_dir, 'barcode_tables')
+        fnames = listdir(table_dir)
+        self.assertEqual(len(fnames), 1)
+        self.assertTrue(fnames[0].endswith('.tsv'))
+        table_fp = join(table_dir, fnames[0])
+        with open(table_fp, 'rb') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], b'%d' % len(obs.table))
+        self.assertIn(b'TAGTCAGGCCAA\tTAGTCAGGCCAT\t1', lines)
+
+        # the stored table is used by the following calls
+        with open(table_fp, 'wb') as f:
+            f.write(b'1\nTAGTCAGGCCAT\tTAGTCAGGCCAT\t0\n')
+        obs = get_barcode_table(barcode_to_sample_id, 'golay_12', 1.5,
+                                cache_dir=self.out_dir)
+        self.assertEqual(obs.table,
+                         {b'TAGTCAGGCCAT': ('1.s1', b'TAGTCAGGCCAT', 0)})
+
+        # and it's not used by other mapping files or parameters
+        obs = get_barcode_table(barcode_to_sample_id, 'golay_12', 0.5,
+                                cache_dir=self.out_dir)
+        self.assertEqual(len(obs.table), 2)
+        self.assertEqual(len(listdir(table_dir)), 2)
+
+    def test_get_barcode_table_corrupt(self):
+        barcode_to_sample_id = {b'TAGTCAGGCCAT': '1.s1',
+                                b'GAGAGCTCTACG': '1.s2'}
+        exp = get_barcode_table(barcode_to_sample_id, 'golay_12', 1.5,
+                                cache_dir=self.out_dir).table
+        table_dir = join(self.out_dir, 'barcode_tables')
+        table_fp = join(table_dir, listdir(table_dir)[0])
+        with open(table_fp, 'rb') as f:
+            data = f.read()
+
+        # truncated or corrupt tables are built again
+        for corrupt in [data[:len(data) // 2], data[:-5], b'',
+                        b'1\nTAGTCAGGCCAT\tAAAAAAAAAAAA\t0\n',
+                        b'\x80\x02}q\x00.']:
+            with open(table_fp, 'wb') as f:
+                f.write(corrupt)
+            obs = get_barcode_table(barcode_to_sample_id, 'golay_12', 1.5,
+                                    cache_dir=self.out_dir)
+            self.assertEqual(obs.table, exp)
+            with open(table_fp, 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(listdir(table_dir), [basename(table_fp)])
+
+    def test_get_barcode_table_write_error(self):
+        def write_error(f, table):
+            f.write(b'2\n')
+            raise IOError("No space left on device")
+
+        write_barcode_table = demultiplexing._write_barcode_table
+        demultiplexing._write_barcode_table = write_error
+        try:
+            with self.assertRaises(IOError):
+                get_barcode_table({b'TAGTCAGGCCAT': '1.s1'}, 'golay_12', 1.5,
+                                  cache_dir=self.out_dir)
+        finally:
+            demultiplexing._write_barcode_table = write_barcode_table
+        # the partial table is removed
+        self.assertEqual(listdir(join(self.out_dir, 'barcode_tables')), [])
+
+    def test_is_barcode_type_supported(self):
+        self.assertTrue(is_barcode_type_supported('golay_12'))
+        self.assertTrue(is_barcode_type_supported('8'))
+        self.assertTrue(is_barcode_type_supported('hamming_8'))
+        self.assertFalse(is_barcode_type_supported('golay_24'))
+        self.assertFalse(is_barcode_type_supported('not-barcoded'))
+
+    def test_is_casava_v180_or_later(self):
+        self.assertTrue(is_casava_v180_or_later(
+            b'M00176:18:000000000-A0DK4:1:1:15579:1518 1:N:0:0'))
+        self.assertFalse(is_casava_v180_or_later(
+            b'HWI-ST753_50:6:1101:15435:9071#0/1'))
+
+    def test_check_header_match(self):
+        self.assertTrue(check_header_match_180_or_later(
+            b'M00176:18:000000000-A0DK4:1:1:15579:1518 1:N:0:0',
+            b'M00176:18:000000000-A0DK4:1:1:15579:1518 2:N:0:0'))
+        self.assertFalse(check_header_match_180_or_later(
+            b'M00176:18:000000000-A0DK4:1:1:15579:1518 1:N:0:0',
+            b'M00176:18:000000000-A0DK4:1:1:15579:1519 2:N:0:0'))
+        self.assertTrue(check_header_match_pre180(
+            b'HWI-ST753_50:6:1101:15435:9071#0/1',
+            b'HWI-ST753_50:6:1101:15435:9071#0/2'))
+        self.assertFalse(check_header_match_pre180(
+            b'HWI-ST753_50:6:1101:15435:9071#0/1',
+            b'HWI-ST753_50:6:1101:15435:9072#0/2'))
+
+    def test_quality_truncation(self):
+        quals = np.array([[40, 40, 40, 40, 40, 40, 40, 40],
+                          [40, 2, 40, 2, 2, 2, 40, 40],
+                          [40, 40, 2, 2, 2, 2, 40, 40],
+                          [2, 2, 2, 2, 40, 40, 40, 40],
+                          [40, 40, 40, 40, 2, 2, 2, 0]])
+        lengths = np.array([8, 8, 8, 8, 7])
+        obs = quality_truncation(quals, lengths, 3, 3)
+        npt.assert_equal(obs, [8, 8, 2, 0, 7])
+        obs = quality_truncation(quals, lengths, 0, 3)
+        npt.assert_equal(obs, [8, 1, 2, 0, 4])
+
+    def test_count_ns(self):
+        seqs = np.array([bytearray(b'ACGTN'), bytearray(b'NNGTN'),
+                         bytearray(b'ACGTA')], dtype=np.uint8)
+        npt.assert_equal(count_ns(seqs, np.array([5, 5, 5])), [1, 3, 0])
+        npt.assert_equal(count_ns(seqs, np.array([4, 2, 5])), [0, 2, 0])
+
+    def test_get_barcode_to_sample_id(self):
+        mapping_fp = self._write('mapping.txt', MAPPING_FILE)
+        self.assertEqual(get_barcode_to_sample_id(mapping_fp),
+                         {b'TAGTCAGGCCAT': '1.s1', b'GAGAGCTCTACG': '1.s2'})
+        self.assertEqual(get_barcode_to_sample_id(mapping_fp, True),
+                         {b'ATGGCCTGACTA': '1.s1', b'CGTAGAGCTCTC': '1.s2'})
+
+    def test_demux_stats(self):
+        stats = DemuxStats(['s1', 's2', 's3'])
+        self.assertTrue(np.isnan(stats.median_length()))
+        stats.input_sequence_count = 10
+        stats.too_short = 2
+        stats.sequence_lengths.update([100, 150, 150, 120])
+        stats.seqs_per_sample.update(['s1', 's1', 's3', 's1'])
+        self.assertEqual(stats.median_length(), 135)
+        exp = ("Quality filter results\n"
+               "Total number of input sequences: 10\n"
+               "Barcode not in mapping file: 0\n"
+               "Read too short after quality truncation: 2\n"
+               "Count of N characters exceeds limit: 0\n"
+               "Illumina quality digit = 0: 0\n"
+               "Barcode errors exceed max: 0\n"
+               "\n"
+               "Result summary (after quality filtering)\n"
+               "Median sequence length: 135.00\n"
+               "s1\t3\n"
+               "s3\t1\n"
+               "s2\t0\n"
+               "\n"
+               "Total number seqs written\t4")
+        self.assertEqual(stats.format_log(), exp)
+
+    def test_demultiplex_fastq(self):
+        reads_fp = self._write('reads.fastq.gz', READS, gz=True)
+        barcodes_fp = self._write('barcodes.fastq', BARCODES)
+        mapping_fp = self._write('mapping.txt', MAPPING_FILE)
+        records = demultiplex_fastq(
+            [(reads_fp, barcodes_fp, mapping_fp, None)], self.out_dir,
+            self.parameters)
+        obs = list(records)
+        self.assertEqual(len(obs), 4)
+        self.assertEqual(self._read('seqs.fna'), EXP_FNA)
+        self.assertEqual(self._read('seqs.fastq'), EXP_FASTQ)
+        log = self._read('split_library_log.txt')
+        self.assertTrue(log.startswith(
+            "Input file paths\nMapping filepath: %s (md5: " % mapping_fp))
+        self.assertTrue(log.endswith(EXP_LOG))
+
+    def test_demultiplex_fastq_compress(self):
+        reads_fp = self._write('reads.fastq', READS)
+        barcodes_fp = self._write('barcodes.fastq', BARCODES)
+        mapping_fp = self._write('mapping.txt', MAPPING_FILE)
+        for _ in demultiplex_fastq(
+                [(reads_fp, barcodes_fp, mapping_fp, None)], self.out_dir,
+                self.parameters, compress=True):
+            pass
+        self.assertFalse(exists(join(self.out_dir, 'seqs.fna')))
+        with GzipFile(join(self.out_dir, 'seqs.fna.gz')) as f:
+            self.assertEqual(f.read().decode('ascii'), EXP_FNA)
+        with GzipFile(join(self.out_dir, 'seqs.fastq.gz')) as f:
+            self.assertEqual(f.read().decode('ascii'), EXP_FASTQ)
+
+    def test_demultiplex_fastq_long_barcodes(self):
+        # only the first bases of the barcode reads are used, as many as the
+        # length of the mapping file barcodes
+        reads_fp = self._write('reads.fastq', READS)
+        barcodes_fp = self._write(
+            'barcodes.fastq', BARCODES.replace('\n+\n', 'A\n+\nI'))
+        mapping_fp = self._write('mapping.txt', MAPPING_FILE)
+        for _ in demultiplex_fastq(
+                [(reads_fp, barcodes_fp, mapping_fp, None)], self.out_dir,
+                self.parameters):
+            pass
+        self.assertEqual(self._read('seqs.fna'), EXP_FNA)
+
+    def test_demultiplex_fastq_rev_comp(self):
+        reads_fp = self._write('reads.fastq', READS)
+        barcodes_fp = self._write('barcodes.fastq', BARCODES)
+        mapping_fp = self._write('mapping.txt', MAPPING_FILE)
+        self.parameters['rev_comp'] = True
+        for _ in demultiplex_fastq(
+                [(reads_fp, barcodes_fp, mapping_fp, None)], self.out_dir,
+                self.parameters):
+            pass
+        fna = self._read('seqs.fna').splitlines()
+        # the quality truncation is applied to the reverse complement, so
+        # the third read is too short
+        self.assertEqual(fna[1], 'GTACGTACGT')
+        self.assertEqual(fna[5], 'GTACGTACGT')
+        self.assertEqual(len(fna), 6)
+
+    def test_demultiplex_fastq_per_sample(self):
+        s1_fp = self._write('s1.fastq', READS)
+        s2_fp = self._write('s2.fastq', READS)
+        for _ in demultiplex_fastq(
+                [(s1_fp, None, None, '1.s1'), (s2_fp, None, None, '1.s2')],
+                self.out_dir, self.parameters):
+            pass
+        headers = self._read('seqs.fna').splitlines()[::2]
+        self.assertEqual(len(headers), 12)
+        self.assertEqual(
+            headers[0], '>1.s1_0 M00176:18:000000000-A0DK4:1:1:1:1 1:N:0:0 '
+                        'orig_bc=AAAAAAAAAAAA new_bc=AAAAAAAAAAAA bc_diffs=0')
+        # the sequence ids keep increasing across the files
+        self.assertEqual([h.split(' ')[0] for h in headers[5:7]],
+                         ['>1.s1_5', '>1.s2_6'])
+        log = self._read('split_library_log.txt')
+        self.assertNotIn('Mapping filepath', log)
+        self.assertNotIn('Barcode read filepath', log)
+        self.assertEqual(log.count('\n---\n\n'), 2)
+
+    def test_merge_split_library_logs(self):
+        # The log of a lane demultiplexed in chunks is merged into the log of
+        # the lane demultiplexed at once
+        reads_fp = self._write('reads.fastq', READS)
+        barcodes_fp = self._write('barcodes.fastq', BARCODES)
+        mapping_fp = self._write('mapping.txt', MAPPING_FILE)
+        lane = (reads_fp, barcodes_fp, mapping_fp, None)
+        serial_dir = join(self.out_dir, 'serial')
+        mkdir(serial_dir)
+        for _ in demultiplex_fastq([lane, lane], serial_dir, self.parameters):
+            pass
+
+        lane_dir = join(self.out_dir, 'lane')
+        mkdir(lane_dir)
+        for _ in demultiplex_fastq([lane], lane_dir, self.parameters):
+            pass
+        chunk_dirs = []
+        for i, (fwd, bcd) in enumerate(split_fastq_pair(
+                reads_fp, barcodes_fp, join(self.out_dir, 'chunks'), 3)):
+            chunk_dir = join(self.out_dir, 'chunk_%d' % i)
+            mkdir(chunk_dir)
+            for _ in demultiplex_fastq([(fwd, bcd, mapping_fp, None)],
+                                       chunk_dir, self.parameters):
+                pass
+            chunk_dirs.append(chunk_dir)
+
+        out_fp = join(self.out_dir, 'split_library_log.txt')
+        merge_split_library_logs(
+            [(None, None, [lane_dir]),
+             (reads_fp, barcodes_fp, chunk_dirs)], out_fp)
+        with open(join(serial_dir, 'split_library_log.txt')) as f:
+            exp = f.read()
+        self.assertEqual(self._read('split_library_log.txt'), exp)
+        self.assertEqual(exp.count('Total number seqs written\t4\n'), 2)
+
+    def test_demultiplex_fastq_errors(self):
+        reads_fp = self._write('reads.fastq', READS)
+        barcodes_fp = self._write('barcodes.fastq', BARCODES)
+        mapping_fp = self._write('mapping.txt', MAPPING_FILE)
+        lanes = [(reads_fp, barcodes_fp, mapping_fp, None)]
+
+        self.parameters['barcode_type'] = 'golay_24'
+        with self.assertRaises(ValueError):
+            demultiplex_fastq(lanes, self.out_dir, self.parameters)
+
+        self.parameters['barcode_type'] = 'golay_12'
+        short_fp = self._write(
+            'short.fastq', ''.join(BARCODES.splitlines(True)[:4]))
+        with self.assertRaises(ValueError):
+            list(demultiplex_fastq([(reads_fp, short_fp, mapping_fp, None)],
+                                   self.out_dir, self.parameters))
+
+        with self.assertRaises(ValueError):
+            list(demultiplex_fastq([(reads_fp, reads_fp, mapping_fp, None)],
+                                   self.out_dir, self.parameters))
+
+
+MAPPING_FILE = (
+    "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tDescription\n"
+    "1.s1\ttagtcaggccat\tGTGCCAGCMGCCGCGGTAA\tdesc1\n"
+    "1.s2\tGAGAGCTCTACG\tGTGCCAGCMGCCGCGGTAA\tdesc2\n")
+
+# 1: exact barcode
+# 2: barcode with one bit error and a short bad run at the end
+# 3: bad run at the end, truncated to 16 of 20 bases
+# 4: bad run in the middle, too short after truncation
+# 5: barcode with two bit errors
+# 6: barcode not in the mapping file
+# 7: too many N characters
+# 8: alternating low quality bases
+READS = """@M00176:18:000000000-A0DK4:1:1:1:1 1:N:0:0
+ACGTACGTAC
++
+IIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:2 1:N:0:0
+ACGTACGTAC
++
+IIIIIIII##
+@M00176:18:000000000-A0DK4:1:1:1:3 1:N:0:0
+ACGTACGTACGTACGTACGT
++
+IIIIIIIIIIIIIIII####
+@M00176:18:000000000-A0DK4:1:1:1:4 1:N:0:0
+ACGTACGTACGTACGTACGT
++
+IIIIIIIIII##########
+@M00176:18:000000000-A0DK4:1:1:1:5 1:N:0:0
+ACGTACGTAC
++
+IIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:6 1:N:0:0
+ACGTACGTAC
++
+IIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:7 1:N:0:0
+ACGTNCGTAC
++
+IIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:8 1:N:0:0
+ACGTACGTAC
++
+I#I#I#I#I#
+"""
+
+BARCODES = """@M00176:18:000000000-A0DK4:1:1:1:1 2:N:0:0
+TAGTCAGGCCAT
++
+IIIIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:2 2:N:0:0
+TAGACAGGCCAT
++
+IIIIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:3 2:N:0:0
+GAGAGCTCTACG
++
+IIIIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:4 2:N:0:0
+GAGAGCTCTACG
++
+IIIIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:5 2:N:0:0
+GAGCGCTCTACG
++
+IIIIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:6 2:N:0:0
+AAAAAAAAAAAA
++
+IIIIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:7 2:N:0:0
+TAGTCAGGCCAT
++
+IIIIIIIIIIII
+@M00176:18:000000000-A0DK4:1:1:1:8 2:N:0:0
+TAGTCAGGCCAT
++
+IIIIIIIIIIII
+"""
+
+EXP_FNA = """>1.s1_0 M00176:18:000000000-A0DK4:1:1:1:1 1:N:0:0 \
+orig_bc=TAGTCAGGCCAT new_bc=TAGTCAGGCCAT bc_diffs=0
+ACGTACGTAC
+>1.s1_1 M00176:18:000000000-A0DK4:1:1:1:2 1:N:0:0 \
+orig_bc=TAGACAGGCCAT new_bc=TAGTCAGGCCAT bc_diffs=1
+ACGTACGTAC
+>1.s2_2 M00176:18:000000000-A0DK4:1:1:1:3 1:N:0:0 \
+orig_bc=GAGAGCTCTACG new_bc=GAGAGCTCTACG bc_diffs=0
+ACGTACGTACGTACGT
+>1.s1_3 M00176:18:000000000-A0DK4:1:1:1:8 1:N:0:0 \
+orig_bc=TAGTCAGGCCAT new_bc=TAGTCAGGCCAT bc_diffs=0
+ACGTACGTAC
+"""
+
+EXP_FASTQ = """@1.s1_0 M00176:18:000000000-A0DK4:1:1:1:1 1:N:0:0 \
+orig_bc=TAGTCAGGCCAT new_bc=TAGTCAGGCCAT bc_diffs=0
+ACGTACGTAC
++
+IIIIIIIIII
+@1.s1_1 M00176:18:000000000-A0DK4:1:1:1:2 1:N:0:0 \
+orig_bc=TAGACAGGCCAT new_bc=TAGTCAGGCCAT bc_diffs=1
+ACGTACGTAC
++
+IIIIIIII##
+@1.s2_2 M00176:18:000000000-A0DK4:1:1:1:3 1:N:0:0 \
+orig_bc=GAGAGCTCTACG new_bc=GAGAGCTCTACG bc_diffs=0
+ACGTACGTACGTACGT
++
+IIIIIIIIIIIIIIII
+@1.s1_3 M00176:18:000000000-A0DK4:1:1:1:8 1:N:0:0 \
+orig_bc=TAGTCAGGCCAT new_bc=TAGTCAGGCCAT bc_diffs=0
+ACGTACGTAC
++
+I#I#I#I#I#
+"""
+
+EXP_LOG = """Quality filter results
+Total number of input sequences: 8
+Barcode not in mapping file: 1
+Read too short after quality truncation: 1
+Count of N characters exceeds limit: 1
+Illumina quality digit = 0: 0
+Barcode errors exceed max: 1
+
+Result summary (after quality filtering)
+Median sequence length: 10.00
+1.s1\t3
+1.s2\t1
+
+Total number seqs written\t4
+---
+
+"""
+
+
+if __name__ == '__main__':
+    main()
@@ -205,6 +205,7 @@ class SplitLibrariesTests(PluginTestCase):
                       "reverse_primers": "disable",
                       "reverse_primer_mismatches": 0,
                       "truncate_ambi_bases": False,
+                      "demux_storage": "gzip",
                       "input_data": artifact}
         data = {'user': 'demo@microbio.me',
                 'command': dumps(['QIIMEq2', '1.9.1', 'Split libraries']),
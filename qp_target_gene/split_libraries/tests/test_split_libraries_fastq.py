@@ -18,10 +18,18 @@ from functools import partial
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
+from qp_target_gene.util import system_call, parallel_system_call
+from qp_target_gene.split_libraries.util import merge_demultiplexed_files
+
 from qp_target_gene.split_libraries.split_libraries_fastq import (
     generate_parameters_string, get_sample_names_by_run_prefix,
     generate_per_sample_fastq_command, generate_split_libraries_fastq_cmd,
+    get_per_sample_fastq_samples,
+    generate_lane_split_libraries_fastq_cmds, get_num_chunks,
+    generate_demultiplexing_lanes, get_split_libraries_runs,
     split_libraries_fastq)
+from qp_target_gene.split_libraries.demultiplexing import (
+    demultiplex_fastq, merge_split_library_logs)
 
 
 class SplitLibrariesFastqTests(PluginTestCase):
@@ -190,6 +198,16 @@ class SplitLibrariesFastqTests(PluginTestCase):
                 forward_seqs, reverse_seqs, barcode_fps,
                 mapping_file, output_dir, params_str)
 
+    def test_get_per_sample_fastq_samples(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        forward_seqs = ["/path/s3_L001.fastq.gz", "1_s1.fastq", "s2.fq.gz"]
+        obs = get_per_sample_fastq_samples(forward_seqs, [], fp)
+        self.assertEqual(obs, ['SKB7.640196', 'SKB8.640193', 'SKD8.640184'])
+
     def test_generate_per_sample_fastq_command_error_nomatches(self):
         fd, fp = mkstemp()
         close(fd)
@@ -329,6 +347,285 @@ class SplitLibrariesFastqTests(PluginTestCase):
             generate_split_libraries_fastq_cmd(
                 fps, mapping_file, atype, out_dir, parameters)
 
+    def test_generate_lane_split_libraries_fastq_cmds(self):
+        out_dir = mkdtemp()
+        fps = {
+            "raw_forward_seqs": ["s2.fastq.gz", "s1.fastq.gz", "s3.fastq.gz"],
+            "raw_barcodes": ["s1_barcodes.fastq.gz", "s2_barcodes.fastq.gz",
+                             "s3_barcodes.fastq.gz"]}
+        self._clean_up_files.append(out_dir)
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        parameters = {
+            "max_bad_run_length": 3, "min_per_read_length_fraction": 0.75,
+            "sequence_max_n": 0, "rev_comp_barcode": False,
+            "rev_comp_mapping_barcodes": True, "rev_comp": False,
+            "phred_quality_threshold": 3, "barcode_type": "golay_12",
+            "max_barcode_errors": 1.5, "input_data": 1, "phred_offset": "auto"}
+        obs_cmds, obs_outdirs, obs_outdir = (
+            generate_lane_split_libraries_fastq_cmds(
+                fps, fp, "FASTQ", out_dir, parameters))
+        exp_outdirs = [join(out_dir, 'sl_out', 'lane_%d' % i)
+                       for i in range(1, 4)]
+        exp_cmds = [
+            "split_libraries_fastq.py --store_demultiplexed_fastq -i "
+            "s{0}.fastq.gz -b s{0}_barcodes.fastq.gz "
+            "-m {1}/mappings/s{0}_mapping_file.txt -o {2} "
+            "--max_bad_run_length 3 --min_per_read_length_fraction 0.75 "
+            "--sequence_max_n 0 --phred_quality_threshold 3 "
+            "--barcode_type golay_12 --max_barcode_errors 1.5 "
+            "--rev_comp_mapping_barcodes".format(i, out_dir, d)
+            for i, d in enumerate(exp_outdirs, 1)]
+        self.assertEqual(obs_cmds, exp_cmds)
+        self.assertEqual(obs_outdirs, exp_outdirs)
+        self.assertEqual(obs_outdir, join(out_dir, 'sl_out'))
+
+        # A single lane is not split
+        fps = {"raw_forward_seqs": ["s1.fastq.gz"],
+               "raw_barcodes": ["s1_barcodes.fastq.gz"]}
+        obs_cmds, obs_outdirs, obs_outdir = (
+            generate_lane_split_libraries_fastq_cmds(
+                fps, fp, "FASTQ", out_dir, parameters))
+        exp_cmd, exp_outdir = generate_split_libraries_fastq_cmd(
+            fps, fp, "FASTQ", out_dir, parameters)
+        self.assertEqual(obs_cmds, [exp_cmd])
+        self.assertEqual(obs_outdirs, [exp_outdir])
+        self.assertEqual(obs_outdir, exp_outdir)
+
+        fps = {"raw_forward_seqs": ["s1.fastq.gz", "s2.fastq.gz"],
+               "raw_barcodes": ["s1_barcodes.fastq.gz"]}
+        with self.assertRaisesRegexp(ValueError, 'The number of barcode files '
+                                     'and the number of sequence files should '
+                                     'match: 1 != 2'):
+            generate_lane_split_libraries_fastq_cmds(
+                fps, fp, "FASTQ", out_dir, parameters)
+
+    def _write_lane(self, out_dir):
+        fwd_fp = join(out_dir, 'reads.fastq.gz')
+        with GzipFile(fwd_fp, mode='w') as fh:
+            fh.write(READS.encode('ascii'))
+        bcds_fp = join(out_dir, 'barcodes.fastq.gz')
+        with GzipFile(bcds_fp, mode='w') as fh:
+            fh.write(BARCODES.encode('ascii'))
+        mapping_fp = join(out_dir, 'mapping_file.txt')
+        with open(mapping_fp, 'w') as f:
+            f.write(MAPPING_FILE_BARCODES)
+        fps = {"raw_forward_seqs": [fwd_fp], "raw_barcodes": [bcds_fp]}
+        return fps, mapping_fp
+
+    def test_generate_lane_split_libraries_fastq_cmds_per_sample(self):
+        fps = {
+            "raw_forward_seqs": ["s1.fastq.gz", "s3.fastq.gz", "s2.fastq.gz"],
+            "raw_reverse_seqs": ["s1_rev.fastq.gz", "s2_rev.fastq.gz",
+                                 "s3_rev.fastq.gz"]}
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        parameters = {
+            "max_bad_run_length": 3, "min_per_read_length_fraction": 0.75,
+            "sequence_max_n": 0, "rev_comp_barcode": False,
+            "rev_comp_mapping_barcodes": True, "rev_comp": False,
+            "phred_quality_threshold": 3, "barcode_type": "golay_12",
+            "max_barcode_errors": 1.5, "input_data": 1, "phred_offset": "auto"}
+        obs_cmds, obs_outdirs, obs_outdir = (
+            generate_lane_split_libraries_fastq_cmds(
+                fps, fp, "per_sample_FASTQ", "/output/dir", parameters, 4))
+        exp_outdirs = ["/output/dir/sl_out/sample_%d" % i
+                       for i in range(1, 4)]
+        exp_cmds = [
+            "split_libraries_fastq.py --store_demultiplexed_fastq -i "
+            "%s --sample_ids %s -o %s --max_bad_run_length 3 "
+            "--min_per_read_length_fraction 0.75 --sequence_max_n 0 "
+            "--phred_quality_threshold 3 --barcode_type golay_12 "
+            "--max_barcode_errors 1.5 --rev_comp_mapping_barcodes"
+            % (fwd, sample, d)
+            for fwd, sample, d in zip(
+                ["s1.fastq.gz", "s2.fastq.gz", "s3.fastq.gz"],
+                ["SKB8.640193", "SKD8.640184", "SKB7.640196"], exp_outdirs)]
+        self.assertEqual(obs_cmds, exp_cmds)
+        self.assertEqual(obs_outdirs, exp_outdirs)
+        self.assertEqual(obs_outdir, "/output/dir/sl_out")
+
+        fps["raw_barcodes"] = ["s1_barcodes.fastq.gz"]
+        with self.assertRaisesRegexp(ValueError, 'per_sample_FASTQ can not '
+                                     'have barcodes: s1_barcodes.fastq.gz'):
+            generate_lane_split_libraries_fastq_cmds(
+                fps, fp, "per_sample_FASTQ", "/output/dir", parameters)
+
+    def test_get_num_chunks(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps, _ = self._write_lane(out_dir)
+        self.assertEqual(get_num_chunks([], 8), 1)
+        # The lane is too small to be split
+        self.assertEqual(get_num_chunks(fps['raw_forward_seqs'], 8), 1)
+
+    def test_generate_lane_split_libraries_fastq_cmds_chunks(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps, mapping_fp = self._write_lane(out_dir)
+        parameters = {
+            "max_bad_run_length": 3, "min_per_read_length_fraction": 0.75,
+            "sequence_max_n": 0, "rev_comp_barcode": False,
+            "rev_comp_mapping_barcodes": False, "rev_comp": False,
+            "phred_quality_threshold": 3, "barcode_type": "golay_12",
+            "max_barcode_errors": 1.5, "input_data": 1, "phred_offset": "auto"}
+        obs_cmds, obs_outdirs, obs_outdir = (
+            generate_lane_split_libraries_fastq_cmds(
+                fps, mapping_fp, "FASTQ", out_dir, parameters, 2))
+        chunks_dir = join(out_dir, 'chunks', 'lane_1')
+        exp_outdirs = [join(out_dir, 'sl_out', 'lane_1_chunk_%d' % i)
+                       for i in range(1, 3)]
+        exp_cmds = [
+            "split_libraries_fastq.py --store_demultiplexed_fastq -i "
+            "{0}/forward_{1}.fastq -b {0}/barcodes_{1}.fastq -m {2} -o {3} "
+            "--max_bad_run_length 3 --min_per_read_length_fraction 0.75 "
+            "--sequence_max_n 0 --phred_quality_threshold 3 "
+            "--barcode_type golay_12 "
+            "--max_barcode_errors 1.5".format(chunks_dir, i, mapping_fp, d)
+            for i, d in enumerate(exp_outdirs, 1)]
+        self.assertEqual(obs_cmds, exp_cmds)
+        self.assertEqual(obs_outdirs, exp_outdirs)
+        self.assertEqual(obs_outdir, join(out_dir, 'sl_out'))
+        for i in (1, 2):
+            self.assertTrue(exists(join(chunks_dir, 'forward_%d.fastq' % i)))
+            self.assertTrue(exists(join(chunks_dir, 'barcodes_%d.fastq' % i)))
+
+    def test_split_libraries_fastq_chunks_match_serial(self):
+        # Demultiplexing the lane in chunks gives the same results than
+        # demultiplexing it at once
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps, mapping_fp = self._write_lane(out_dir)
+        parameters = {
+            "max_bad_run_length": 3, "min_per_read_length_fraction": 0.75,
+            "sequence_max_n": 0, "rev_comp_barcode": False,
+            "rev_comp_mapping_barcodes": False, "rev_comp": False,
+            "phred_quality_threshold": 3, "barcode_type": "golay_12",
+            "max_barcode_errors": 1.5, "input_data": 1, "phred_offset": "auto"}
+
+        serial_dir = join(out_dir, 'serial')
+        cmd, serial_out = generate_split_libraries_fastq_cmd(
+            fps, mapping_fp, "FASTQ", serial_dir, parameters)
+        std_out, std_err, return_value = system_call(cmd)
+        self.assertEqual(return_value, 0, std_err)
+
+        chunked_dir = join(out_dir, 'chunked')
+        cmds, chunk_outs, chunked_out = (
+            generate_lane_split_libraries_fastq_cmds(
+                fps, mapping_fp, "FASTQ", chunked_dir, parameters, 3))
+        self.assertEqual(len(cmds), 3)
+        for _, std_out, std_err, return_value in parallel_system_call(cmds):
+            self.assertEqual(return_value, 0, std_err)
+        for _ in merge_demultiplexed_files(chunk_outs, chunked_out):
+            pass
+        merge_split_library_logs(
+            get_split_libraries_runs(fps, chunk_outs),
+            join(chunked_out, 'split_library_log.txt'))
+
+        for fname in ['seqs.fna', 'seqs.fastq', 'split_library_log.txt']:
+            with open(join(serial_out, fname)) as f:
+                exp = f.read()
+            with open(join(chunked_out, fname)) as f:
+                obs = f.read()
+            if fname == 'split_library_log.txt':
+                # The mapping files are split in each output directory, so
+                # only their directory differs
+                exp = exp.replace(serial_dir, '<out_dir>')
+                obs = obs.replace(chunked_dir, '<out_dir>')
+            self.assertTrue(exp)
+            self.assertEqual(obs, exp)
+
+    def test_get_split_libraries_runs(self):
+        fps = {"raw_forward_seqs": ["/lanes/f_2.fastq", "/lanes/f_1.fastq"],
+               "raw_barcodes": ["/lanes/b_2.fastq", "/lanes/b_1.fastq"]}
+        sl_outs = ['/sl_out/lane_1', '/sl_out/lane_2_chunk_1',
+                   '/sl_out/lane_2_chunk_2']
+        self.assertEqual(get_split_libraries_runs(fps, sl_outs), [
+            (None, None, ['/sl_out/lane_1']),
+            ("/lanes/f_2.fastq", "/lanes/b_2.fastq",
+             ['/sl_out/lane_2_chunk_1', '/sl_out/lane_2_chunk_2'])])
+
+        sl_outs = ['/sl_out/sample_1', '/sl_out/sample_2']
+        self.assertEqual(
+            get_split_libraries_runs({"raw_forward_seqs": ["s1", "s2"]},
+                                     sl_outs),
+            [(None, None, ['/sl_out/sample_1']),
+             (None, None, ['/sl_out/sample_2'])])
+
+    def test_generate_demultiplexing_lanes(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps, mapping_fp = self._write_lane(out_dir)
+        obs_lanes, obs_out = generate_demultiplexing_lanes(
+            fps, mapping_fp, "FASTQ", out_dir)
+        self.assertEqual(obs_out, join(out_dir, 'sl_out'))
+        self.assertTrue(isdir(obs_out))
+        self.assertEqual(obs_lanes, [
+            (fps['raw_forward_seqs'][0], fps['raw_barcodes'][0],
+             mapping_fp, None)])
+
+        fps = {"raw_forward_seqs": ["s1.fastq.gz", "s3.fastq.gz",
+                                    "s2.fastq.gz"]}
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        obs_lanes, _ = generate_demultiplexing_lanes(
+            fps, fp, "per_sample_FASTQ", out_dir)
+        self.assertEqual(obs_lanes, [
+            ("s1.fastq.gz", None, None, "SKB8.640193"),
+            ("s2.fastq.gz", None, None, "SKD8.640184"),
+            ("s3.fastq.gz", None, None, "SKB7.640196")])
+
+        fps = {"raw_forward_seqs": ["s1.fastq.gz", "s2.fastq.gz"],
+               "raw_barcodes": ["s1_bc.fastq.gz"]}
+        with self.assertRaises(ValueError):
+            generate_demultiplexing_lanes(fps, mapping_fp, "FASTQ", out_dir)
+
+    def test_split_libraries_fastq_native_matches_qiime(self):
+        # The in-process demultiplexing writes the same sequences and log
+        # than split_libraries_fastq.py
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps, mapping_fp = self._write_lane(out_dir)
+        parameters = {
+            "max_bad_run_length": 3, "min_per_read_length_fraction": 0.75,
+            "sequence_max_n": 0, "rev_comp_barcode": False,
+            "rev_comp_mapping_barcodes": False, "rev_comp": False,
+            "phred_quality_threshold": 3, "barcode_type": "golay_12",
+            "max_barcode_errors": 1.5, "input_data": 1, "phred_offset": "auto"}
+
+        qiime_dir = join(out_dir, 'qiime')
+        cmd, qiime_out = generate_split_libraries_fastq_cmd(
+            fps, mapping_fp, "FASTQ", qiime_dir, parameters)
+        std_out, std_err, return_value = system_call(cmd)
+        self.assertEqual(return_value, 0, std_err)
+
+        lanes, native_out = generate_demultiplexing_lanes(
+            fps, mapping_fp, "FASTQ", join(out_dir, 'native'))
+        for _ in demultiplex_fastq(lanes, native_out, parameters):
+            pass
+
+        for fname in ['seqs.fna', 'seqs.fastq', 'split_library_log.txt']:
+            with open(join(qiime_out, fname)) as f:
+                exp = f.read()
+            with open(join(native_out, fname)) as f:
+                obs = f.read()
+            if fname == 'split_library_log.txt':
+                # The mapping files are split in each output directory, so
+                # only their directory differs
+                exp = exp.replace(qiime_dir, '<out_dir>')
+                obs = obs.replace(join(out_dir, 'native'), '<out_dir>')
+            self.assertTrue(exp)
+            self.assertEqual(obs, exp)
+
     def test_split_libraries_fastq(self):
         # Create a new job
         parameters = {"max_bad_run_length": 3,
@@ -341,6 +638,9 @@ class SplitLibrariesFastqTests(PluginTestCase):
                       "barcode_type": "golay_12",
                       "max_barcode_errors": 1.5,
                       "phred_offset": "auto",
+                      "demux_storage": "gzip",
+                      "demux_engine": "qiime",
+                      "compress_outputs": False,
                       "input_data": 1}
         data = {'user': 'demo@microbio.me',
                 'command': dumps(
@@ -414,6 +714,13 @@ MAPPING_FILE_4 = (
     "SKD8.640184\tILLUMINA\tA\tA\tA\tANL\tA\ts111\tIllumina MiSeq\tdesc3\n"
 )
 
+MAPPING_FILE_BARCODES = (
+    "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tDescription\n"
+    "SKB7.640196\tTAGTCAGGCCAT\tGTGCCAGCMGCCGCGGTAA\tdesc1\n"
+    "SKB8.640193\tCGTAGAGCTCTC\tGTGCCAGCMGCCGCGGTAA\tdesc2\n"
+    "SKD8.640184\tCCTCTGAGAGCT\tGTGCCAGCMGCCGCGGTAA\tdesc3\n"
+)
+
 
 READS = """@M00176:18:000000000-A0DK4:1:1:15579:1518 1:N:0:0
 GACAGAGGGTGCAAACGTTGCTCGGAATCACTGGGCGTAAAGGGCGTGTAGGCGGGAAGGATAGTCAGATGTGAAATCCCTGGGCTCAACCCAGGAACTGCATTTGAAACTCCCTGTCTTGAGTGTCGGAGAGGGTAGCGGTATTCCTGGT
@@ -11,15 +11,25 @@
 from unittest import main
 from os.path import isdir, exists, join, basename
 from shutil import rmtree
-from os import remove, close
+from os import remove, close, mkdir
 from tempfile import mkdtemp, mkstemp
+from gzip import GzipFile
+import re
 
+import numpy as np
+import numpy.testing as npt
+from h5py import File
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
 from qp_target_gene.split_libraries.util import (
     get_artifact_information, split_mapping_file, generate_demux_file,
-    generate_artifact_info)
+    generate_artifact_info, concatenate_files, merge_files, parse_fastaqual,
+    convert_fastaqual_fastq, write_fastq, parse_fastq, DemuxWriter,
+    write_demux, DEMUX_STORAGE_PROFILES, renumber_header,
+    merge_demultiplexed_files, count_fastq_records, split_fastq_pair,
+    read_fastq_batches)
+from qp_target_gene.split_libraries import util as sl_util
 
 
 class UtilTests(PluginTestCase):
@@ -84,6 +94,86 @@ class UtilTests(PluginTestCase):
         with open(obs[1], "U") as f:
             self.assertEqual(f.read(), EXP_MAPPING_FILE_2)
 
+    def test_concatenate_files(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps = []
+        for i, content in enumerate(["first\n", "", "second\nthird\n"]):
+            fp = join(out_dir, 'file_%d.txt' % i)
+            with open(fp, 'w') as f:
+                f.write(content)
+            fps.append(fp)
+
+        out_fp = join(out_dir, 'merged.txt')
+        obs = concatenate_files(fps, out_fp)
+        self.assertEqual(obs, 19)
+        with open(out_fp) as f:
+            self.assertEqual(f.read(), "first\nsecond\nthird\n")
+
+    def test_merge_files(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        in_dirs = [join(out_dir, 'run_1'), join(out_dir, 'run_2')]
+        for i, d in enumerate(in_dirs):
+            mkdir(d)
+            with open(join(d, 'seqs.fna'), 'w') as f:
+                f.write(">s_%d\nACGT\n" % i)
+            with open(join(d, 'split_library_log.txt'), 'w') as f:
+                f.write("log %d\n" % i)
+
+        obs = merge_files(in_dirs, out_dir,
+                          ['split_library_log.txt', 'seqs.fna'])
+        self.assertEqual(obs, {'split_library_log.txt': 12, 'seqs.fna': 20})
+        with open(join(out_dir, 'seqs.fna')) as f:
+            self.assertEqual(f.read(), ">s_0\nACGT\n>s_1\nACGT\n")
+        with open(join(out_dir, 'split_library_log.txt')) as f:
+            self.assertEqual(f.read(), "log 0\nlog 1\n")
+
+    def _write_fastaqual(self, fasta, qual):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fasta_fp = join(out_dir, 'seqs.fna')
+        with open(fasta_fp, 'w') as f:
+            f.write(fasta)
+        qual_fp = join(out_dir, 'seqs_filtered.qual')
+        with open(qual_fp, 'w') as f:
+            f.write(qual)
+        return out_dir, fasta_fp, qual_fp
+
+    def test_parse_fastaqual(self):
+        _, fasta_fp, qual_fp = self._write_fastaqual(FASTA_SEQS, QUAL_SEQS)
+        obs = list(parse_fastaqual(fasta_fp, qual_fp))
+        exp = [(b'a_1 orig_bc=abc new_bc=abc bc_diffs=0', b'xyzw', b'?@+I'),
+               (b'b_2 orig_bc=abw new_bc=wbc bc_diffs=4', b'qwe', b'!#5')]
+        self.assertEqual(obs, exp)
+
+    def test_parse_fastaqual_error(self):
+        _, fasta_fp, qual_fp = self._write_fastaqual(
+            FASTA_SEQS, QUAL_SEQS.replace('b_2', 'b_3'))
+        with self.assertRaises(ValueError):
+            list(parse_fastaqual(fasta_fp, qual_fp))
+
+        _, fasta_fp, qual_fp = self._write_fastaqual(
+            FASTA_SEQS, QUAL_SEQS.split('>b_2')[0])
+        with self.assertRaises(ValueError):
+            list(parse_fastaqual(fasta_fp, qual_fp))
+
+        for score in ['400', '-1', 'x', '4.5']:
+            _, fasta_fp, qual_fp = self._write_fastaqual(
+                FASTA_SEQS, QUAL_SEQS.replace(' 40', ' ' + score))
+            with self.assertRaisesRegexp(ValueError, 'Invalid quality score '
+                                         'in .*a_1.*%s' % re.escape(score)):
+                list(parse_fastaqual(fasta_fp, qual_fp))
+
+    def test_convert_fastaqual_fastq(self):
+        out_dir, fasta_fp, qual_fp = self._write_fastaqual(
+            FASTA_SEQS, QUAL_SEQS)
+        fastq_fp = join(out_dir, 'seqs.fastq')
+        obs = convert_fastaqual_fastq(fasta_fp, qual_fp, fastq_fp)
+        self.assertEqual(obs, 2)
+        with open(fastq_fp) as f:
+            self.assertEqual(f.read(), EXP_FASTQ_SEQS)
+
     def test_generate_demux_file(self):
         out_dir = mkdtemp()
         self._clean_up_files.append(out_dir)
@@ -96,6 +186,339 @@ class UtilTests(PluginTestCase):
         self.assertEqual(obs_fp, exp_fp)
         self.assertTrue(exists(exp_fp))
 
+    def test_generate_demux_file_records(self):
+        out_dir, fasta_fp, qual_fp = self._write_fastaqual(
+            FASTA_SEQS, QUAL_SEQS)
+        fastq_fp = join(out_dir, 'seqs.fastq')
+        records = write_fastq(parse_fastaqual(fasta_fp, qual_fp), fastq_fp)
+
+        obs_fp = generate_demux_file(out_dir, records)
+        self.assertEqual(obs_fp, join(out_dir, 'seqs.demux'))
+        with open(fastq_fp) as f:
+            self.assertEqual(f.read(), EXP_FASTQ_SEQS)
+        with File(obs_fp, 'r') as f:
+            self.assertEqual(sorted(f), ['a', 'b'])
+            self.assertEqual(f.attrs['n'], 2)
+
+    def test_write_fastq_gz(self):
+        out_dir, fasta_fp, qual_fp = self._write_fastaqual(
+            FASTA_SEQS, QUAL_SEQS)
+        fastq_fp = join(out_dir, 'seqs.fastq.gz')
+        records = list(write_fastq(parse_fastaqual(fasta_fp, qual_fp),
+                                   fastq_fp))
+        self.assertEqual(len(records), 2)
+        with GzipFile(fastq_fp, 'rb') as f:
+            self.assertEqual(f.read().decode('ascii'), EXP_FASTQ_SEQS)
+        self.assertEqual(count_fastq_records(fastq_fp), 2)
+
+    def test_generate_demux_file_records_empty(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        with self.assertRaises(ValueError):
+            generate_demux_file(out_dir, iter([]))
+
+    def test_parse_fastq(self):
+        fd, fp = mkstemp(suffix='.fastq')
+        close(fd)
+        self._clean_up_files.append(fp)
+        with open(fp, 'w') as f:
+            f.write(DEMUX_SEQS)
+
+        with open(fp, 'rb') as f:
+            obs = list(parse_fastq(f))
+        exp = [(b'a_1 orig_bc=abc new_bc=abc bc_diffs=0', b'xyz', b'ABC'),
+               (b'b_1 orig_bc=abw new_bc=wbc bc_diffs=4', b'qwe', b'DFG'),
+               (b'b_2 orig_bc=abw new_bc=wbc bc_diffs=4', b'qwe', b'DEF')]
+        self.assertEqual(obs, exp)
+
+        with open(fp, 'w') as f:
+            f.write(FASTA_SEQS)
+        with open(fp, 'rb') as f:
+            with self.assertRaises(ValueError):
+                list(parse_fastq(f))
+
+    def test_renumber_header(self):
+        self.assertEqual(
+            renumber_header(b'a_b_1 orig_bc=abc new_bc=abc bc_diffs=0', 10),
+            b'a_b_11 orig_bc=abc new_bc=abc bc_diffs=0')
+        self.assertEqual(renumber_header(b'a_0', 3), b'a_3')
+
+    def test_merge_demultiplexed_files(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        in_dirs = [join(out_dir, 'lane_%d' % i) for i in range(1, 4)]
+        seqs = [DEMUX_SEQS, "", DEMUX_SEQS.replace('@a_1', '@a_0')]
+        for i, (d, fastq) in enumerate(zip(in_dirs, seqs)):
+            mkdir(d)
+            with open(join(d, 'seqs.fastq'), 'w') as f:
+                f.write(fastq)
+            with open(join(d, 'seqs.fna'), 'w') as f:
+                for line_no, line in enumerate(fastq.splitlines(True)):
+                    if line_no % 4 == 0:
+                        f.write('>' + line[1:])
+                    elif line_no % 4 == 1:
+                        f.write(line)
+            with open(join(d, 'split_library_log.txt'), 'w') as f:
+                f.write("log %d\n" % i)
+
+        records = merge_demultiplexed_files(in_dirs, out_dir)
+        with open(join(out_dir, 'split_library_log.txt')) as f:
+            self.assertEqual(f.read(), "log 0\nlog 1\nlog 2\n")
+        with open(join(out_dir, 'seqs.fna')) as f:
+            self.assertEqual(f.read(), EXP_MERGED_FNA)
+
+        obs = [h for h, _, _ in records]
+        exp = [b'a_1 orig_bc=abc new_bc=abc bc_diffs=0',
+               b'b_1 orig_bc=abw new_bc=wbc bc_diffs=4',
+               b'b_2 orig_bc=abw new_bc=wbc bc_diffs=4',
+               b'a_3 orig_bc=abc new_bc=abc bc_diffs=0',
+               b'b_4 orig_bc=abw new_bc=wbc bc_diffs=4',
+               b'b_5 orig_bc=abw new_bc=wbc bc_diffs=4']
+        self.assertEqual(obs, exp)
+        with open(join(out_dir, 'seqs.fastq'), 'rb') as f:
+            self.assertEqual([h for h, _, _ in parse_fastq(f)], exp)
+
+    def _write_fastq_pair(self, forward, barcodes):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fwd_fp = join(out_dir, 'forward.fastq.gz')
+        with GzipFile(fwd_fp, mode='w') as f:
+            f.write(forward.encode('ascii'))
+        bcd_fp = join(out_dir, 'barcodes.fastq')
+        with open(bcd_fp, 'w') as f:
+            f.write(barcodes)
+        return out_dir, fwd_fp, bcd_fp
+
+    def test_count_fastq_records(self):
+        _, fwd_fp, bcd_fp = self._write_fastq_pair(
+            DEMUX_SEQS, DEMUX_SEQS.rstrip('\n'))
+        self.assertEqual(count_fastq_records(fwd_fp), 3)
+        self.assertEqual(count_fastq_records(bcd_fp), 3)
+
+    def test_read_fastq_batches(self):
+        forward = DEMUX_SEQS * 3
+        _, fwd_fp, bcd_fp = self._write_fastq_pair(
+            forward, forward.replace('\n', '\r\n').rstrip('\r\n'))
+        with open(bcd_fp, 'rb') as f:
+            exp = list(parse_fastq(f))
+        self.assertEqual(len(exp), 9)
+        for fp in [fwd_fp, bcd_fp]:
+            batches = list(read_fastq_batches(fp, 4))
+            self.assertEqual([len(b) for b in batches], [4, 4, 1])
+            obs = [b.record(i) for b in batches for i in range(len(b))]
+            self.assertEqual(obs, exp)
+
+        batch = batches[0]
+        npt.assert_equal(batch.lengths(0), [37, 37, 37, 37])
+        seqs, lengths = batch.matrix(1)
+        npt.assert_equal(seqs, [bytearray(b'xyz'), bytearray(b'qwe'),
+                                bytearray(b'qwe'), bytearray(b'xyz')])
+        npt.assert_equal(lengths, [3, 3, 3, 3])
+        quals, lengths = batch.matrix(3, width=2, rows=np.array([1, 2]))
+        npt.assert_equal(quals, [bytearray(b'DF'), bytearray(b'DE')])
+        npt.assert_equal(lengths, [2, 2])
+        self.assertEqual(batch.get(1, 1), b'qwe')
+
+    def test_read_fastq_batches_small_blocks(self):
+        # the records are found even if a batch doesn't fit in a block
+        forward = DEMUX_SEQS * 3 + '\n\n'
+        _, fwd_fp, bcd_fp = self._write_fastq_pair(forward, forward)
+        block_size = sl_util.FASTQ_BLOCK_SIZE
+        sl_util.FASTQ_BLOCK_SIZE = 10
+        try:
+            for fp in [fwd_fp, bcd_fp]:
+                obs = [b.record(i) for b in read_fastq_batches(fp, 2)
+                       for i in range(len(b))]
+                self.assertEqual(len(obs), 9)
+                self.assertEqual(obs[-1], (
+                    b'b_2 orig_bc=abw new_bc=wbc bc_diffs=4', b'qwe', b'DEF'))
+        finally:
+            sl_util.FASTQ_BLOCK_SIZE = block_size
+
+    def test_read_fastq_batches_empty(self):
+        _, fwd_fp, bcd_fp = self._write_fastq_pair('', '')
+        self.assertEqual(list(read_fastq_batches(fwd_fp)), [])
+        self.assertEqual(list(read_fastq_batches(bcd_fp)), [])
+
+    def test_read_fastq_batches_error(self):
+        _, fwd_fp, bcd_fp = self._write_fastq_pair(
+            DEMUX_SEQS + '@c_1\nxyz\n', DEMUX_SEQS.replace('+', '-'))
+        with self.assertRaises(ValueError):
+            list(read_fastq_batches(fwd_fp))
+        with self.assertRaises(ValueError):
+            list(read_fastq_batches(bcd_fp))
+
+    def test_split_fastq_pair(self):
+        forward = DEMUX_SEQS * 3
+        barcodes = forward.replace('xyz', 'AAA').replace('qwe', 'CCC')
+        out_dir, fwd_fp, bcd_fp = self._write_fastq_pair(
+            forward, barcodes.rstrip('\n'))
+        chunks_dir = join(out_dir, 'chunks')
+
+        obs = split_fastq_pair(fwd_fp, bcd_fp, chunks_dir, 4)
+        exp = [(join(chunks_dir, 'forward_%d.fastq' % i),
+                join(chunks_dir, 'barcodes_%d.fastq' % i))
+               for i in range(1, 5)]
+        self.assertEqual(obs, exp)
+
+        obs_fwd = []
+        obs_bcd = []
+        for fwd, bcd in obs:
+            with open(fwd) as f:
+                obs_fwd.append(f.read())
+            with open(bcd) as f:
+                obs_bcd.append(f.read())
+        self.assertEqual([c.count('\n') for c in obs_fwd], [12, 8, 8, 8])
+        self.assertEqual(''.join(obs_fwd), forward)
+        self.assertEqual(''.join(obs_bcd), barcodes)
+
+        # Less records than chunks
+        out_dir, fwd_fp, bcd_fp = self._write_fastq_pair(
+            DEMUX_SEQS, DEMUX_SEQS)
+        obs = split_fastq_pair(fwd_fp, bcd_fp, join(out_dir, 'chunks'), 10)
+        self.assertEqual(len(obs), 3)
+
+        # Nothing to split
+        out_dir, fwd_fp, bcd_fp = self._write_fastq_pair('', '')
+        obs = split_fastq_pair(fwd_fp, bcd_fp, join(out_dir, 'chunks'), 10)
+        self.assertEqual(obs, [(fwd_fp, bcd_fp)])
+
+    def test_split_fastq_pair_error(self):
+        out_dir, fwd_fp, bcd_fp = self._write_fastq_pair(
+            DEMUX_SEQS, DEMUX_SEQS * 2)
+        with self.assertRaises(ValueError):
+            split_fastq_pair(fwd_fp, bcd_fp, join(out_dir, 'chunks'), 2)
+
+        out_dir, fwd_fp, bcd_fp = self._write_fastq_pair(
+            DEMUX_SEQS * 2, DEMUX_SEQS)
+        with self.assertRaises(ValueError):
+            split_fastq_pair(fwd_fp, bcd_fp, join(out_dir, 'chunks'), 2)
+
+    def test_write_demux(self):
+        fd, fp = mkstemp(suffix='.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+
+        records = [
+            (b's.1_0 orig_bc=AAAA new_bc=AAAA bc_diffs=0', b'ACG', b'III'),
+            (b's.2_1 orig_bc=CCCA new_bc=CCCC bc_diffs=1', b'ACGT', b'II5I'),
+            (b's.1_2 orig_bc=AAAA new_bc=AAAA bc_diffs=0', b'ACGTA',
+             b'!!!!!'),
+            (b's.1_3 orig_bc=ATAA new_bc=AAAA bc_diffs=1', b'AC', b'II')]
+        with File(fp, 'w') as f:
+            self.assertEqual(write_demux(records, f), 4)
+
+        with File(fp, 'r') as f:
+            self.assertTrue(f.attrs['has-qual'])
+            self.assertEqual(f.attrs['n'], 4)
+            self.assertEqual(f.attrs['max'], 5)
+            self.assertEqual(f.attrs['min'], 2)
+            self.assertEqual(f.attrs['mean'], 3.5)
+            self.assertEqual(f.attrs['median'], 3.5)
+
+            s1 = f['s.1']
+            self.assertEqual(s1.attrs['n'], 3)
+            self.assertEqual(s1.attrs['median'], 3)
+            npt.assert_equal(s1['sequence'][:], [b'ACG', b'ACGTA', b'AC'])
+            self.assertEqual(s1['sequence'].dtype, np.dtype('|S5'))
+            npt.assert_equal(s1['qual'][:], [[40, 40, 40, 0, 0],
+                                             [0, 0, 0, 0, 0],
+                                             [40, 40, 0, 0, 0]])
+            npt.assert_equal(s1['barcode/original'][:],
+                             [b'AAAA', b'AAAA', b'ATAA'])
+            npt.assert_equal(s1['barcode/corrected'][:],
+                             [b'AAAA', b'AAAA', b'AAAA'])
+            npt.assert_equal(s1['barcode/error'][:], [0, 0, 1])
+
+            s2 = f['s.2']
+            npt.assert_equal(s2['sequence'][:], [b'ACGT'])
+            npt.assert_equal(s2['qual'][:], [[40, 40, 20, 40]])
+            npt.assert_equal(s2['barcode/error'][:], [1])
+
+    def test_demux_writer_widen(self):
+        fd, fp = mkstemp(suffix='.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+
+        with File(fp, 'w') as f:
+            writer = DemuxWriter(f, buffer_size=1)
+            writer.write(b's_0 orig_bc=A new_bc=A bc_diffs=0', b'AC', b'II')
+            writer.write(b's_1 orig_bc=A new_bc=A bc_diffs=0', b'ACGT',
+                         b'IIII')
+            writer.write(b's_2 orig_bc=A new_bc=A bc_diffs=0', b'A', b'I')
+            # the datasets are doubled, and narrowed when closing
+            writer.write(b't_0 orig_bc=A new_bc=A bc_diffs=0', b'AC', b'II')
+            writer.write(b't_1 orig_bc=A new_bc=A bc_diffs=0', b'ACG', b'III')
+            self.assertEqual(f['t/sequence'].dtype, np.dtype('|S4'))
+            self.assertEqual(writer.close(), 5)
+
+        with File(fp, 'r') as f:
+            npt.assert_equal(f['s/sequence'][:], [b'AC', b'ACGT', b'A'])
+            self.assertEqual(f['s/sequence'].dtype, np.dtype('|S4'))
+            npt.assert_equal(f['s/qual'][:], [[40, 40, 0, 0],
+                                              [40, 40, 40, 40],
+                                              [40, 0, 0, 0]])
+            npt.assert_equal(f['t/sequence'][:], [b'AC', b'ACG'])
+            self.assertEqual(f['t/sequence'].dtype, np.dtype('|S3'))
+            npt.assert_equal(f['t/qual'][:], [[40, 40, 0], [40, 40, 40]])
+
+    def test_demux_writer_write_chunk(self):
+        fd, fp = mkstemp(suffix='.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+
+        with File(fp, 'w') as f:
+            writer = DemuxWriter(f)
+            writer.write(b's_0 orig_bc=A new_bc=A bc_diffs=0', b'AC', b'II')
+            writer.write_chunk(
+                b's', np.frombuffer(b'ACG\x00ACGT', dtype=np.uint8).reshape(
+                    2, 4),
+                np.array([[40, 40, 40, 0], [1, 2, 3, 4]], dtype=np.uint8),
+                np.array([b'A', b'C']), np.array([b'A', b'A']),
+                np.array([0, 1]))
+            self.assertEqual(writer.close(), 3)
+
+        with File(fp, 'r') as f:
+            self.assertTrue(f.attrs['has-qual'])
+            self.assertEqual(f.attrs['max'], 4)
+            self.assertEqual(f['s'].attrs['n'], 3)
+            # the chunk goes after the sequences already written
+            npt.assert_equal(f['s/sequence'][:], [b'AC', b'ACG', b'ACGT'])
+            self.assertEqual(f['s/sequence'].dtype, np.dtype('|S4'))
+            npt.assert_equal(f['s/qual'][:], [[40, 40, 0, 0],
+                                              [40, 40, 40, 0],
+                                              [1, 2, 3, 4]])
+            npt.assert_equal(f['s/barcode/original'][:], [b'A', b'A', b'C'])
+            npt.assert_equal(f['s/barcode/error'][:], [0, 0, 1])
+
+    def test_write_demux_storage(self):
+        records = [
+            (b's_0 orig_bc=AAAA new_bc=AAAA bc_diffs=0', b'ACG', b'III'),
+            (b's_1 orig_bc=AAAA new_bc=AAAA bc_diffs=0', b'AC', b'II')]
+        for storage, profile in DEMUX_STORAGE_PROFILES.items():
+            fd, fp = mkstemp(suffix='.demux')
+            close(fd)
+            self._clean_up_files.append(fp)
+            with File(fp, 'w') as f:
+                self.assertEqual(write_demux(records, f, storage), 2)
+
+            with File(fp, 'r') as f:
+                for name in ['sequence', 'qual', 'barcode/error']:
+                    ds = f['s'][name]
+                    self.assertEqual(ds.compression, profile['compression'])
+                    self.assertEqual(ds.shuffle, profile['shuffle'])
+                    if profile['chunk_size'] is not None:
+                        self.assertEqual(ds.chunks[0], profile['chunk_size'])
+                npt.assert_equal(f['s/sequence'][:], [b'ACG', b'AC'])
+
+    def test_demux_writer_storage_error(self):
+        fd, fp = mkstemp(suffix='.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        with File(fp, 'w') as f:
+            with self.assertRaises(ValueError):
+                DemuxWriter(f, storage='bzip2')
+
     def test_generate_demux_file_error(self):
         out_dir = mkdtemp()
         self._clean_up_files.append(out_dir)
@@ -120,6 +543,25 @@ class UtilTests(PluginTestCase):
         exp = [ArtifactInfo('demultiplexed', 'Demultiplexed', fps)]
         self.assertEqual(obs, exp)
 
+    def test_generate_artifact_info_compress(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        with open(join(out_dir, 'seqs.fna'), 'w') as f:
+            f.write(FASTA_SEQS)
+        # The outputs may have been written compressed
+        with GzipFile(join(out_dir, 'seqs.fastq.gz'), 'wb') as f:
+            f.write(DEMUX_SEQS.encode('ascii'))
+        obs = generate_artifact_info(out_dir, compress=True)
+        fps = [(join(out_dir, "seqs.fna.gz"), "preprocessed_fasta"),
+               (join(out_dir, "seqs.fastq.gz"), "preprocessed_fastq"),
+               (join(out_dir, "seqs.demux"), "preprocessed_demux"),
+               (join(out_dir, "split_library_log.txt"), "log")]
+        exp = [ArtifactInfo('demultiplexed', 'Demultiplexed', fps)]
+        self.assertEqual(obs, exp)
+        self.assertFalse(exists(join(out_dir, 'seqs.fna')))
+        with GzipFile(join(out_dir, 'seqs.fna.gz'), 'rb') as f:
+            self.assertEqual(f.read().decode('ascii'), FASTA_SEQS)
+
 
 DEMUX_SEQS = """@a_1 orig_bc=abc new_bc=abc bc_diffs=0
 xyz
@@ -135,6 +577,30 @@ qwe
 DEF
 """
 
+FASTA_SEQS = """>a_1 orig_bc=abc new_bc=abc bc_diffs=0
+xy
+zw
+>b_2 orig_bc=abw new_bc=wbc bc_diffs=4
+qwe
+"""
+
+QUAL_SEQS = """>a_1 orig_bc=abc new_bc=abc bc_diffs=0
+30 31
+10 40
+>b_2 orig_bc=abw new_bc=wbc bc_diffs=4
+0 2 20
+"""
+
+EXP_FASTQ_SEQS = """@a_1 orig_bc=abc new_bc=abc bc_diffs=0
+xyzw
++
+?@+I
+@b_2 orig_bc=abw new_bc=wbc bc_diffs=4
+qwe
++
+!#5
+"""
+
 MAPPING_FILE_SINGLE = (
     "#SampleID\tBarcodeSequence\tLinkerPrimerSequence\tDescription\n"
     "Sample1\tGTCCGCAAGTTA\tGTGCCAGCMGCCGCGGTAA\tTGP test\n"
@@ -159,6 +625,14 @@ EXP_MAPPING_FILE_2 = (
     "Description\n"
     "Sample2\tCGTAGAGCTCTC\tGTGCCAGCMGCCGCGGTAA\tprefix_2\tTGP øtest\n"
 )
+EXP_MERGED_FNA = (
+    ">a_1 orig_bc=abc new_bc=abc bc_diffs=0\nxyz\n"
+    ">b_1 orig_bc=abw new_bc=wbc bc_diffs=4\nqwe\n"
+    ">b_2 orig_bc=abw new_bc=wbc bc_diffs=4\nqwe\n"
+    ">a_3 orig_bc=abc new_bc=abc bc_diffs=0\nxyz\n"
+    ">b_4 orig_bc=abw new_bc=wbc bc_diffs=4\nqwe\n"
+    ">b_5 orig_bc=abw new_bc=wbc bc_diffs=4\nqwe\n")
+
 
 if __name__ == '__main__':
     main()
@@ -8,12 +8,36 @@
 
 from os.path import join, exists
 from functools import partial
-from os import makedirs, stat
+from os import makedirs, stat, fstat, remove
+from shutil import copyfileobj
+from multiprocessing.pool import ThreadPool
+from mmap import mmap, ACCESS_READ, PAGESIZE
+import re
+import warnings
 
+from future.moves.itertools import zip_longest
+
+import numpy as np
 import pandas as pd
 from h5py import File
 from qiita_client import ArtifactInfo
-from qiita_files.demux import to_hdf5
+
+from qp_target_gene.parallel_gzip import open_gzip, compress_file
+
+# Kernel-side copies are only available in python 3
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+try:
+    from os import sendfile
+except ImportError:
+    sendfile = None
+# Releasing the pages of a memory map is only available in python 3.8+
+try:
+    from mmap import MADV_DONTNEED
+except ImportError:
+    MADV_DONTNEED = None
 
 
 def get_artifact_information(qclient, artifact_id):
@@ -80,13 +104,1183 @@ def split_mapping_file(mapping_file, out_dir):
     return output_fps
 
 
-def generate_demux_file(sl_out):
+# Size of the buffer used when copying the files without the kernel support
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def _copy_file(in_f, out_f):
+    """Appends the contents of `in_f` to `out_f`
+
+    Parameters
+    ----------
+    in_f : file
+        The input file, opened in binary mode
+    out_f : file
+        The output file, opened in unbuffered binary mode
+
+    Returns
+    -------
+    int
+        The number of bytes copied
+
+    Notes
+    -----
+    The copy happens inside the kernel (copy_file_range or sendfile) when the
+    platform supports it, falling back to large buffered copies otherwise
+    """
+    in_fd, out_fd = in_f.fileno(), out_f.fileno()
+    size = fstat(in_fd).st_size
+    kernel_copies = [
+        (copy_file_range, lambda done: copy_file_range(
+            in_fd, out_fd, size - done, done)),
+        (sendfile, lambda done: sendfile(out_fd, in_fd, done, size - done))]
+    for available, kernel_copy in kernel_copies:
+        if available is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                n = kernel_copy(copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            if copied:
+                raise
+            # The file system doesn't support this syscall, try the next one
+            continue
+        if copied == size:
+            return copied
+        raise IOError("Unable to copy %s: %d of %d bytes copied"
+                      % (in_f.name, copied, size))
+    copyfileobj(in_f, out_f, COPY_BUFFER_SIZE)
+    return size
+
+
+def concatenate_files(fps, out_fp):
+    """Concatenates the files in `fps` into `out_fp`
+
+    Parameters
+    ----------
+    fps : list of str
+        The filepaths to concatenate, in order
+    out_fp : str
+        The output filepath
+
+    Returns
+    -------
+    int
+        The number of bytes written to `out_fp`
+    """
+    written = 0
+    with open(out_fp, 'wb', 0) as out_f:
+        for fp in fps:
+            with open(fp, 'rb') as in_f:
+                written += _copy_file(in_f, out_f)
+    return written
+
+
+def merge_files(in_dirs, out_dir, fnames, num_jobs=None):
+    """Concatenates the files named `fnames` of each of the `in_dirs`
+
+    Parameters
+    ----------
+    in_dirs : list of str
+        The directories holding the files to merge, in order
+    out_dir : str
+        The directory where the merged files are written
+    fnames : list of str
+        The names of the files to merge
+    num_jobs : int, optional
+        The number of files merged at the same time. Defaults to merging all
+        the `fnames` at once
+
+    Returns
+    -------
+    dict of {str: int}
+        The number of bytes written, keyed by file name
+    """
+    def merge(fname):
+        return concatenate_files([join(d, fname) for d in in_dirs],
+                                 join(out_dir, fname))
+
+    pool = ThreadPool(num_jobs or len(fnames))
+    try:
+        sizes = pool.map(merge, fnames)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(fnames, sizes))
+
+
+# Size of the buffer used when writing the FASTQ records
+FASTQ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Maximum PHRED score that can be represented in FASTQ files (offset 33)
+MAX_PHRED_SCORE = 93
+
+
+def _parse_fasta_like(fp, sep):
+    """Yields the records of a FASTA or QUAL file
+
+    Parameters
+    ----------
+    fp : str
+        The filepath
+    sep : bytes
+        The string used to join the lines of a single record
+
+    Yields
+    ------
+    bytes, bytes
+        The record header (without the leading '>') and its data
+    """
+    header, data = None, []
+    with open(fp, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(b'>'):
+                if header is not None:
+                    yield header, sep.join(data)
+                header, data = line[1:], []
+            else:
+                data.append(line)
+    if header is not None:
+        yield header, sep.join(data)
+
+
+def _phred_to_ascii(header, qual):
+    """Converts the PHRED scores of a QUAL record to ASCII (offset 33)
+
+    Parameters
+    ----------
+    header : bytes
+        The record header
+    qual : bytes
+        The space separated PHRED scores
+
+    Returns
+    -------
+    bytes
+        The ASCII encoded quality
+
+    Raises
+    ------
+    ValueError
+        If a quality score is not a valid PHRED score
+    """
+    # The scores of the whole record are parsed and offset at once by NumPy.
+    # Older NumPy versions only warn about the data that can't be parsed
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            scores = np.fromstring(qual, dtype=np.int64, sep=' ')
+    except (ValueError, DeprecationWarning):
+        scores = None
+    if scores is None or (scores.size and (
+            scores.min() < 0 or scores.max() > MAX_PHRED_SCORE)):
+        invalid = [q for q in qual.split()
+                   if not q.isdigit() or int(q) > MAX_PHRED_SCORE]
+        raise ValueError("Invalid quality score in %s: %s"
+                         % (header, invalid[0] if invalid else qual))
+    return (scores + 33).astype(np.uint8).tobytes()
+
+
+def parse_fastaqual(fasta_fp, qual_fp):
+    """Yields the FASTQ records from a pair of FASTA and QUAL files
+
+    Parameters
+    ----------
+    fasta_fp : str
+        The FASTA filepath
+    qual_fp : str
+        The QUAL filepath
+
+    Yields
+    ------
+    bytes, bytes, bytes
+        The record header, sequence and ASCII encoded quality (offset 33)
+
+    Raises
+    ------
+    ValueError
+        If the FASTA and QUAL records do not match
+        If a quality score is not a valid PHRED score
+    """
+    fasta_recs = _parse_fasta_like(fasta_fp, b'')
+    qual_recs = _parse_fasta_like(qual_fp, b' ')
+    for fasta_rec, qual_rec in zip_longest(fasta_recs, qual_recs):
+        if fasta_rec is None or qual_rec is None:
+            raise ValueError("The FASTA and QUAL files have a different "
+                             "number of records")
+        header, seq = fasta_rec
+        qual_header, qual = qual_rec
+        if header != qual_header:
+            raise ValueError("The FASTA and QUAL headers do not match: %s != "
+                             "%s" % (header, qual_header))
+        qual = _phred_to_ascii(header, qual)
+        if len(seq) != len(qual):
+            raise ValueError("The sequence and quality lengths of %s do not "
+                             "match: %d != %d" % (header, len(seq), len(qual)))
+        yield header, seq, qual
+
+
+def write_fastq(records, fastq_fp):
+    """Writes the FASTQ `records` to `fastq_fp`, yielding them
+
+    Parameters
+    ----------
+    records : iterable of (bytes, bytes, bytes)
+        The header, sequence and ASCII encoded quality of each record
+    fastq_fp : str
+        The output FASTQ filepath. If it ends in .gz, the file is compressed
+        in parallel
+
+    Yields
+    ------
+    bytes, bytes, bytes
+        The records, as they are written to `fastq_fp`, so they can be
+        consumed by another writer without re-parsing the FASTQ file
+    """
+    with open_output(fastq_fp) as f:
+        for header, seq, qual in records:
+            f.write(b''.join([b'@', header, b'\n', seq, b'\n+\n', qual,
+                              b'\n']))
+            yield header, seq, qual
+
+
+def convert_fastaqual_fastq(fasta_fp, qual_fp, fastq_fp):
+    """Converts a pair of FASTA and QUAL files into a FASTQ file
+
+    Parameters
+    ----------
+    fasta_fp : str
+        The FASTA filepath
+    qual_fp : str
+        The QUAL filepath
+    fastq_fp : str
+        The output FASTQ filepath
+
+    Returns
+    -------
+    int
+        The number of records written
+    """
+    count = 0
+    for _ in write_fastq(parse_fastaqual(fasta_fp, qual_fp), fastq_fp):
+        count += 1
+    return count
+
+
+def parse_fastq(fh):
+    """Yields the records of a FASTQ file
+
+    Parameters
+    ----------
+    fh : file
+        The FASTQ file, opened in binary mode. It is only read sequentially,
+        so it can also be a pipe
+
+    Yields
+    ------
+    bytes, bytes, bytes
+        The record header, sequence and ASCII encoded quality
+
+    Raises
+    ------
+    ValueError
+        If a record is not a valid FASTQ record
+    """
+    while True:
+        header = fh.readline()
+        if not header:
+            return
+        if not header.strip():
+            continue
+        seq, plus, qual = fh.readline(), fh.readline(), fh.readline()
+        if not header.startswith(b'@') or not plus.startswith(b'+'):
+            raise ValueError("Invalid FASTQ record: %s" % header.strip())
+        yield (header[1:].rstrip(b'\r\n'), seq.rstrip(b'\r\n'),
+               qual.rstrip(b'\r\n'))
+
+
+def renumber_header(header, offset):
+    """Adds `offset` to the sequence index of a demultiplexed record header
+
+    Parameters
+    ----------
+    header : bytes
+        The record header, in the `<sample>_<index> <description>` format used
+        by the split libraries scripts
+    offset : int
+        The value to add to the sequence index
+
+    Returns
+    -------
+    bytes
+        The renumbered header
+    """
+    seq_id, sep, description = header.partition(b' ')
+    sample, idx = seq_id.rsplit(b'_', 1)
+    return b''.join([sample, b'_', str(int(idx) + offset).encode('ascii'),
+                     sep, description])
+
+
+def _renumber_fastq(fps, offsets):
+    """Yields the records of the FASTQ files `fps`, renumbered by `offsets`
+
+    Parameters
+    ----------
+    fps : list of str
+        The FASTQ filepaths
+    offsets : list of int
+        The value to add to the sequence indices of each of the files
+
+    Yields
+    ------
+    bytes, bytes, bytes
+        The renumbered header, the sequence and the quality of each record
+    """
+    for fp, offset in zip(fps, offsets):
+        with open(fp, 'rb', FASTQ_BUFFER_SIZE) as f:
+            for header, seq, qual in parse_fastq(f):
+                yield renumber_header(header, offset), seq, qual
+
+
+def merge_demultiplexed_files(in_dirs, out_dir):
+    """Merges the outputs of split_libraries_fastq.py ran on parts of the data
+
+    Parameters
+    ----------
+    in_dirs : list of str
+        The split_libraries_fastq.py output directories, in the order the
+        data is found in the original files
+    out_dir : str
+        The directory where the merged files are written
+
+    Returns
+    -------
+    generator of (bytes, bytes, bytes)
+        The merged FASTQ records, as they are written to `out_dir`/seqs.fastq
+
+    Notes
+    -----
+    Each of the split_libraries_fastq.py runs numbers its sequences starting
+    at 0, so the sequence indices are shifted by the number of sequences of
+    the previous runs, so the merged sequences are the ones of a single run
+    over all the data. The logs are concatenated, which only gives the log of
+    a single run if each of the runs processed whole input files: the logs of
+    the chunks of a file are merged by
+    `demultiplexing.merge_split_library_logs`. The logs and the FASTA files
+    are merged when this function is called, while the FASTQ file is written
+    as the returned records are consumed, so they can be passed to the demux
+    writer
+    """
+    concatenate_files([join(d, 'split_library_log.txt') for d in in_dirs],
+                      join(out_dir, 'split_library_log.txt'))
+
+    offsets = []
+    count = 0
+    with open(join(out_dir, 'seqs.fna'), 'wb', FASTQ_BUFFER_SIZE) as out_f:
+        for in_dir in in_dirs:
+            offsets.append(count)
+            with open(join(in_dir, 'seqs.fna'), 'rb', FASTQ_BUFFER_SIZE) as f:
+                for line in f:
+                    if line.startswith(b'>'):
+                        line = b'>' + renumber_header(line[1:], offsets[-1])
+                        count += 1
+                    out_f.write(line)
+
+    return write_fastq(
+        _renumber_fastq([join(d, 'seqs.fastq') for d in in_dirs], offsets),
+        join(out_dir, 'seqs.fastq'))
+
+
+def _open_fastq(fp):
+    """Opens a FASTQ file, that may be gzipped, for reading in binary mode
+
+    Parameters
+    ----------
+    fp : str
+        The FASTQ filepath
+
+    Returns
+    -------
+    file
+        The open file. Gzipped files are decompressed by a pool of threads
+    """
+    if fp.endswith('.gz'):
+        return open_gzip(fp)
+    return open(fp, 'rb')
+
+
+def open_output(fp):
+    """Opens an output file for writing in binary mode
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath. If it ends in .gz, the file is compressed in
+        parallel
+
+    Returns
+    -------
+    file
+        The open file
+    """
+    if fp.endswith('.gz'):
+        return open_gzip(fp, 'wb')
+    return open(fp, 'wb', FASTQ_BUFFER_SIZE)
+
+
+# Size of the blocks in which `read_fastq_batches` reads the FASTQ files
+FASTQ_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class FastqBatch(object):
+    """A batch of FASTQ records that share a single buffer
+
+    Parameters
+    ----------
+    data : np.array of np.uint8
+        The buffer holding the records
+    starts : np.array of int
+        The position in `data` where the header (without the leading '@'),
+        sequence, '+' and quality lines of each record start, one record per
+        row
+    ends : np.array of int
+        The position in `data` where each of the lines ends, without the line
+        terminator
+
+    Notes
+    -----
+    The records stay in `data`, so they can be processed with NumPy without
+    creating a Python string for each line
+    """
+    def __init__(self, data, starts, ends):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lengths(self, line):
+        """Returns the length of one of the lines of the records
+
+        Parameters
+        ----------
+        line : int
+            The line: 0 for the header, 1 for the sequence, 3 for the quality
+
+        Returns
+        -------
+        np.array of int
+            The length of the line of each record
+        """
+        return self.ends[:, line] - self.starts[:, line]
+
+    def matrix(self, line, width=None, rows=None):
+        """Returns one of the lines of the records as a matrix
+
+        Parameters
+        ----------
+        line : int
+            The line: 0 for the header, 1 for the sequence, 3 for the quality
+        width : int, optional
+            The number of columns of the matrix. Longer lines are truncated.
+            Defaults to the length of the longest line
+        rows : np.array of int, optional
+            The records to include. Defaults to all of them
+
+        Returns
+        -------
+        np.array of np.uint8, np.array of int
+            The bytes of the line of each record, padded with zeros
+            The length of the line of each record (at most `width`)
+        """
+        starts = self.starts[:, line]
+        lengths = self.ends[:, line] - starts
+        if rows is not None:
+            starts, lengths = starts[rows], lengths[rows]
+        if width is None:
+            width = lengths.max() if len(lengths) else 0
+        lengths = np.minimum(lengths, width)
+        if not width:
+            return np.zeros((len(starts), 0), dtype=np.uint8), lengths
+        pos = np.arange(width)
+        inside = pos < lengths[:, None]
+        matrix = self.data[np.where(inside, starts[:, None] + pos, 0)]
+        matrix[~inside] = 0
+        return matrix, lengths
+
+    def get(self, line, i):
+        """Returns one of the lines of a record
+
+        Parameters
+        ----------
+        line : int
+            The line: 0 for the header, 1 for the sequence, 3 for the quality
+        i : int
+            The index of the record in the batch
+
+        Returns
+        -------
+        bytes
+            The line
+        """
+        return self.data[self.starts[i, line]:self.ends[i, line]].tobytes()
+
+    def record(self, i):
+        """Returns a record
+
+        Parameters
+        ----------
+        i : int
+            The index of the record in the batch
+
+        Returns
+        -------
+        bytes, bytes, bytes
+            The record header, sequence and ASCII encoded quality
+        """
+        return self.get(0, i), self.get(1, i), self.get(3, i)
+
+
+def _find_fastq_records(data, start, end, final):
+    """Locates the complete FASTQ records of `data[start:end]`
+
+    Parameters
+    ----------
+    data : np.array of np.uint8
+        The buffer
+    start, end : int
+        The region of `data` to search
+    final : bool
+        Whether the region ends at the end of the file
+
+    Returns
+    -------
+    np.array of int, np.array of int, np.array of int
+        The position where each line of the records starts, one record per
+        row, as expected by `FastqBatch`
+        The position where each line of the records ends
+        The position where the record after each of the records starts
+
+    Raises
+    ------
+    ValueError
+        If a record is not a valid FASTQ record
+    """
+    line_ends = np.flatnonzero(data[start:end] == ord('\n')) + start
+    if final and end > start and (not len(line_ends) or
+                                  line_ends[-1] != end - 1):
+        # The last line has no line terminator
+        line_ends = np.append(line_ends, end)
+    if not len(line_ends):
+        empty = np.zeros((0, 4), dtype=int)
+        return empty, empty, np.zeros(0, dtype=int)
+    line_starts = np.concatenate(([start], line_ends[:-1] + 1))
+    nexts = line_ends + 1
+    # Windows line terminators
+    line_ends = line_ends - ((line_ends > line_starts) &
+                             (data[np.maximum(line_ends - 1, 0)] == ord('\r')))
+    if final:
+        # Blank lines are allowed at the end of the file
+        not_blank = np.flatnonzero(line_ends > line_starts)
+        n_lines = not_blank[-1] + 1 if len(not_blank) else 0
+        if n_lines % 4:
+            i = n_lines - n_lines % 4
+            raise ValueError("Invalid FASTQ record: %s"
+                             % data[line_starts[i]:line_ends[i]].tobytes())
+        line_starts, line_ends = line_starts[:n_lines], line_ends[:n_lines]
+    n_records = len(line_starts) // 4
+    starts = line_starts[:4 * n_records].reshape(n_records, 4)
+    ends = line_ends[:4 * n_records].reshape(n_records, 4)
+    nexts = nexts[3:4 * n_records:4]
+
+    last = len(data) - 1
+    valid = ((data[np.minimum(starts[:, 0], last)] == ord('@')) &
+             (data[np.minimum(starts[:, 2], last)] == ord('+')) &
+             (ends[:, 0] > starts[:, 0]) & (ends[:, 2] > starts[:, 2]))
+    if not valid.all():
+        i = np.flatnonzero(~valid)[0]
+        raise ValueError("Invalid FASTQ record: %s"
+                         % data[starts[i, 0]:ends[i, 0]].tobytes())
+    starts[:, 0] += 1
+    return starts, ends, nexts
+
+
+def _batches_of(data, starts, ends, batch_size):
+    """Splits the records found by `_find_fastq_records` in batches
+
+    Parameters
+    ----------
+    data : np.array of np.uint8
+        The buffer
+    starts, ends : np.array of int
+        The start and end of each line of the records
+    batch_size : int
+        The number of records of each batch
+
+    Returns
+    -------
+    list of FastqBatch
+        The batches
+    """
+    return [FastqBatch(data, starts[i:i + batch_size], ends[i:i + batch_size])
+            for i in range(0, len(starts), batch_size)]
+
+
+def read_fastq_batches(fp, batch_size=10000):
+    """Yields the records of a FASTQ file, that may be gzipped, in batches
+
+    Parameters
+    ----------
+    fp : str
+        The FASTQ filepath
+    batch_size : int, optional
+        The number of records of each batch. All the batches but the last one
+        have exactly `batch_size` records, so the batches of two files with
+        the same number of records can be zipped
+
+    Yields
+    ------
+    FastqBatch
+        The records
+
+    Raises
+    ------
+    ValueError
+        If a record is not a valid FASTQ record
+
+    Notes
+    -----
+    Uncompressed files are memory mapped and gzipped files are decompressed,
+    in parallel if they are BGZF compressed, in blocks of `FASTQ_BLOCK_SIZE`
+    bytes. The record boundaries are located with NumPy and the records are
+    not copied out of the buffer. Contrary to `parse_fastq`, blank lines are
+    only allowed at the end of the file.
+    """
+    if fp.endswith('.gz'):
+        with open_gzip(fp) as gz:
+            buf = b''
+            final = False
+            while not final:
+                block = gz.read(FASTQ_BLOCK_SIZE)
+                final = not block
+                buf += block
+                data = np.frombuffer(buf, dtype=np.uint8)
+                starts, ends, nexts = _find_fastq_records(
+                    data, 0, len(data), final)
+                n = len(starts)
+                if not final:
+                    n -= n % batch_size
+                    if not n:
+                        continue
+                for batch in _batches_of(data, starts[:n], ends[:n],
+                                         batch_size):
+                    yield batch
+                if not final:
+                    buf = buf[nexts[n - 1]:]
+        return
+
+    with open(fp, 'rb') as f:
+        size = fstat(f.fileno()).st_size
+        if not size:
+            return
+        mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+        data = np.frombuffer(mm, dtype=np.uint8)
+        pos = 0
+        window = FASTQ_BLOCK_SIZE
+        while pos < size:
+            end = min(pos + window, size)
+            final = end == size
+            starts, ends, nexts = _find_fastq_records(data, pos, end, final)
+            n = len(starts)
+            if not final:
+                n -= n % batch_size
+                if not n:
+                    # Not even a batch fits in the window
+                    window *= 2
+                    continue
+            for batch in _batches_of(data, starts[:n], ends[:n],
+                                     batch_size):
+                yield batch
+            if not n:
+                break
+            pos = nexts[n - 1]
+            window = FASTQ_BLOCK_SIZE
+            if MADV_DONTNEED is not None:
+                # The pages already read are released, so the resident
+                # memory doesn't grow with the file size. They are read
+                # back from the file if a batch still uses them
+                mm.madvise(MADV_DONTNEED, 0, pos - pos % PAGESIZE)
+        del data
+        try:
+            mm.close()
+        except BufferError:
+            # Some batches are still in use, the map is closed once they
+            # are garbage collected
+            pass
+
+
+def count_fastq_records(fp):
+    """Counts the records of a FASTQ file, that may be gzipped
+
+    Parameters
+    ----------
+    fp : str
+        The FASTQ filepath
+
+    Returns
+    -------
+    int
+        The number of records in `fp`
+    """
+    lines = 0
+    last = b'\n'
+    with _open_fastq(fp) as f:
+        for block in iter(partial(f.read, COPY_BUFFER_SIZE), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        lines += 1
+    return lines // 4
+
+
+def _copy_lines(in_f, out_f, n_lines, leftover):
+    """Copies the next `n_lines` lines of `in_f` to `out_f`
+
+    Parameters
+    ----------
+    in_f : file
+        The input file, opened in binary mode
+    out_f : file
+        The output file, opened in binary mode
+    n_lines : int
+        The number of lines to copy
+    leftover : bytes
+        The data already read from `in_f` that has not been copied yet
+
+    Returns
+    -------
+    bytes
+        The data read from `in_f` that has not been copied
+
+    Raises
+    ------
+    ValueError
+        If `in_f` has less than `n_lines` lines
+    """
+    last = b'\n'
+    while n_lines > 0:
+        block = leftover or in_f.read(COPY_BUFFER_SIZE)
+        leftover = b''
+        if not block:
+            if n_lines == 1 and last != b'\n':
+                # The last line of the file has no line break
+                out_f.write(b'\n')
+                break
+            raise ValueError("%s has %d lines less than expected"
+                             % (in_f.name, n_lines))
+        count = block.count(b'\n')
+        if count < n_lines:
+            out_f.write(block)
+            n_lines -= count
+            last = block[-1:]
+        else:
+            pos = -1
+            for _ in range(n_lines):
+                pos = block.index(b'\n', pos + 1)
+            out_f.write(block[:pos + 1])
+            leftover = block[pos + 1:]
+            n_lines = 0
+    return leftover
+
+
+def split_fastq_pair(forward_fp, barcode_fp, out_dir, num_chunks):
+    """Splits a pair of forward and barcode FASTQ files in chunks
+
+    Parameters
+    ----------
+    forward_fp : str
+        The forward reads FASTQ filepath, that may be gzipped
+    barcode_fp : str
+        The barcode reads FASTQ filepath, that may be gzipped
+    out_dir : str
+        The directory where the chunks are written
+    num_chunks : int
+        The number of chunks
+
+    Returns
+    -------
+    list of (str, str)
+        The forward and barcode filepaths of each chunk, in the order of the
+        records in the original files
+
+    Raises
+    ------
+    ValueError
+        If the forward and barcode files have a different number of records
+
+    Notes
+    -----
+    The chunks hold consecutive records, so processing them in order is
+    equivalent to processing the original files. All the chunks have the same
+    number of records (+/- 1) and the n-th forward chunk has the same reads
+    than the n-th barcode chunk. If there are less records than `num_chunks`,
+    less chunks are created, and if the files are empty they are not split.
+    """
+    n = count_fastq_records(barcode_fp)
+    sizes = [n // num_chunks + (i < n % num_chunks)
+             for i in range(num_chunks)]
+    sizes = [size for size in sizes if size]
+    if len(sizes) < 2:
+        return [(forward_fp, barcode_fp)]
+
+    if not exists(out_dir):
+        makedirs(out_dir)
+    chunks = [(join(out_dir, 'forward_%d.fastq' % i),
+               join(out_dir, 'barcodes_%d.fastq' % i))
+              for i in range(1, len(sizes) + 1)]
+    for fp, chunk_fps in zip([forward_fp, barcode_fp], zip(*chunks)):
+        leftover = b''
+        with _open_fastq(fp) as in_f:
+            for chunk_fp, size in zip(chunk_fps, sizes):
+                with open(chunk_fp, 'wb') as out_f:
+                    leftover = _copy_lines(in_f, out_f, 4 * size, leftover)
+            if leftover.strip() or in_f.read(COPY_BUFFER_SIZE).strip():
+                raise ValueError("%s has more records than %s"
+                                 % (fp, barcode_fp))
+    return chunks
+
+
+# Number of records kept in memory by the demux writer before appending them
+# to the HDF5 datasets
+DEMUX_BUFFER_SIZE = 100000
+
+# HDF5 storage profiles of the demux file, keyed by name. Each profile
+# defines the number of sequences per chunk (None lets h5py choose them), the
+# compression filter and whether the shuffle filter is applied before it.
+# 'gzip' is the layout created by qiita_files.demux.to_hdf5
+DEMUX_STORAGE_PROFILES = {
+    'gzip': {'chunk_size': None, 'compression': 'gzip', 'shuffle': False},
+    'gzip_shuffle': {'chunk_size': 2048, 'compression': 'gzip',
+                     'shuffle': True},
+    'lzf': {'chunk_size': 2048, 'compression': 'lzf', 'shuffle': True},
+    'none': {'chunk_size': 2048, 'compression': None, 'shuffle': False}}
+
+# Number of quality scores per chunk of the quality datasets, when the
+# storage profile sets the chunk size
+QUAL_CHUNK_WIDTH = 64
+
+BARCODE_RE = re.compile(br'orig_bc=(\S+) new_bc=(\S+) bc_diffs=(\d+)')
+
+
+def _length_stats(counts):
+    """Computes the sequence length statistics stored in the demux file
+
+    Parameters
+    ----------
+    counts : dict of {int: int}
+        The number of sequences keyed by sequence length
+
+    Returns
+    -------
+    dict of {str: object}
+        The statistics, keyed by the demux attribute name. These are the same
+        statistics that qiita_files.demux.to_hdf5 computes over the full list
+        of lengths.
+    """
+    lengths = np.array(sorted(counts))
+    freqs = np.array([counts[length] for length in lengths])
+    n = freqs.sum()
+    mean = (lengths * freqs).sum() / float(n)
+    std = np.sqrt((freqs * (lengths - mean) ** 2).sum() / float(n))
+    cum_freqs = np.cumsum(freqs)
+
+    def nth(i):
+        return lengths[np.searchsorted(cum_freqs, i, side='right')]
+
+    hist, hist_edge = np.histogram(lengths, weights=freqs)
+    return {'n': n, 'max': lengths.max(), 'min': lengths.min(),
+            'mean': mean, 'median': (nth((n - 1) // 2) + nth(n // 2)) / 2.0,
+            'std': std, 'hist': hist, 'hist_edge': hist_edge}
+
+
+class DemuxWriter(object):
+    """Streams demultiplexed sequences into an HDF5 demux file
+
+    Parameters
+    ----------
+    h5file : h5py.File
+        The demux file, opened in write mode
+    buffer_size : int, optional
+        The number of sequences kept in memory before appending them to the
+        HDF5 datasets
+    max_barcode_length : int, optional
+        The length of the barcode datasets
+    storage : str, optional
+        The HDF5 storage profile, one of `DEMUX_STORAGE_PROFILES`
+
+    Raises
+    ------
+    ValueError
+        If `storage` is not a known storage profile
+
+    Notes
+    -----
+    The file has the same layout as the one created by
+    qiita_files.demux.to_hdf5, but the datasets are resizable and they are
+    extended as the sequences are written, so the file can be created while
+    the sequences are produced. The sequence widths grow with the longest
+    sequence seen, so the datasets end up with the same shapes and types as
+    the ones created by to_hdf5. The widths grow geometrically and are
+    narrowed to the longest sequence of each sample when the writer is
+    closed.
+    """
+    def __init__(self, h5file, buffer_size=DEMUX_BUFFER_SIZE,
+                 max_barcode_length=12, storage='gzip'):
+        if storage not in DEMUX_STORAGE_PROFILES:
+            raise ValueError(
+                "Unknown demux storage profile: %s. Please, choose a value "
+                "from %s" % (storage,
+                             ', '.join(sorted(DEMUX_STORAGE_PROFILES))))
+        self.h5file = h5file
+        self.profile = DEMUX_STORAGE_PROFILES[storage]
+        self.buffer_size = buffer_size
+        self.bc_dtype = '|S%d' % max_barcode_length
+        self.has_qual = None
+        self._buffers = {}
+        self._buffered = 0
+        self._lengths = {}
+        self._widths = {}
+
+    def write(self, header, seq, qual=None):
+        """Writes a single sequence
+
+        Parameters
+        ----------
+        header : bytes
+            The sequence header, in the `<sample>_<idx> orig_bc=<barcode>
+            new_bc=<barcode> bc_diffs=<errors>` format
+        seq : bytes
+            The sequence
+        qual : bytes, optional
+            The ASCII encoded quality (offset 33)
+        """
+        sample = header.split(None, 1)[0].rsplit(b'_', 1)[0]
+        match = BARCODE_RE.search(header)
+        if match:
+            bc_ori, bc_cor, bc_err = match.groups()
+        else:
+            bc_ori, bc_cor, bc_err = b'', b'', 0
+        if self.has_qual is None:
+            self.has_qual = qual is not None
+
+        self._buffers.setdefault(sample, []).append(
+            (seq, qual, bc_ori, bc_cor, int(bc_err)))
+        self._buffered += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def write_chunk(self, sample, seqs, quals, bc_ori, bc_cor, bc_err):
+        """Writes a chunk of sequences of a single sample
+
+        Parameters
+        ----------
+        sample : bytes
+            The sample
+        seqs : np.ndarray
+            The sequences, as a uint8 matrix padded with NULs
+        quals : np.ndarray or None
+            The PHRED qualities, as a uint8 matrix with the same shape as
+            `seqs`
+        bc_ori, bc_cor, bc_err : np.ndarray
+            The original barcodes, corrected barcodes and barcode errors
+
+        Notes
+        -----
+        The chunk is appended to the datasets without buffering, after the
+        sequences of the sample already written with `write`
+        """
+        if self.has_qual is None:
+            self.has_qual = quals is not None
+        if sample in self._buffers:
+            self.flush()
+        lens = (seqs != 0).sum(axis=1)
+        if not seqs.shape[1]:
+            seqs = np.zeros((len(seqs), 1), dtype=np.uint8)
+            if quals is not None:
+                quals = np.zeros((len(seqs), 1), dtype=np.uint8)
+        seqs = np.ascontiguousarray(seqs).view(
+            '|S%d' % seqs.shape[1]).ravel()
+        self._append(sample.decode('utf-8'), seqs, quals, lens,
+                     bc_ori.astype(self.bc_dtype),
+                     bc_cor.astype(self.bc_dtype), bc_err.astype(np.int64))
+
+    def flush(self):
+        """Appends the buffered sequences to the HDF5 datasets"""
+        for sample, records in self._buffers.items():
+            seqs, quals, bc_ori, bc_cor, bc_err = zip(*records)
+            lens = np.array([len(s) for s in seqs])
+            width = max(1, lens.max())
+            seqs = np.array(seqs, dtype='|S%d' % width)
+            if self.has_qual:
+                data = np.frombuffer(b''.join(quals), dtype=np.uint8) - 33
+                if data.size != lens.sum():
+                    raise ValueError("The sequence and quality lengths of "
+                                     "sample %s do not match" % sample)
+                quals = np.zeros((len(seqs), width), dtype=np.uint8)
+                quals[np.arange(width) < lens[:, None]] = data
+            else:
+                quals = None
+            self._append(sample.decode('utf-8'), seqs, quals, lens,
+                         np.array(bc_ori, dtype=self.bc_dtype),
+                         np.array(bc_cor, dtype=self.bc_dtype),
+                         np.array(bc_err, dtype=np.int64))
+        self._buffers = {}
+        self._buffered = 0
+
+    def _create_dataset(self, grp, name, shape, dtype):
+        """Creates an empty resizable dataset using the storage profile"""
+        chunk_size = self.profile['chunk_size']
+        if chunk_size is None:
+            chunks = True
+        elif len(shape) == 1:
+            chunks = (chunk_size,)
+        else:
+            chunks = (chunk_size, QUAL_CHUNK_WIDTH)
+        return grp.create_dataset(
+            name, shape=shape, maxshape=(None,) * len(shape), dtype=dtype,
+            chunks=chunks, compression=self.profile['compression'],
+            shuffle=self.profile['shuffle'])
+
+    def _create_group(self, sample, width):
+        """Creates the empty resizable datasets of `sample`"""
+        grp = self.h5file.create_group(sample)
+        self._create_dataset(grp, 'sequence', (0,), '|S%d' % width)
+        self._create_dataset(grp, 'barcode/original', (0,), self.bc_dtype)
+        self._create_dataset(grp, 'barcode/corrected', (0,), self.bc_dtype)
+        self._create_dataset(grp, 'barcode/error', (0,), np.int64)
+        if self.has_qual:
+            self._create_dataset(grp, 'qual', (0, width), np.uint8)
+        return grp
+
+    def _set_width(self, grp, width):
+        """Widens or narrows the sequence and quality datasets of `grp`"""
+        old = grp['sequence']
+        dtype = '|S%d' % width
+        new = self._create_dataset(grp, 'sequence_tmp', (0,), dtype)
+        new.resize(old.shape)
+        for i in range(0, old.shape[0], self.buffer_size):
+            new[i:i + self.buffer_size] = old[
+                i:i + self.buffer_size].astype(dtype)
+        del grp['sequence']
+        grp.move('sequence_tmp', 'sequence')
+        if 'qual' in grp:
+            grp['qual'].resize(width, axis=1)
+
+    def _append(self, sample, seqs, quals, lens, bc_ori, bc_cor, bc_err):
+        """Appends the arrays of a single sample to its datasets"""
+        width = seqs.dtype.itemsize
+        if sample not in self.h5file:
+            grp = self._create_group(sample, width)
+        else:
+            grp = self.h5file[sample]
+            current = grp['sequence'].dtype.itemsize
+            if width > current:
+                # The datasets are at least doubled, so on unsorted input the
+                # sequences are only copied a few times. They are narrowed to
+                # the longest sequence when the writer is closed
+                current = max(width, 2 * current)
+                self._set_width(grp, current)
+            if width < current:
+                seqs = seqs.astype('|S%d' % current)
+                if quals is not None:
+                    quals = np.pad(quals, ((0, 0), (0, current - width)),
+                                   'constant')
+        self._widths[sample] = max(width, self._widths.get(sample, 0))
+
+        start = grp['sequence'].shape[0]
+        end = start + len(seqs)
+        for name, data in [('sequence', seqs), ('barcode/original', bc_ori),
+                           ('barcode/corrected', bc_cor),
+                           ('barcode/error', bc_err), ('qual', quals)]:
+            if data is not None:
+                grp[name].resize(end, axis=0)
+                grp[name][start:end] = data
+
+        counts = self._lengths.setdefault(sample, {})
+        for length, count in zip(*np.unique(lens, return_counts=True)):
+            counts[length] = counts.get(length, 0) + count
+
+    def close(self):
+        """Flushes the buffered sequences and stores the length statistics
+
+        Returns
+        -------
+        int
+            The number of sequences written
+        """
+        self.flush()
+        for sample, width in self._widths.items():
+            if self.h5file[sample]['sequence'].dtype.itemsize > width:
+                self._set_width(self.h5file[sample], width)
+        totals = {}
+        for sample, counts in self._lengths.items():
+            self.h5file[sample].attrs.update(_length_stats(counts))
+            for length, count in counts.items():
+                totals[length] = totals.get(length, 0) + count
+        self.h5file.attrs['has-qual'] = bool(self.has_qual)
+        if not totals:
+            return 0
+        stats = _length_stats(totals)
+        self.h5file.attrs.update(stats)
+        return int(stats['n'])
+
+
+def write_demux(records, h5file, storage='gzip'):
+    """Writes the demultiplexed `records` to `h5file`
+
+    Parameters
+    ----------
+    records : iterable of (bytes, bytes, bytes)
+        The header, sequence and ASCII encoded quality of each record
+    h5file : h5py.File
+        The demux file, opened in write mode
+    storage : str, optional
+        The HDF5 storage profile, one of `DEMUX_STORAGE_PROFILES`
+
+    Returns
+    -------
+    int
+        The number of sequences written
+    """
+    writer = DemuxWriter(h5file, storage=storage)
+    for header, seq, qual in records:
+        writer.write(header, seq, qual)
+    return writer.close()
+
+
+def generate_demux_file(sl_out, records=None, storage='gzip'):
     """Creates the HDF5 demultiplexed file
 
     Parameters
     ----------
     sl_out : str
         Path to the output directory of split libraries
+    records : iterable of (bytes, bytes, bytes), optional
+        The demultiplexed records. If not provided, they are read from the
+        seqs.fastq file in `sl_out`. Passing the records as they are produced
+        (e.g. the ones yielded by `write_fastq`) allows creating the demux
+        file at the same time as the fastq file.
+    storage : str, optional
+        The HDF5 storage profile of the demux file, one of
+        `DEMUX_STORAGE_PROFILES`
 
     Returns
     -------
@@ -98,27 +1292,58 @@ def generate_demux_file(sl_out):
     ValueError
         If the split libraries output does not contain the demultiplexed fastq
         file
+        If there are no demultiplexed sequences
     """
-    fastq_fp = str(join(sl_out, 'seqs.fastq'))
-    if not exists(fastq_fp):
-        raise ValueError("The split libraries output directory does not "
-                         "contain the demultiplexed fastq file.")
-    elif stat(fastq_fp).st_size == 0:
-        raise ValueError("No sequences were demuxed. Check your parameters.")
-
     demux_fp = join(sl_out, 'seqs.demux')
-    with File(demux_fp, "w") as f:
-        to_hdf5(fastq_fp, f)
+    if records is None:
+        fastq_fp = str(join(sl_out, 'seqs.fastq'))
+        if not exists(fastq_fp):
+            raise ValueError("The split libraries output directory does not "
+                             "contain the demultiplexed fastq file.")
+        elif stat(fastq_fp).st_size == 0:
+            raise ValueError(
+                "No sequences were demuxed. Check your parameters.")
+        with open(fastq_fp, 'rb') as fh, File(demux_fp, "w") as f:
+            write_demux(parse_fastq(fh), f, storage)
+    else:
+        with File(demux_fp, "w") as f:
+            n = write_demux(records, f, storage)
+        if n == 0:
+            raise ValueError(
+                "No sequences were demuxed. Check your parameters.")
     return demux_fp
 
 
-def generate_artifact_info(sl_out):
+def compress_output(fp):
+    """Compresses an output file in parallel, replacing it
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath
+
+    Returns
+    -------
+    str
+        The compressed filepath, `fp` with a .gz extension. If the output was
+        written compressed, it is returned as is
+    """
+    gz_fp = fp + '.gz'
+    if not exists(gz_fp):
+        compress_file(fp, gz_fp)
+        remove(fp)
+    return gz_fp
+
+
+def generate_artifact_info(sl_out, compress=False):
     """Creates the artifact information to attach to the payload
 
     Parameters
     ----------
     sl_out : str
         Path to the split libraries output directory
+    compress : bool, optional
+        Whether the seqs.fna and seqs.fastq files are compressed
 
     Returns
     -------
@@ -130,8 +1355,13 @@ def generate_artifact_info(sl_out):
         - The list of filepaths with their artifact type
     """
     path_builder = partial(join, sl_out)
-    filepaths = [(path_builder('seqs.fna'), 'preprocessed_fasta'),
-                 (path_builder('seqs.fastq'), 'preprocessed_fastq'),
+    fna_fp = path_builder('seqs.fna')
+    fastq_fp = path_builder('seqs.fastq')
+    if compress:
+        fna_fp = compress_output(fna_fp)
+        fastq_fp = compress_output(fastq_fp)
+    filepaths = [(fna_fp, 'preprocessed_fasta'),
+                 (fastq_fp, 'preprocessed_fastq'),
                  (path_builder('seqs.demux'), 'preprocessed_demux'),
                  (path_builder('split_library_log.txt'), 'log')]
     return [ArtifactInfo('demultiplexed', 'Demultiplexed', filepaths)]
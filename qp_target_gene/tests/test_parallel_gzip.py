@@ -0,0 +1,129 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from gzip import GzipFile
+import zlib
+
+import qp_target_gene.parallel_gzip as parallel_gzip
+from qp_target_gene.parallel_gzip import (
+    compress_bgzf, is_bgzf, open_gzip, compress_file, decompress_file,
+    BGZF_BLOCK_SIZE, BGZF_EOF)
+
+
+class ParallelGzipTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        # Large enough to have several blocks and chunks
+        self.data = b''.join(
+            b'@read_%d\n%s\n+\n%s\n'
+            % (i, bytes(bytearray(33 + (i * 7 + j) % 94 for j in range(100))),
+               b'I' * 100)
+            for i in range(3000))
+        self._chunk_size = parallel_gzip.GZIP_CHUNK_SIZE
+        parallel_gzip.GZIP_CHUNK_SIZE = 100000
+
+    def tearDown(self):
+        parallel_gzip.GZIP_CHUNK_SIZE = self._chunk_size
+        rmtree(self.out_dir)
+
+    def _read_gzip(self, fp):
+        with GzipFile(fp, 'rb') as f:
+            return f.read()
+
+    def test_compress_bgzf(self):
+        obs = compress_bgzf(self.data)
+        self.assertEqual(zlib.decompress(obs, 31),
+                         self.data[:BGZF_BLOCK_SIZE])
+        self.assertEqual(compress_bgzf(b''), b'')
+        # The EOF block is an empty BGZF block
+        self.assertEqual(zlib.decompress(BGZF_EOF, 31), b'')
+
+    def test_open_gzip_write(self):
+        fp = join(self.out_dir, 'seqs.fastq.gz')
+        with open_gzip(fp, 'wb', num_jobs=3) as f:
+            for i in range(0, len(self.data), 1000):
+                f.write(self.data[i:i + 1000])
+        self.assertTrue(is_bgzf(fp))
+        self.assertEqual(self._read_gzip(fp), self.data)
+        with open(fp, 'rb') as f:
+            self.assertTrue(f.read().endswith(BGZF_EOF))
+
+        # Empty files only have the EOF block
+        with open_gzip(fp, 'wb') as f:
+            pass
+        with open(fp, 'rb') as f:
+            self.assertEqual(f.read(), BGZF_EOF)
+        self.assertEqual(self._read_gzip(fp), b'')
+
+    def test_open_gzip_read_bgzf(self):
+        fp = join(self.out_dir, 'seqs.fastq.gz')
+        with open_gzip(fp, 'wb') as f:
+            f.write(self.data)
+        with open_gzip(fp, num_jobs=3) as f:
+            self.assertEqual(f.read(), self.data)
+        with open_gzip(fp, num_jobs=2) as f:
+            lines = list(f)
+        self.assertEqual(len(lines), 4 * 3000)
+        self.assertEqual(b''.join(lines), self.data)
+
+    def test_open_gzip_read_gzip(self):
+        fp = join(self.out_dir, 'seqs.fastq.gz')
+        with GzipFile(fp, 'wb') as f:
+            f.write(self.data)
+        self.assertFalse(is_bgzf(fp))
+        with open_gzip(fp, num_jobs=3) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_open_gzip_read_multi_member(self):
+        fp = join(self.out_dir, 'seqs.fastq.gz')
+        half = len(self.data) // 2
+        with open(fp, 'wb') as f:
+            for data in [self.data[:half], self.data[half:]]:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                f.write(compressor.compress(data) + compressor.flush())
+            # trailing zeros are ignored, as GzipFile does
+            f.write(b'\x00' * 16)
+        with open_gzip(fp) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_open_gzip_read_truncated(self):
+        fp = join(self.out_dir, 'seqs.fastq.gz')
+        with GzipFile(fp, 'wb') as f:
+            f.write(self.data)
+        with open(fp, 'rb') as f:
+            data = f.read()
+        with open(fp, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        with self.assertRaises(EOFError):
+            with open_gzip(fp) as f:
+                f.read()
+
+    def test_open_gzip_error(self):
+        with self.assertRaisesRegexp(ValueError, 'Mode not supported: ab'):
+            open_gzip(join(self.out_dir, 'seqs.fastq.gz'), 'ab')
+
+    def test_compress_decompress_file(self):
+        fp = join(self.out_dir, 'seqs.fna')
+        with open(fp, 'wb') as f:
+            f.write(self.data)
+        compress_file(fp, fp + '.gz', num_jobs=2)
+        self.assertTrue(is_bgzf(fp + '.gz'))
+        self.assertEqual(self._read_gzip(fp + '.gz'), self.data)
+
+        out_fp = join(self.out_dir, 'out.fna')
+        decompress_file(fp + '.gz', out_fp, num_jobs=2)
+        with open(out_fp, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,21 +7,32 @@
 # -----------------------------------------------------------------------------
 
 from unittest import main
-from os.path import isdir, exists, join
-from os import remove, close, mkdir
+from os.path import isdir, exists, join, getmtime, getsize
+from os import remove, close, mkdir, makedirs, utime, listdir, environ
 from shutil import rmtree
 from tempfile import mkstemp, mkdtemp
 from json import dumps
 from functools import partial
 from glob import glob
+from gzip import GzipFile
+from hashlib import md5
+from collections import OrderedDict
+from fcntl import flock, LOCK_SH
+from tarfile import open as taropen
 
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
+from qp_target_gene.parallel_gzip import is_bgzf
 from qp_target_gene.pick_otus import (
     write_parameters_file, generate_artifact_info,
     generate_pick_closed_reference_otus_cmd, generate_sortmerna_tgz,
-    pick_closed_reference_otus)
+    pick_closed_reference_otus, count_fasta_records, count_sample_records,
+    assign_samples, split_fasta, generate_sharded_pick_otus_cmds,
+    merge_otu_maps, generate_merge_shards_cmd, cached_sortmerna_index,
+    evict_sortmerna_indexes, dereplicate_fasta, expand_otu_map,
+    generate_expand_otus_cmd, OTUCache, get_otu_cache,
+    filter_cached_sequences, cache_otu_assignments)
 
 CLIENT_ID = '19ndkO3oMKsoChjVVWluF7QkxHRfYhTKSFbAVt8IhK7gZgDaO4'
 CLIENT_SECRET = ('J7FfQ7CQdOxuKhQAf1eoGgBAE81Ns8Gu3EKaWFm3IO2JKh'
@@ -36,6 +47,7 @@ class PickOTUsTests(PluginTestCase):
             'reference-tax': '/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt',
             "sortmerna_e_value": 1, "sortmerna_max_pos": 10000,
             "similarity": 0.97, "sortmerna_coverage": 0.97, "threads": 1,
+            "shards": 1, "shard_by_sample": False, "dereplicate": False,
             "input_data": 2}
 
     def tearDown(self):
@@ -58,6 +70,96 @@ class PickOTUsTests(PluginTestCase):
         exp = EXP_PARAMS
         self.assertEqual(obs, exp)
 
+        self.parameters['sortmerna_db'] = '/tmp/cache/reference'
+        write_parameters_file(fp, self.parameters)
+        with open(fp) as f:
+            obs = f.read()
+        self.assertEqual(
+            obs, EXP_PARAMS + "pick_otus:sortmerna_db\t/tmp/cache/reference\n")
+
+    def test_cached_sortmerna_index(self):
+        cache_dir = mkdtemp()
+        self._clean_up_files.append(cache_dir)
+        ref_fp = join(cache_dir, 'ref.fna')
+        with open(ref_fp, 'w') as f:
+            f.write(REF_SEQ)
+
+        # Without a cache directory QIIME builds the index
+        with cached_sortmerna_index(ref_fp, 10000) as obs:
+            self.assertIsNone(obs)
+
+        index_dir = join(cache_dir, 'sortmerna_indexes',
+                         'dc6027976b50f2211848eadbabd1cac7_10000')
+        with cached_sortmerna_index(ref_fp, 10000, cache_dir) as obs:
+            self.assertEqual(obs, join(index_dir, 'reference'))
+            self.assertTrue(glob(obs + '*'))
+        marker = join(index_dir, 'complete')
+        utime(marker, (0, 0))
+        index_files = {fp: getmtime(fp) for fp in glob(obs + '*')}
+
+        # The index is reused, also for a copy of the reference
+        copy_fp = join(cache_dir, 'copy.fna')
+        with open(copy_fp, 'w') as f:
+            f.write(REF_SEQ)
+        with cached_sortmerna_index(copy_fp, 10000, cache_dir) as obs:
+            self.assertEqual(obs, join(index_dir, 'reference'))
+        self.assertEqual({fp: getmtime(fp) for fp in glob(obs + '*')},
+                         index_files)
+        # and its last use is updated
+        self.assertTrue(getmtime(marker) > 0)
+
+        # Other indexing parameters have their own index, and the least
+        # recently used index is evicted if the cache is too large
+        with cached_sortmerna_index(ref_fp, 500, cache_dir, 1) as obs:
+            self.assertTrue(obs.endswith('_500/reference'))
+        self.assertFalse(exists(index_dir))
+        self.assertTrue(exists(obs + '.stats'))
+
+    def test_cached_sortmerna_index_error(self):
+        cache_dir = mkdtemp()
+        self._clean_up_files.append(cache_dir)
+        ref_fp = join(cache_dir, 'ref.fna')
+        with open(ref_fp, 'w') as f:
+            f.write("not a fasta file")
+        with self.assertRaisesRegexp(RuntimeError,
+                                     'Error building the SortMeRNA index'):
+            with cached_sortmerna_index(ref_fp, 10000, cache_dir):
+                pass
+        # Nothing is left in the cache but the lock
+        self.assertEqual(listdir(join(cache_dir, 'sortmerna_indexes')),
+                         ['c86ead9fe898d020b8cea5c40a89b152_10000.lock'])
+
+    def test_evict_sortmerna_indexes(self):
+        index_root = mkdtemp()
+        self._clean_up_files.append(index_root)
+        for i, name in enumerate(['a', 'b', 'c', 'd']):
+            makedirs(join(index_root, name))
+            with open(join(index_root, name, 'reference.stats'), 'w') as f:
+                f.write('x' * 100)
+            marker = join(index_root, name, 'complete')
+            open(marker, 'w').close()
+            utime(marker, (i, i))
+        # Incomplete indexes are not evicted
+        makedirs(join(index_root, 'tmpXXXX.tmp'))
+
+        # 'a' is the least recently used, but it is kept
+        evict_sortmerna_indexes(index_root, 300, keep='a')
+        self.assertEqual(sorted(listdir(index_root)),
+                         ['a', 'b.lock', 'c', 'd', 'tmpXXXX.tmp'])
+
+        # 'a' is in use by another job
+        with open(join(index_root, 'a.lock'), 'a') as lock:
+            flock(lock, LOCK_SH)
+            evict_sortmerna_indexes(index_root, 100)
+        self.assertEqual(sorted(listdir(index_root)),
+                         ['a', 'a.lock', 'b.lock', 'c.lock', 'd.lock',
+                          'tmpXXXX.tmp'])
+
+        evict_sortmerna_indexes(index_root, 0)
+        self.assertEqual(sorted(listdir(index_root)),
+                         ['a.lock', 'b.lock', 'c.lock', 'd.lock',
+                          'tmpXXXX.tmp'])
+
     def test_generate_pick_closed_reference_otus_cmd(self):
         output_dir = mkdtemp()
         self._clean_up_files.append(output_dir)
@@ -75,11 +177,375 @@ class PickOTUsTests(PluginTestCase):
         self.assertEqual(obs, exp)
         self.assertEqual(obs_dir, join(output_dir, 'cr_otus'))
 
+    def test_generate_pick_closed_reference_otus_cmd_gz(self):
+        output_dir = mkdtemp()
+        self._clean_up_files.append(output_dir)
+        seqs_fp = join(output_dir, 'seqs.fna.gz')
+        with GzipFile(seqs_fp, 'wb') as f:
+            f.write(b'>s1_0\nACGT\n')
+        filepaths = {'preprocessed_fasta': [seqs_fp],
+                     'preprocessed_demux': ['/directory/seqs.demux']}
+
+        obs, obs_dir = generate_pick_closed_reference_otus_cmd(
+            filepaths, output_dir, self.parameters)
+        # The gzipped file is decompressed in the output directory
+        self.assertTrue(obs.startswith(
+            "pick_closed_reference_otus.py -i %s/seqs.fna " % output_dir))
+        with open(join(output_dir, 'seqs.fna'), 'rb') as f:
+            self.assertEqual(f.read(), b'>s1_0\nACGT\n')
+
+    def _write_reads(self, fp):
+        with open(fp, 'w') as f:
+            f.write(READS + SKB_READS)
+
+    def _read_fastas(self, fps):
+        data = []
+        for fp in fps:
+            with open(fp, 'rb') as f:
+                data.append(f.read())
+        return data
+
+    def test_count_fasta_records(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fp = join(out_dir, 'seqs.fna')
+        self._write_reads(fp)
+        self.assertEqual(count_fasta_records(fp), 14)
+        with GzipFile(fp + '.gz', 'wb') as f:
+            f.write((READS + SKB_READS).encode('ascii'))
+        self.assertEqual(count_fasta_records(fp + '.gz'), 14)
+        with open(fp, 'w') as f:
+            f.write('')
+        self.assertEqual(count_fasta_records(fp), 0)
+
+    def test_count_sample_records(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fp = join(out_dir, 'seqs.fna')
+        self._write_reads(fp)
+        obs = count_sample_records(fp)
+        self.assertEqual(list(obs.items()),
+                         [(b'1001.SKB1', 11), (b'1001.SKB2', 2),
+                          (b'1001.SKB3', 1)])
+
+    def test_assign_samples(self):
+        counts = OrderedDict([(b's1', 5), (b's2', 10), (b's3', 5),
+                              (b's4', 1)])
+        self.assertEqual(assign_samples(counts, 2),
+                         {b's2': 0, b's1': 1, b's3': 1, b's4': 0})
+        self.assertEqual(assign_samples(counts, 5),
+                         {b's2': 0, b's1': 1, b's3': 2, b's4': 3})
+
+    def test_split_fasta(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fp = join(out_dir, 'seqs.fna')
+        self._write_reads(fp)
+        with open(fp, 'rb') as f:
+            exp = f.read()
+
+        out_fps = [join(out_dir, 'shard_%d.fna' % i) for i in range(3)]
+        self.assertEqual(split_fasta(fp, out_fps), [4, 5, 5])
+        # The shards are consecutive
+        self.assertEqual(b''.join(self._read_fastas(out_fps)), exp)
+
+        # Whole samples, each shard keeps the order of the file
+        self.assertEqual(split_fasta(fp, out_fps, by_sample=True),
+                         [11, 2, 1])
+        lines = exp.splitlines(True)
+        records = [lines[i] + lines[i + 1] for i in range(0, len(lines), 2)]
+        obs = self._read_fastas(out_fps)
+        for shard, sample in enumerate([b'SKB1', b'SKB2', b'SKB3']):
+            self.assertEqual(obs[shard], b''.join(
+                r for r in records if r.startswith(b'>1001.%s_' % sample)))
+
+        # More shards than records
+        out_fps = [join(out_dir, 'shard_%d.fna' % i) for i in range(20)]
+        obs = split_fasta(fp, out_fps)
+        self.assertEqual(sum(obs), 14)
+        self.assertEqual(max(obs), 1)
+        self.assertEqual(b''.join(self._read_fastas(out_fps)), exp)
+
+    def test_generate_sharded_pick_otus_cmds(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        seqs_fp = join(out_dir, 'seqs.fna.gz')
+        with GzipFile(seqs_fp, 'wb') as f:
+            f.write((READS + SKB_READS).encode('ascii'))
+        filepaths = {'preprocessed_fasta': [seqs_fp],
+                     'preprocessed_demux': ['/directory/seqs.demux']}
+        self.parameters['shards'] = 2
+        self.parameters['sortmerna_db'] = '/tmp/cache/reference'
+
+        obs_cmds, obs_outs, obs_dir = generate_sharded_pick_otus_cmds(
+            filepaths, out_dir, self.parameters)
+        exp_outs = [join(out_dir, 'shards', '0', 'cr_otus'),
+                    join(out_dir, 'shards', '1', 'cr_otus')]
+        exp_cmds = [
+            "pick_closed_reference_otus.py -i {0}/shards/{1}/seqs.fna "
+            "-r /databases/gg/13_8/rep_set/97_otus.fasta -o "
+            "{0}/shards/{1}/cr_otus -p {0}/cr_params.txt -t "
+            "/databases/gg/13_8/taxonomy/97_otu_taxonomy.txt".format(
+                out_dir, i) for i in range(2)]
+        self.assertEqual(obs_cmds, exp_cmds)
+        self.assertEqual(obs_outs, exp_outs)
+        self.assertEqual(obs_dir, join(out_dir, 'cr_otus'))
+        self.assertEqual(
+            b''.join(self._read_fastas(
+                [join(out_dir, 'shards', str(i), 'seqs.fna')
+                 for i in range(2)])),
+            (READS + SKB_READS).encode('ascii'))
+        with open(join(out_dir, 'cr_params.txt')) as f:
+            self.assertEqual(
+                f.read(),
+                EXP_PARAMS + "pick_otus:sortmerna_db\t/tmp/cache/reference\n")
+
+    def test_generate_sharded_pick_otus_cmds_sortmerna_db(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        seqs_fp = join(out_dir, 'seqs.fna')
+        with open(seqs_fp, 'w') as f:
+            f.write(READS + SKB_READS)
+        ref_fp = join(out_dir, 'ref.fna')
+        with open(ref_fp, 'w') as f:
+            f.write(REF_SEQ)
+        self.parameters['reference-seq'] = ref_fp
+        self.parameters['shards'] = 3
+
+        # The index is built once, and used by all the shards
+        obs_cmds, _, _ = generate_sharded_pick_otus_cmds(
+            {'preprocessed_fasta': [seqs_fp]}, out_dir, self.parameters)
+        sortmerna_db = join(out_dir, 'shards', 'sortmerna_indexes',
+                            'reference')
+        self.assertTrue(glob(sortmerna_db + '*'))
+        self.assertEqual(len(obs_cmds), 3)
+        for cmd in obs_cmds:
+            with open(cmd.split(' -p ')[1].split()[0]) as f:
+                self.assertIn(
+                    "pick_otus:sortmerna_db\t%s\n" % sortmerna_db, f.read())
+
+    def test_merge_otu_maps(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fps = [join(out_dir, 'map_%d.txt' % i) for i in range(2)]
+        with open(fps[0], 'w') as f:
+            f.write("367523\ts1_0\ts1_2\n187144\ts1_1\n")
+        with open(fps[1], 'w') as f:
+            f.write("836974\ts2_0\n367523\ts2_1\ts2_2\n")
+        out_fp = join(out_dir, 'seqs_otus.txt')
+        merge_otu_maps(fps, out_fp)
+        with open(out_fp) as f:
+            self.assertEqual(f.read(), "367523\ts1_0\ts1_2\ts2_1\ts2_2\n"
+                                       "187144\ts1_1\n836974\ts2_0\n")
+
+    def test_generate_merge_shards_cmd(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        shard_outs = []
+        for i in range(2):
+            shard_out = join(out_dir, 'shards', str(i), 'cr_otus')
+            otus_dir = join(shard_out, 'sortmerna_picked_otus')
+            makedirs(otus_dir)
+            with open(join(otus_dir, 'seqs_otus.txt'), 'w') as f:
+                f.write("367523\ts%d_0\n" % i)
+            with open(join(otus_dir, 'seqs_failures.txt'), 'w') as f:
+                f.write("s%d_1\n" % i)
+            with open(join(shard_out, 'log_2016010%d.txt' % i), 'w') as f:
+                f.write("shard %d\n" % i)
+            shard_outs.append(shard_out)
+        pick_out = join(out_dir, 'cr_otus')
+
+        obs = generate_merge_shards_cmd(shard_outs, pick_out, '/tmp/tax.txt')
+        exp = ("make_otu_table.py -i {0}/sortmerna_picked_otus/seqs_otus.txt "
+               "-t /tmp/tax.txt -o {0}/otu_table.biom".format(pick_out))
+        self.assertEqual(obs, exp)
+        pb = partial(join, pick_out)
+        with open(pb('sortmerna_picked_otus', 'seqs_otus.txt')) as f:
+            self.assertEqual(f.read(), "367523\ts0_0\ts1_0\n")
+        with open(pb('sortmerna_picked_otus', 'seqs_failures.txt')) as f:
+            self.assertEqual(f.read(), "s0_1\ns1_1\n")
+        with open(pb('log_20160100.txt')) as f:
+            self.assertEqual(f.read(), "shard 0\nshard 1\n")
+
+    def test_dereplicate_fasta(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        seqs_fp = join(out_dir, 'seqs.fna.gz')
+        with GzipFile(seqs_fp, 'wb') as f:
+            f.write((READS + SKB_READS).encode('ascii'))
+        out_fp = join(out_dir, 'uniques.fna')
+        map_fp = join(out_dir, 'dereplication_map.txt')
+
+        self.assertEqual(dereplicate_fasta(seqs_fp, out_fp, map_fp), (14, 10))
+        with open(out_fp) as f:
+            obs = f.read().split('\n')
+        self.assertEqual(obs[:2], [
+            '>derep_0',
+            'TACGTAGGTGGCAAGCGTTGTCCGGAATTATTGGGCGTAAAGCGCGCGCAGGCGGTCCTTTAAGT'
+            'CTGATGTGAAAGCCCACGGCTTAACCGTGGAGGGTCATTGGAAACTGGAGGACTTGAGTACAGAA'
+            'GAGGAGAGAGGAATTCCACGT'])
+        self.assertEqual(obs[2::2][:-1],
+                         ['>derep_%d' % i for i in range(1, 10)])
+        with open(map_fp) as f:
+            obs = f.read()
+        exp = ''.join('derep_%d\t1001.SKB1_%d\n' % (i, i) for i in range(10))
+        exp += ('derep_1\t1001.SKB2_0\nderep_7\t1001.SKB1_10\n'
+                'derep_9\t1001.SKB3_0\nderep_0\t1001.SKB2_1\n')
+        self.assertEqual(obs, exp)
+
+    def test_expand_otu_map(self):
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        map_fp = join(out_dir, 'seqs_otus.txt')
+        with open(map_fp, 'w') as f:
+            f.write("836974\tderep_2\n367523\tderep_0\tderep_3\n")
+        failures_fp = join(out_dir, 'seqs_failures.txt')
+        with open(failures_fp, 'w') as f:
+            f.write("derep_1\n")
+        derep_map_fp = join(out_dir, 'dereplication_map.txt')
+        with open(derep_map_fp, 'w') as f:
+            f.write("derep_0\ts1_0\nderep_1\ts1_1\nderep_0\ts2_0\n"
+                    "derep_2\ts2_1\nderep_3\ts1_2\nderep_1\ts3_0\n")
+
+        expand_otu_map(map_fp, failures_fp, derep_map_fp)
+        with open(map_fp) as f:
+            self.assertEqual(f.read(), "836974\ts2_1\n"
+                                       "367523\ts1_0\ts2_0\ts1_2\n")
+        with open(failures_fp) as f:
+            self.assertEqual(f.read(), "s1_1\ns3_0\n")
+
+        # The OTUs of the sequences that were not picked
+        with open(map_fp, 'w') as f:
+            f.write("836974\tderep_2\n")
+        expand_otu_map(map_fp, failures_fp, derep_map_fp,
+                       cached={b'derep_0': b'367523', b'derep_1': None,
+                               b'derep_3': b'187144'})
+        with open(map_fp) as f:
+            obs = f.read().splitlines()
+        self.assertEqual(obs[0], "836974\ts2_1")
+        self.assertEqual(sorted(obs[1:]), ["187144\ts1_2",
+                                           "367523\ts1_0\ts2_0"])
+        with open(failures_fp) as f:
+            self.assertEqual(f.read(), "s1_1\ns3_0\n")
+
+    def test_generate_expand_otus_cmd(self):
+        pick_out = mkdtemp()
+        self._clean_up_files.append(pick_out)
+        otus_dir = join(pick_out, 'sortmerna_picked_otus')
+        mkdir(otus_dir)
+        with open(join(otus_dir, 'seqs_otus.txt'), 'w') as f:
+            f.write("367523\tderep_0\n")
+        log_fp = join(pick_out, 'log_20160101.txt')
+        with open(log_fp, 'w') as f:
+            f.write("Logging started\n")
+        derep_map_fp = join(pick_out, 'dereplication_map.txt')
+        with open(derep_map_fp, 'w') as f:
+            f.write("derep_0\ts1_0\nderep_0\ts2_0\n")
+
+        obs = generate_expand_otus_cmd(pick_out, derep_map_fp,
+                                       '/tmp/tax.txt', (2, 1))
+        exp = ("make_otu_table.py -i {0}/sortmerna_picked_otus/seqs_otus.txt "
+               "-t /tmp/tax.txt -o {0}/otu_table.biom".format(pick_out))
+        self.assertEqual(obs, exp)
+        with open(join(otus_dir, 'seqs_otus.txt')) as f:
+            self.assertEqual(f.read(), "367523\ts1_0\ts2_0\n")
+        with open(log_fp) as f:
+            self.assertEqual(f.read(), "Logging started\n\nDereplicated 2 "
+                                       "sequences into 1 unique sequences\n")
+
+    def _otu_cache(self):
+        cache_dir = mkdtemp()
+        self._clean_up_files.append(cache_dir)
+        ref_fp = join(cache_dir, 'ref.fna')
+        with open(ref_fp, 'w') as f:
+            f.write(REF_SEQ)
+        self.parameters['reference-seq'] = ref_fp
+        return cache_dir
+
+    def test_otu_cache(self):
+        cache_dir = self._otu_cache()
+        self.assertIsNone(get_otu_cache(self.parameters))
+
+        cache = get_otu_cache(self.parameters, cache_dir)
+        self.assertTrue(exists(join(cache_dir, 'otu_assignments.sqlite')))
+        self.assertEqual(cache.lookup([b'a' * 16]), {})
+        cache.store([(b'a' * 16, b'367523'), (b'b' * 16, None)])
+        self.assertEqual(cache.lookup([b'a' * 16, b'b' * 16, b'c' * 16]),
+                         {b'a' * 16: b'367523', b'b' * 16: None})
+        cache.close()
+
+        # The assignments are shared by the jobs with the same reference and
+        # parameters
+        cache = get_otu_cache(dict(self.parameters, threads=4), cache_dir)
+        self.assertEqual(cache.lookup([b'a' * 16]), {b'a' * 16: b'367523'})
+        cache.close()
+        cache = get_otu_cache(dict(self.parameters, similarity=0.99),
+                              cache_dir)
+        self.assertEqual(cache.lookup([b'a' * 16]), {})
+        cache.close()
+
+    def test_filter_cached_sequences(self):
+        cache_dir = self._otu_cache()
+        cache = OTUCache(join(cache_dir, 'otus.sqlite'),
+                         self.parameters['reference-seq'], self.parameters)
+        self._clean_up_files.append(cache_dir)
+        seqs = [b'ACGT', b'CCCC', b'GGGG']
+        cache.store([(md5(b'ACGT').digest(), b'367523'),
+                     (md5(b'GGGG').digest(), None)])
+        fp = join(cache_dir, 'uniques.fna')
+        with open(fp, 'wb') as f:
+            for i, seq in enumerate(seqs):
+                f.write(b'>derep_%d\n%s\n' % (i, seq))
+        out_fp = join(cache_dir, 'seqs.fna')
+
+        obs = filter_cached_sequences(fp, out_fp, cache)
+        self.assertEqual(obs, {b'derep_0': b'367523', b'derep_2': None})
+        with open(out_fp, 'rb') as f:
+            self.assertEqual(f.read(), b'>derep_1\nCCCC\n')
+
+        # Once picked, the assignments are stored
+        map_fp = join(cache_dir, 'seqs_otus.txt')
+        with open(map_fp, 'w') as f:
+            f.write("836974\tderep_1\n")
+        cache_otu_assignments(out_fp, map_fp, None, cache)
+        self.assertEqual(filter_cached_sequences(fp, out_fp, cache),
+                         {b'derep_0': b'367523', b'derep_1': b'836974',
+                          b'derep_2': None})
+        with open(out_fp, 'rb') as f:
+            self.assertEqual(f.read(), b'')
+        cache.close()
+
+    def _sortmerna_picked_otus(self):
+        outdir = mkdtemp()
+        self._clean_up_files.append(outdir)
+        otus_dir = join(outdir, 'sortmerna_picked_otus')
+        mkdir(otus_dir)
+        for name, contents in SORTMERNA_ARCHIVE.items():
+            if contents is not None:
+                with open(join(outdir, name), 'wb') as f:
+                    f.write(contents)
+        return outdir
+
+    def _read_archive(self, fp, mode):
+        with taropen(fp, mode) as tar:
+            return {m.name: tar.extractfile(m).read() if m.isfile() else None
+                    for m in tar.getmembers()}
+
     def test_generate_sortmerna_tgz(self):
         outdir = mkdtemp()
         self._clean_up_files.append(outdir)
         mkdir(join(outdir, 'sortmerna_picked_otus'))
-        self.assertIsNone(generate_sortmerna_tgz(outdir))
+        obs = generate_sortmerna_tgz(outdir)
+        self.assertEqual(obs[0], 0)
+        self.assertTrue(exists(join(outdir, 'sortmerna_picked_otus.tgz')))
+
+        outdir = self._sortmerna_picked_otus()
+        archived, archive_size, _ = generate_sortmerna_tgz(outdir, num_jobs=2)
+        tgz = join(outdir, 'sortmerna_picked_otus.tgz')
+        self.assertEqual(archived, 17005)
+        self.assertEqual(archive_size, getsize(tgz))
+        self.assertTrue(is_bgzf(tgz))
+        self.assertEqual(self._read_archive(tgz, 'r:gz'), SORTMERNA_ARCHIVE)
 
     def test_generate_artifact_info(self):
         outdir = mkdtemp()
@@ -138,6 +604,137 @@ class PickOTUsTests(PluginTestCase):
         exp_ainfo = [ArtifactInfo('OTU table', 'BIOM', fps)]
         self.assertEqual(obs_ainfo, exp_ainfo)
 
+    def test_pick_closed_reference_otus_sharded(self):
+        self.parameters['shards'] = 3
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['QIIMEq2', '1.9.1',
+                                  'Pick closed-reference OTUs']),
+                'status': 'running',
+                'parameters': dumps(self.parameters)}
+        job_id = self.qclient.post(
+            '/apitest/processing_job/', data=data)['job']
+
+        fps = self.qclient.get('/qiita_db/artifacts/2/')['files']
+        fasta_fp = fps['preprocessed_fasta'][0]
+        self.parameters['reference-seq'] = '/tmp/seq.fna'
+        self.parameters['reference-tax'] = '/tmp/tax.txt'
+        with open(fasta_fp, 'w') as f:
+            f.write(READS)
+        with open(self.parameters['reference-seq'], 'w') as f:
+            f.write(REF_SEQ)
+        with open(self.parameters['reference-tax'], 'w') as f:
+            f.write(REF_TAX)
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        obs_success, obs_ainfo, obs_msg = pick_closed_reference_otus(
+            self.qclient, job_id, self.parameters, out_dir)
+        self.assertEqual(obs_msg, "")
+        self.assertTrue(obs_success)
+        path_builder = partial(join, out_dir, 'cr_otus')
+        log_fp = glob(path_builder("log_*.txt"))[0]
+        fps = [(path_builder("otu_table.biom"), "biom"),
+               (path_builder("sortmerna_picked_otus"), "directory"),
+               (path_builder("sortmerna_picked_otus.tgz"), "tgz"),
+               (log_fp, "log")]
+        exp_ainfo = [ArtifactInfo('OTU table', 'BIOM', fps)]
+        self.assertEqual(obs_ainfo, exp_ainfo)
+        self.assertFalse(exists(join(out_dir, 'shards')))
+
+        # The merged map and failures have the sequences of all the shards
+        otus_dir = path_builder('sortmerna_picked_otus')
+        with open(glob(join(otus_dir, '*_otus.txt'))[0]) as f:
+            seqs = [s for line in f for s in line.split()[1:]]
+        with open(glob(join(otus_dir, '*_failures.txt'))[0]) as f:
+            seqs.extend(line.strip() for line in f)
+        self.assertEqual(sorted(seqs, key=lambda s: int(s.split('_')[-1])),
+                         ['1001.SKB1_%d' % i for i in range(10)])
+
+    def _run_job(self, reads):
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['QIIMEq2', '1.9.1',
+                                  'Pick closed-reference OTUs']),
+                'status': 'running',
+                'parameters': dumps(self.parameters)}
+        job_id = self.qclient.post(
+            '/apitest/processing_job/', data=data)['job']
+        fps = self.qclient.get('/qiita_db/artifacts/2/')['files']
+        with open(fps['preprocessed_fasta'][0], 'w') as f:
+            f.write(reads)
+        parameters = dict(self.parameters)
+        parameters['reference-seq'] = '/tmp/seq.fna'
+        parameters['reference-tax'] = '/tmp/tax.txt'
+        with open(parameters['reference-seq'], 'w') as f:
+            f.write(REF_SEQ)
+        with open(parameters['reference-tax'], 'w') as f:
+            f.write(REF_TAX)
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        obs_success, obs_ainfo, obs_msg = pick_closed_reference_otus(
+            self.qclient, job_id, parameters, out_dir)
+        self.assertEqual(obs_msg, "")
+        self.assertTrue(obs_success)
+        return out_dir
+
+    def test_pick_closed_reference_otus_dereplicate(self):
+        exp_dir = self._run_job(READS + SKB_READS)
+        self.parameters['dereplicate'] = True
+        obs_dir = self._run_job(READS + SKB_READS)
+        self.assertFalse(exists(join(obs_dir, 'dereplicated')))
+
+        # The OTUs have the same sequences as without dereplication
+        def read_otus(out_dir):
+            otus_dir = join(out_dir, 'cr_otus', 'sortmerna_picked_otus')
+            with open(glob(join(otus_dir, '*_otus.txt'))[0]) as f:
+                otus = {line.split()[0]: line.split()[1:] for line in f}
+            with open(glob(join(otus_dir, '*_failures.txt'))[0]) as f:
+                failures = f.read().split()
+            return otus, failures
+
+        self.assertEqual(read_otus(obs_dir), read_otus(exp_dir))
+        with open(glob(join(obs_dir, 'cr_otus', 'log_*.txt'))[0]) as f:
+            self.assertIn("Dereplicated 14 sequences into 10 unique "
+                          "sequences", f.read())
+
+    def test_pick_closed_reference_otus_otu_cache(self):
+        exp_dir = self._run_job(READS + SKB_READS)
+        cache_dir = mkdtemp()
+        self._clean_up_files.append(cache_dir)
+        environ['QP_TARGET_GENE_CACHE_DIR'] = cache_dir
+        try:
+            # The cache is not used if the sequences are not dereplicated
+            obs_dir = self._run_job(READS + SKB_READS)
+            with open(glob(join(obs_dir, 'cr_otus', 'log_*.txt'))[0]) as f:
+                log = f.read()
+            self.assertNotIn("Dereplicated", log)
+            self.assertNotIn("OTU cache hits", log)
+            # The first job picks all the unique sequences, the second one
+            # takes them from the cache
+            self.parameters['dereplicate'] = True
+            obs_dirs = [self._run_job(READS + SKB_READS),
+                        self._run_job(READS + SKB_READS)]
+        finally:
+            del environ['QP_TARGET_GENE_CACHE_DIR']
+
+        def read_otus(out_dir):
+            otus_dir = join(out_dir, 'cr_otus', 'sortmerna_picked_otus')
+            with open(glob(join(otus_dir, '*_otus.txt'))[0]) as f:
+                otus = {line.split()[0]: line.split()[1:] for line in f}
+            with open(glob(join(otus_dir, '*_failures.txt'))[0]) as f:
+                failures = f.read().split()
+            return otus, failures
+
+        self.assertEqual(read_otus(obs_dirs[1]), read_otus(exp_dir))
+        for obs_dir, exp in zip(obs_dirs, ["0 of 10", "10 of 10"]):
+            with open(glob(join(obs_dir, 'cr_otus', 'log_*.txt'))[0]) as f:
+                self.assertIn("OTU cache hits: %s" % exp, f.read())
+
+
+SORTMERNA_ARCHIVE = {
+    'sortmerna_picked_otus': None,
+    'sortmerna_picked_otus/seqs_otus.txt': b"367523\ts1_0\ts2_0\n" * 1000,
+    'sortmerna_picked_otus/seqs_failures.txt': b"s1_1\n"}
 
 EXP_PARAMS = """pick_otus:otu_picking_method\tsortmerna
 pick_otus:sortmerna_max_pos\t10000
@@ -179,6 +776,21 @@ CCGGGGCTCAACCTCGGAACTGCCTTTGATACAGCGTCTCTTGAGTCCGATAGAGGCGGGTGGCATTCCTAGT
 """
 
 
+SKB_READS = """>1001.SKB2_0 orig_bc=TAGCGTCGGACG new_bc=TAGCGTCGGACG bc_diffs=0
+TACGTAGGTGGCAAGCGTTGTCCGGATTTATTGGGTTTAAAGGGTGCGTAGGCGGTTGTATAAGTCAGTGCTGAAATA\
+TCCCGGCTTAACCGGGAGGGTGGCATTGATACTGCGGGGCTTGAGAACGGGTGAGGTAGGCGGAATTGACGGT
+>1001.SKB1_10 orig_bc=TAACTTGCGGAC new_bc=TAACTTGCGGAC bc_diffs=0
+TACAGAGGGTGCAAGCGTTAATCGGAATTACTGGGCTTAAAGCGTGCGTAGTCGGTTATTCAAGTCGGGGGTGAAAGC\
+CCCGGGCTCAACCTGGGAATTGCATTCGATACTGTTTAGCTAGAGTTCGGCAGAGGGAAGTGGAATTTCCGGT
+>1001.SKB3_0 orig_bc=ACGGTGAGTGTC new_bc=ACGGTGAGTGTC bc_diffs=0
+TACGAAGGGGACTAGCGTTGTTCGGAATCACTGGGCGTAAAGCGCACGTAGGCGGATATGTCAGTCAGGGGTGAAATC\
+CCGGGGCTCAACCTCGGAACTGCCTTTGATACAGCGTCTCTTGAGTCCGATAGAGGCGGGTGGCATTCCTAGT
+>1001.SKB2_1 orig_bc=TAGCGTCGGACG new_bc=TAGCGTCGGACG bc_diffs=0
+TACGTAGGTGGCAAGCGTTGTCCGGAATTATTGGGCGTAAAGCGCGCGCAGGCGGTCCTTTAAGTCTGATGTGAAAGC\
+CCACGGCTTAACCGTGGAGGGTCATTGGAAACTGGAGGACTTGAGTACAGAAGAGGAGAGAGGAATTCCACGT
+"""
+
+
 REF_TAX = """367523\tk__Bacteria; p__Bacteroidetes; c__Flavobacteriia; \
 o__; f__; g__; s__
 187144\tk__Bacteria; p__Firmicutes; c__Clostridia; o__; f__; g__; s__
@@ -17,7 +17,13 @@ from functools import partial
 from qiita_client import ArtifactInfo
 from qiita_client.testing import PluginTestCase
 
-from qp_target_gene.trimming import (trimming, generate_trimming)
+import numpy as np
+import numpy.testing as npt
+from h5py import File
+
+from qp_target_gene.trimming import (trimming, generate_trimming, trim_demux,
+                                     format_trimmed,
+                                     generate_multiple_trimming)
 from qp_target_gene import plugin
 
 
@@ -60,7 +66,7 @@ class TrimmingTest(PluginTestCase):
             'prep': pid}
         aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
 
-        params = {'input_data': aid, 'length': 50}
+        params = {'input_data': aid, 'length': 50, 'demux_storage': 'gzip'}
         data = {'user': 'demo@microbio.me',
                 'command': dumps(['QIIMEq2', '1.9.1', 'Trimming']),
                 'status': 'running', 'parameters': dumps(params)}
@@ -81,6 +87,74 @@ class TrimmingTest(PluginTestCase):
         self.assertEqual(ainfo, exp_ainfo)
         self.assertEqual(msg, "")
 
+    def test_trimming_multiple_lengths(self):
+        fd, fp = mkstemp(suffix='_seqs.demux')
+        close(fd)
+        self._clean_up_files.append(fp)
+        copyfile('support_files/filtered_5_seqs.demux', fp)
+
+        prep_info_dict = {
+            'SKB7.640196': {'description_for_test': 'SKB7'},
+            'SKB8.640193': {'description_for_test': 'SKB8'}
+        }
+        data = {'prep_info': dumps(prep_info_dict),
+                'study': 1,
+                'data_type': '16S'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+        data = {
+            'filepaths': dumps([(fp, 'preprocessed_demux')]),
+            'type': "Demultiplexed",
+            'name': "New demultiplexed artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        params = {'input_data': aid, 'lengths': '150,90',
+                  'demux_storage': 'gzip'}
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['QIIMEq2', '1.9.1',
+                                  'Trimming multiple lengths']),
+                'status': 'running', 'parameters': dumps(params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+
+        success, ainfo, msg = trimming(self.qclient, jid, params, out_dir)
+        self.assertTrue(success)
+        exp_ainfo = []
+        for length in [90, 150]:
+            pb = partial(join, out_dir, 'trimmed_%d' % length)
+            exp_ainfo.append(ArtifactInfo(
+                'Trimmed Demultiplexed %d' % length, 'Demultiplexed',
+                [(pb('seqs.fna'), 'preprocessed_fasta'),
+                 (pb('seqs.fastq'), 'preprocessed_fastq'),
+                 (pb('seqs.demux'), 'preprocessed_demux')]))
+        self.assertEqual(ainfo, exp_ainfo)
+        self.assertEqual(msg, "")
+
+        # The lengths can also be a list
+        params['lengths'] = [90, 150]
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        success, ainfo, msg = trimming(self.qclient, jid, params, out_dir)
+        self.assertTrue(success)
+        self.assertEqual(len(ainfo), 2)
+        self.assertEqual(msg, "")
+
+        params['lengths'] = '90,120'
+        success, ainfo, msg = trimming(self.qclient, jid, params, out_dir)
+        self.assertFalse(success)
+        self.assertIsNone(ainfo)
+        self.assertEqual(msg, "Trimming lengths not supported: 120. Please, "
+                              "choose values from 90, 100, 150")
+
+        params['lengths'] = '90,abc'
+        success, ainfo, msg = trimming(self.qclient, jid, params, out_dir)
+        self.assertFalse(success)
+        self.assertIsNone(ainfo)
+        self.assertEqual(msg, "Trimming lengths should be comma separated "
+                              "integers: 90,abc")
+
     def test_generate_trimming(self):
         # generating filepaths
         fd, fp = mkstemp(suffix='_seqs.demux')
@@ -119,7 +193,8 @@ class TrimmingTest(PluginTestCase):
 
         out_dir = mkdtemp()
         self._clean_up_files.append(out_dir)
-        generate_trimming([fp], out_dir, {'length': 51})
+        obs_fp = generate_trimming([fp], out_dir, {'length': 51})
+        self.assertEqual(obs_fp, join(out_dir, 'seqs.demux'))
 
         pd = partial(join, out_dir)
         with open(pd('seqs.fna')) as ffh, open(pd('seqs.fastq')) as qfh:
@@ -137,6 +212,157 @@ class TrimmingTest(PluginTestCase):
         self.assertEqual(fr, efr)
         self.assertEqual(qr, eqr)
 
+        # the demux file is written with the trimmed sequences
+        with File(obs_fp, 'r') as f:
+            self.assertEqual(list(f), ['1.SKB7.640196'])
+            self.assertEqual(f.attrs['n'], 1)
+            self.assertEqual(f.attrs['max'], 51)
+            grp = f['1.SKB7.640196']
+            npt.assert_equal(grp['sequence'][:], [
+                b'TACGGAGGGTGCAAGCGTTATCCGGATTCACTGGGTTTAAAGGGTGCGTAA'])
+            self.assertEqual(grp['qual'].shape, (1, 51))
+            npt.assert_equal(grp['barcode/corrected'][:], [b'GAACTTAGGCCG'])
+
+        with self.assertRaisesRegexp(ValueError, 'No sequences were demuxed'):
+            generate_trimming([fp], out_dir, {'length': 200})
+
+    def test_generate_trimming_multiple_files(self):
+        fps = []
+        for _ in range(2):
+            fd, fp = mkstemp(suffix='_seqs.demux')
+            close(fd)
+            self._clean_up_files.append(fp)
+            copyfile('support_files/filtered_5_seqs_50bps.demux', fp)
+            fps.append(fp)
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        generate_trimming(fps, out_dir, {'length': 51})
+
+        # the records of each file are appended, not overwritten
+        pd = partial(join, out_dir)
+        with open(pd('seqs.fna')) as ffh, open(pd('seqs.fastq')) as qfh:
+            fr = ffh.readlines()
+            qr = qfh.readlines()
+
+        efr = ['>1.SKB7.640196_310 orig_bc=GAACTTAGGCCG new_bc=GAACTTAGGCCG '
+               'bc_diffs=0\n',
+               'TACGGAGGGTGCAAGCGTTATCCGGATTCACTGGGTTTAAAGGGTGCGTAA\n']
+        eqr = ['@1.SKB7.640196_310 orig_bc=GAACTTAGGCCG new_bc=GAACTTAGGCCG '
+               'bc_diffs=0\n',
+               'TACGGAGGGTGCAAGCGTTATCCGGATTCACTGGGTTTAAAGGGTGCGTAA\n',
+               '+\n',
+               'BBBFFFFFGDFHHJJJJIIJJIJJGIJJJIJJJJJHIIIIGIJIHIJJJHI\n']
+        self.assertEqual(fr, efr * 2)
+        self.assertEqual(qr, eqr * 2)
+
+    def test_generate_multiple_trimming(self):
+        fp = 'support_files/filtered_5_seqs.demux'
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        obs = generate_multiple_trimming([fp], out_dir, [10, 100])
+        self.assertEqual(obs, {10: join(out_dir, 'trimmed_10'),
+                               100: join(out_dir, 'trimmed_100')})
+
+        # each length has the same files as a trimming to that length
+        for length in [10, 100]:
+            exp_dir = mkdtemp()
+            self._clean_up_files.append(exp_dir)
+            generate_trimming([fp], exp_dir, {'length': length})
+            for fname in ['seqs.fna', 'seqs.fastq']:
+                with open(join(obs[length], fname)) as f:
+                    obs_seqs = f.read()
+                with open(join(exp_dir, fname)) as f:
+                    self.assertEqual(obs_seqs, f.read())
+            with File(join(obs[length], 'seqs.demux'), 'r') as f:
+                self.assertEqual(f.attrs['max'], length)
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        with self.assertRaisesRegexp(ValueError, 'No sequences were demuxed'):
+            generate_multiple_trimming([fp], out_dir, [10, 200])
+
+    def test_generate_trimming_parallel(self):
+        # the samples of both files are trimmed by different processes and
+        # the outputs are the same as the serial trimming
+        fps = ['support_files/filtered_5_seqs.demux',
+               'support_files/filtered_5_seqs_50bps.demux']
+        exp_dir = mkdtemp()
+        self._clean_up_files.append(exp_dir)
+        generate_multiple_trimming(fps, exp_dir, [10, 50], num_jobs=1)
+        obs_dir = mkdtemp()
+        self._clean_up_files.append(obs_dir)
+        generate_multiple_trimming(fps, obs_dir, [10, 50], num_jobs=3)
+        self.assertFalse(exists(join(obs_dir, 'trimmed_10',
+                                     'trimming_fragments')))
+
+        for length in ['trimmed_10', 'trimmed_50']:
+            for fname in ['seqs.fna', 'seqs.fastq']:
+                with open(join(obs_dir, length, fname), 'rb') as f:
+                    obs_seqs = f.read()
+                with open(join(exp_dir, length, fname), 'rb') as f:
+                    self.assertEqual(obs_seqs, f.read())
+            with File(join(obs_dir, length, 'seqs.demux'), 'r') as obs, \
+                    File(join(exp_dir, length, 'seqs.demux'), 'r') as exp:
+                self.assertEqual(list(obs), list(exp))
+                self.assertEqual(dict(obs.attrs).keys(),
+                                 dict(exp.attrs).keys())
+                for attr in exp.attrs:
+                    npt.assert_equal(obs.attrs[attr], exp.attrs[attr])
+                for sample in exp:
+                    for attr in exp[sample].attrs:
+                        npt.assert_equal(obs[sample].attrs[attr],
+                                         exp[sample].attrs[attr])
+                    for name in ['sequence', 'qual', 'barcode/original',
+                                 'barcode/corrected', 'barcode/error']:
+                        npt.assert_equal(obs[sample][name][:],
+                                         exp[sample][name][:])
+
+        obs_dir = mkdtemp()
+        self._clean_up_files.append(obs_dir)
+        with self.assertRaisesRegexp(ValueError, 'No sequences were demuxed'):
+            generate_trimming(fps, obs_dir, {'length': 200}, num_jobs=2)
+
+    def test_trim_demux(self):
+        fp = 'support_files/filtered_5_seqs_50bps.demux'
+        obs = list(trim_demux([fp], 51, chunk_size=100))
+        self.assertEqual(len(obs), 1)
+        sample, idx, seqs, quals, bc_ori, bc_cor, bc_err = obs[0]
+        self.assertEqual(sample, b'1.SKB7.640196')
+        npt.assert_equal(idx, [310])
+        self.assertEqual(seqs.shape, (1, 51))
+        self.assertEqual(quals.shape, (1, 51))
+        self.assertEqual(seqs.tobytes(), b'TACGGAGGGTGCAAGCGTTATCCGGATTCACTGG'
+                                         b'GTTTAAAGGGTGCGTAA')
+        npt.assert_equal(bc_ori, [b'GAACTTAGGCCG'])
+        npt.assert_equal(bc_cor, [b'GAACTTAGGCCG'])
+        npt.assert_equal(bc_err, [0])
+
+        # the chunks keep the indices within the sample
+        chunks = list(trim_demux([fp], 10, chunk_size=100))
+        self.assertTrue(len(chunks) > 1)
+        idx = np.concatenate([chunk[1] for chunk in chunks
+                              if chunk[0] == b'1.SKB7.640196'])
+        npt.assert_equal(idx, np.arange(len(idx)))
+
+        self.assertEqual(list(trim_demux([fp], 200)), [])
+
+    def test_format_trimmed(self):
+        obs_fasta, obs_fastq = format_trimmed(
+            b'1.s1', np.array([0, 3]),
+            np.frombuffer(b'ACGTTGCA', dtype=np.uint8).reshape(2, 4),
+            np.array([[0, 10, 20, 30], [40, 41, 2, 3]], dtype=np.uint8),
+            np.array([b'AAAA', b'CCCC']), np.array([b'AAAA', b'CCCA']),
+            np.array([0, 1]))
+        self.assertEqual(
+            obs_fasta,
+            b'>1.s1_0 orig_bc=AAAA new_bc=AAAA bc_diffs=0\nACGT\n'
+            b'>1.s1_3 orig_bc=CCCC new_bc=CCCA bc_diffs=1\nTGCA\n')
+        self.assertEqual(
+            obs_fastq,
+            b'@1.s1_0 orig_bc=AAAA new_bc=AAAA bc_diffs=0\nACGT\n+\n!+5?\n'
+            b'@1.s1_3 orig_bc=CCCC new_bc=CCCA bc_diffs=1\nTGCA\n+\nIJ#$\n')
+
 
 if __name__ == '__main__':
     main()
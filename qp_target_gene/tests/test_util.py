@@ -7,9 +7,15 @@
 # -----------------------------------------------------------------------------
 
 from unittest import TestCase, main
-from os import getcwd
+from os import getcwd, environ
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
 
-from qp_target_gene.util import system_call
+from qp_target_gene.util import (system_call, get_num_jobs, get_cache_dir,
+                                 get_cache_size, parallel_system_call,
+                                 streaming_system_call)
 
 
 class UtilTests(TestCase):
@@ -25,6 +31,108 @@ class UtilTests(TestCase):
         self.assertTrue("not found" in obs_err)
         self.assertEqual(obs_val, 127)
 
+    def test_get_num_jobs(self):
+        self.assertEqual(get_num_jobs(3), 3)
+        self.assertEqual(get_num_jobs(0), 1)
+
+        environ['QP_TARGET_GENE_NUM_JOBS'] = '5'
+        try:
+            self.assertEqual(get_num_jobs(), 5)
+            self.assertEqual(get_num_jobs(default=1), 5)
+        finally:
+            del environ['QP_TARGET_GENE_NUM_JOBS']
+        self.assertTrue(get_num_jobs() >= 1)
+        self.assertEqual(get_num_jobs(default=1), 1)
+
+    def test_get_cache_dir(self):
+        environ['QP_TARGET_GENE_CACHE_DIR'] = '/tmp/cache'
+        try:
+            self.assertEqual(get_cache_dir(), '/tmp/cache')
+        finally:
+            del environ['QP_TARGET_GENE_CACHE_DIR']
+        self.assertIsNone(get_cache_dir())
+
+    def test_get_cache_size(self):
+        environ['QP_TARGET_GENE_CACHE_SIZE'] = '1.5'
+        try:
+            self.assertEqual(get_cache_size(), 1610612736)
+        finally:
+            del environ['QP_TARGET_GENE_CACHE_SIZE']
+        self.assertIsNone(get_cache_size())
+
+    def test_parallel_system_call(self):
+        cmds = ["sleep 0.3; echo a", "echo b", "echo c >&2; exit 2"]
+        obs = sorted(parallel_system_call(cmds, num_jobs=2))
+        exp = [(0, "a\n", "", 0), (1, "b\n", "", 0), (2, "", "c\n", 2)]
+        self.assertEqual(obs, exp)
+
+    def test_parallel_system_call_fail_fast(self):
+        cmds = ["exit 1", "sleep 10", "echo never"]
+        results = parallel_system_call(cmds, num_jobs=2)
+        obs = next(results)
+        self.assertEqual(obs, (0, "", "", 1))
+        # Stop consuming the results: the running command is killed and the
+        # pending one is never started
+        results.close()
+
+    def test_parallel_system_call_requires(self):
+        cmds = ["sleep 0.3; echo a", "echo b", "echo c", "exit 1", "echo d"]
+        requires = {1: [0], 2: [0, 1], 4: [3]}
+        obs = list(parallel_system_call(cmds, num_jobs=4, requires=requires))
+        # The commands run after the commands they depend on, and the ones
+        # depending on a failed command are never executed
+        self.assertEqual([o[0] for o in obs], [3, 0, 1, 2])
+        self.assertEqual([o[1] for o in obs], ["", "a\n", "b\n", "c\n"])
+
+    def test_streaming_system_call(self):
+        obs_out, obs_err, obs_val = streaming_system_call("pwd")
+        self.assertEqual(obs_out, "%s\n" % getcwd())
+        self.assertEqual(obs_err, "")
+        self.assertEqual(obs_val, 0)
+
+    def test_streaming_system_call_error(self):
+        obs_out, obs_err, obs_val = streaming_system_call(
+            "IHopeThisCommandDoesNotExist")
+        self.assertEqual(obs_out, "")
+        self.assertTrue("not found" in obs_err)
+        self.assertEqual(obs_val, 127)
+
+    def test_streaming_system_call_spool(self):
+        out_dir = mkdtemp()
+        self.addCleanup(rmtree, out_dir)
+        prefix = join(out_dir, 'cmd')
+
+        obs_out, obs_err, obs_val = streaming_system_call(
+            "seq 1 1000; echo error >&2", log_prefix=prefix, tail_lines=2,
+            max_log_size=1000, log_backups=2)
+        self.assertEqual(obs_out, "999\n1000\n")
+        self.assertEqual(obs_err, "error\n")
+        self.assertEqual(obs_val, 0)
+
+        with open(prefix + '_stdout.txt') as f:
+            self.assertTrue(f.read().endswith("999\n1000\n"))
+        self.assertTrue(exists(prefix + '_stdout.txt.2'))
+        self.assertFalse(exists(prefix + '_stdout.txt.3'))
+        with open(prefix + '_stderr.txt') as f:
+            self.assertEqual(f.read(), "error\n")
+
+    def test_streaming_system_call_progress(self):
+        obs = []
+        streaming_system_call(
+            "echo 'step 1'; echo other; sleep 0.5; echo 'step 2'; "
+            "echo 'step 3'", progress_re='^step', progress_callback=obs.append,
+            progress_interval=0.3)
+        self.assertEqual(obs, ['step 1', 'step 2'])
+
+    def test_streaming_system_call_timeout(self):
+        start = time()
+        obs_out, obs_err, obs_val = streaming_system_call(
+            "echo start; sleep 20 & sleep 20", timeout=0.5, kill_grace=1)
+        self.assertTrue(time() - start < 5)
+        self.assertEqual(obs_out, "start\n")
+        self.assertTrue("timed out" in obs_err)
+        self.assertNotEqual(obs_val, 0)
+
 
 if __name__ == '__main__':
     main()
@@ -6,19 +6,454 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
+from os import makedirs
 from os.path import join
 from functools import partial
+from itertools import chain, repeat
+from multiprocessing import Pool
+from shutil import rmtree
 from h5py import File
+import numpy as np
 
 from qiita_client import ArtifactInfo
 
-from qp_target_gene.split_libraries.util import generate_demux_file
-from qiita_files.demux import fetch
-from qiita_files.format.fasta import format_fasta_record
-from qiita_files.format.fastq import format_fastq_record
+from qp_target_gene.split_libraries.util import (
+    DemuxWriter, FASTQ_BUFFER_SIZE, merge_files, _length_stats)
+from qp_target_gene.util import get_num_jobs
 
+# Number of sequences of a sample read from the demux file at once
+TRIMMING_CHUNK_SIZE = 100000
 
-def generate_trimming(filepaths, out_dir, parameters):
+HEADER_FMT = b"%s_%d orig_bc=%s new_bc=%s bc_diffs=%d"
+
+# The lengths of the "Trimming multiple lengths" command, each of them has its
+# own output
+MULTIPLE_TRIMMING_LENGTHS = (90, 100, 150)
+
+
+def _sample_chunks(grp, sample, max_length, chunk_size):
+    """Yields the untrimmed sequences of a sample of a demux file in chunks
+
+    Parameters
+    ----------
+    grp : h5py.Group
+        The group of the sample
+    sample : str
+        The sample
+    max_length : int
+        The maximum trimming length. Only this many quality columns are read
+    chunk_size : int
+        The number of sequences read at once
+
+    Yields
+    ------
+    bytes, int, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray
+        The sample, the index within the sample of the first sequence, and
+        the sequences, PHRED qualities, original barcodes, corrected barcodes
+        and barcode errors of a chunk of its sequences. The sequences and
+        qualities are uint8 matrices padded with NULs
+    """
+    width = grp['sequence'].dtype.itemsize
+    sample = sample.encode('utf-8')
+    for start in range(0, grp['sequence'].shape[0], chunk_size):
+        end = start + chunk_size
+        yield (sample, start,
+               grp['sequence'][start:end].view(np.uint8).reshape(-1, width),
+               grp['qual'][start:end, :max_length],
+               grp['barcode/original'][start:end],
+               grp['barcode/corrected'][start:end],
+               grp['barcode/error'][start:end])
+
+
+def _demux_chunks(filepaths, min_length, max_length, chunk_size):
+    """Yields the untrimmed sequences of the demux files in chunks
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    min_length : int
+        The minimum trimming length. Samples without sequences this long are
+        skipped
+    max_length : int
+        The maximum trimming length. Only this many quality columns are read
+    chunk_size : int
+        The number of sequences of a sample read at once
+
+    Yields
+    ------
+    tuple
+        The chunks of each sample, as yielded by `_sample_chunks`
+    """
+    for fp in filepaths:
+        with File(fp, 'r') as fh:
+            for sample in fh:
+                if fh[sample]['sequence'].dtype.itemsize < min_length:
+                    # None of the sequences is long enough
+                    continue
+                for chunk in _sample_chunks(fh[sample], sample, max_length,
+                                            chunk_size):
+                    yield chunk
+
+
+def _trim_chunk(chunk, length):
+    """Trims a chunk of sequences yielded by `_demux_chunks`
+
+    Parameters
+    ----------
+    chunk : tuple
+        The chunk
+    length : int
+        The length of the trimmed sequences. Shorter sequences are discarded
+
+    Returns
+    -------
+    tuple or None
+        The trimmed chunk, as yielded by `trim_demux`. None if none of the
+        sequences is long enough
+    """
+    sample, start, seqs, quals, bc_ori, bc_cor, bc_err = chunk
+    if seqs.shape[1] < length:
+        return None
+    if length > 0:
+        # The sequences are padded with NULs, so a sequence is long enough
+        # if it has a base at `length` - 1
+        mask = seqs[:, length - 1] != 0
+    else:
+        mask = np.ones(len(seqs), dtype=bool)
+    if not mask.any():
+        return None
+    return (sample, np.flatnonzero(mask) + start, seqs[mask, :length],
+            quals[mask, :length], bc_ori[mask], bc_cor[mask], bc_err[mask])
+
+
+def trim_demux(filepaths, length, chunk_size=TRIMMING_CHUNK_SIZE):
+    """Yields the sequences of the demux files trimmed to `length`
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    length : int
+        The length of the trimmed sequences. Shorter sequences are discarded
+    chunk_size : int, optional
+        The number of sequences of a sample read at once
+
+    Yields
+    ------
+    bytes, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+    np.ndarray
+        The sample, and the indices within the sample, trimmed sequences,
+        trimmed PHRED qualities, original barcodes, corrected barcodes and
+        barcode errors of a chunk of its sequences. The sequences and
+        qualities are uint8 matrices of `length` columns
+
+    Notes
+    -----
+    The samples are read in the same order as `qiita_files.demux.fetch` does,
+    and the files in the order of `filepaths`. The datasets of each sample
+    are read in chunks of `chunk_size` sequences, and the length filter and
+    the trimming are applied to the whole chunk with NumPy.
+    """
+    for chunk in _demux_chunks(filepaths, length, length, chunk_size):
+        trimmed = _trim_chunk(chunk, length)
+        if trimmed is not None:
+            yield trimmed
+
+
+def _rows_to_bytes(matrix):
+    """Returns the rows of a uint8 matrix as a list of bytes"""
+    if not matrix.shape[1]:
+        return [b''] * matrix.shape[0]
+    return np.ascontiguousarray(matrix).view(
+        '|S%d' % matrix.shape[1]).ravel().tolist()
+
+
+def format_trimmed(sample, idx, seqs, quals, bc_ori, bc_cor, bc_err):
+    """Formats a chunk of trimmed sequences as FASTA and FASTQ
+
+    Parameters
+    ----------
+    sample : bytes
+        The sample
+    idx : np.ndarray
+        The indices of the sequences within the sample
+    seqs : np.ndarray
+        The trimmed sequences, as a uint8 matrix
+    quals : np.ndarray
+        The trimmed PHRED qualities, as a uint8 matrix
+    bc_ori, bc_cor, bc_err : np.ndarray
+        The original barcodes, corrected barcodes and barcode errors
+
+    Returns
+    -------
+    bytes, bytes
+        The FASTA and FASTQ records. Both are formatted from the same headers
+    """
+    headers = [HEADER_FMT % (sample, i, o, c, e) for i, o, c, e in zip(
+        idx.tolist(), bc_ori.tolist(), bc_cor.tolist(), bc_err.tolist())]
+    seqs = _rows_to_bytes(seqs)
+    quals = _rows_to_bytes(quals + 33)
+    fasta = b''.join(chain.from_iterable(zip(
+        repeat(b'>'), headers, repeat(b'\n'), seqs, repeat(b'\n'))))
+    fastq = b''.join(chain.from_iterable(zip(
+        repeat(b'@'), headers, repeat(b'\n'), seqs, repeat(b'\n+\n'), quals,
+        repeat(b'\n'))))
+    return fasta, fastq
+
+
+class TrimmingWriter(object):
+    """Writes trimmed sequences to seqs.fna, seqs.fastq and seqs.demux
+
+    Parameters
+    ----------
+    out_dir : str
+        The directory of the files
+    storage : str, optional
+        The HDF5 storage profile of the demux file, one of
+        `DEMUX_STORAGE_PROFILES`
+    """
+    def __init__(self, out_dir, storage='gzip'):
+        pd = partial(join, out_dir)
+        self.out_dir = out_dir
+        self.demux_fp = pd('seqs.demux')
+        self._fasta = open(pd('seqs.fna'), 'wb', FASTQ_BUFFER_SIZE)
+        self._fastq = open(pd('seqs.fastq'), 'wb', FASTQ_BUFFER_SIZE)
+        self._h5file = File(self.demux_fp, 'w')
+        self._demux = DemuxWriter(self._h5file, storage=storage)
+
+    def write(self, chunk):
+        """Writes a chunk of trimmed sequences
+
+        Parameters
+        ----------
+        chunk : tuple
+            The chunk, as yielded by `trim_demux`
+        """
+        fasta, fastq = format_trimmed(*chunk)
+        self._fasta.write(fasta)
+        self._fastq.write(fastq)
+        self._demux.write_chunk(*(chunk[:1] + chunk[2:]))
+
+    def close(self):
+        """Closes the files
+
+        Returns
+        -------
+        int
+            The number of sequences written
+        """
+        try:
+            return self._demux.close()
+        finally:
+            self._h5file.close()
+            self._fasta.close()
+            self._fastq.close()
+
+
+def _trim_chunks(chunks, writers):
+    """Trims the chunks to the length of each of the `writers`
+
+    Parameters
+    ----------
+    chunks : iterable of tuple
+        The untrimmed chunks, as yielded by `_sample_chunks`
+    writers : dict of {int: TrimmingWriter}
+        The writer of each trimming length. They are closed once the chunks
+        are written
+
+    Returns
+    -------
+    dict of {int: int}
+        The number of sequences written, keyed by length
+    """
+    try:
+        for chunk in chunks:
+            for length, writer in writers.items():
+                trimmed = _trim_chunk(chunk, length)
+                if trimmed is not None:
+                    writer.write(trimmed)
+    finally:
+        counts = {length: writer.close()
+                  for length, writer in writers.items()}
+    return counts
+
+
+def _trim_sample(args):
+    """Trims a sample of a demux file to fragment files
+
+    Parameters
+    ----------
+    args : tuple of (str, str, list of int, str, str)
+        The demux filepath, the sample, the trimming lengths, the demux
+        storage profile and the directory of the fragments. The fragment of
+        each length is written to a subdirectory named after the length
+
+    Returns
+    -------
+    dict of {int: int}
+        The number of sequences written, keyed by length
+    """
+    fp, sample, lengths, storage, frag_dir = args
+    writers = {}
+    for length in lengths:
+        length_dir = join(frag_dir, str(length))
+        makedirs(length_dir)
+        writers[length] = TrimmingWriter(length_dir, storage)
+    with File(fp, 'r') as fh:
+        return _trim_chunks(
+            _sample_chunks(fh[sample], sample, max(lengths),
+                           TRIMMING_CHUNK_SIZE), writers)
+
+
+def _append_group(src, dst, n):
+    """Appends the `n` sequences of the `src` sample group to `dst`"""
+    for name in ['sequence', 'qual', 'barcode/original', 'barcode/corrected',
+                 'barcode/error']:
+        start = dst[name].shape[0]
+        dst[name].resize(start + n, axis=0)
+        for i in range(0, n, TRIMMING_CHUNK_SIZE):
+            end = min(i + TRIMMING_CHUNK_SIZE, n)
+            dst[name][start + i:start + end] = src[name][i:end]
+
+
+def _merge_fragments(frag_dirs, out_dir, length):
+    """Concatenates the trimming fragments in order
+
+    Parameters
+    ----------
+    frag_dirs : list of str
+        The fragment directories, in order
+    out_dir : str
+        The output directory
+    length : int
+        The trimming length of the fragments
+
+    Returns
+    -------
+    int
+        The number of sequences of the merged demux file
+
+    Notes
+    -----
+    The demux groups are copied without recompressing them. If a sample is
+    in several fragments (i.e. in several demux files), its datasets are
+    appended to the ones of the first fragment. As all the trimmed sequences
+    are `length` long, the length statistics are computed from the number of
+    sequences of each sample.
+    """
+    merge_files(frag_dirs, out_dir, ['seqs.fna', 'seqs.fastq'])
+    counts = {}
+    with File(join(out_dir, 'seqs.demux'), 'w') as f:
+        f.attrs['has-qual'] = True
+        for frag_dir in frag_dirs:
+            with File(join(frag_dir, 'seqs.demux'), 'r') as frag:
+                for sample in frag:
+                    src = frag[sample]
+                    n = src['sequence'].shape[0]
+                    if sample not in f:
+                        frag.copy(src, f, name=sample)
+                    else:
+                        _append_group(src, f[sample], n)
+                    counts[sample] = counts.get(sample, 0) + n
+        for sample, n in counts.items():
+            f[sample].attrs.update(_length_stats({length: n}))
+        total = sum(counts.values())
+        if total:
+            f.attrs.update(_length_stats({length: total}))
+    return total
+
+
+def _parallel_trimming(filepaths, out_dirs, storage, num_jobs):
+    """Trims the samples of the demux files in a pool of processes
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    out_dirs : dict of {int: str}
+        The output directory of each trimming length
+    storage : str
+        The HDF5 storage profile of the demux files
+    num_jobs : int
+        The number of processes
+
+    Returns
+    -------
+    dict of {int: int}
+        The number of sequences written, keyed by length
+
+    Notes
+    -----
+    Each sample of each demux file is trimmed by a worker to its own
+    fragment files. The fragments are then concatenated in the order of the
+    serial trimming, so the outputs are the same.
+    """
+    lengths = sorted(out_dirs)
+    frag_root = join(out_dirs[lengths[0]], 'trimming_fragments')
+    tasks = []
+    for fp in filepaths:
+        with File(fp, 'r') as fh:
+            for sample in fh:
+                if fh[sample]['sequence'].dtype.itemsize >= lengths[0]:
+                    tasks.append((fp, sample, lengths, storage,
+                                  join(frag_root, str(len(tasks)))))
+    pool = Pool(num_jobs)
+    try:
+        results = pool.map(_trim_sample, tasks, chunksize=1)
+        counts = {}
+        for length in lengths:
+            frag_dirs = [join(task[-1], str(length))
+                         for task, result in zip(tasks, results)
+                         if result[length]]
+            counts[length] = _merge_fragments(frag_dirs, out_dirs[length],
+                                              length)
+    finally:
+        pool.close()
+        pool.join()
+        rmtree(frag_root, ignore_errors=True)
+    return counts
+
+
+def _write_trimming(filepaths, out_dirs, storage, num_jobs):
+    """Trims the demux files once for all the lengths of `out_dirs`
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    out_dirs : dict of {int: str}
+        The output directory of each trimming length
+    storage : str
+        The HDF5 storage profile of the demux files
+    num_jobs : int
+        The number of processes. If 1, the files are trimmed in this process
+
+    Raises
+    ------
+    ValueError
+        If no sequence is long enough to be trimmed to one of the lengths
+    """
+    if num_jobs > 1:
+        counts = _parallel_trimming(filepaths, out_dirs, storage, num_jobs)
+    else:
+        writers = {}
+        try:
+            for length, out_dir in out_dirs.items():
+                writers[length] = TrimmingWriter(out_dir, storage)
+        except Exception:
+            for writer in writers.values():
+                writer.close()
+            raise
+        counts = _trim_chunks(
+            _demux_chunks(filepaths, min(writers), max(writers),
+                          TRIMMING_CHUNK_SIZE), writers)
+    if not all(counts.values()):
+        raise ValueError("No sequences were demuxed. Check your parameters.")
+
+
+def generate_trimming(filepaths, out_dir, parameters, storage='gzip',
+                      num_jobs=1):
     """Generate the trimming of the filepaths
 
     Parameters
@@ -29,28 +464,87 @@ def generate_trimming(filepaths, out_dir, parameters):
         The job output directory
     parameters : dict
         The command's parameters, keyed by parameter name
+    storage : str, optional
+        The HDF5 storage profile of the trimmed demux file, one of
+        `DEMUX_STORAGE_PROFILES`
+    num_jobs : int, optional
+        The number of processes trimming the samples. By default the samples
+        are trimmed serially, in this process
+
+    Returns
+    -------
+    str
+        The path of the trimmed demux file
+
+    Raises
+    ------
+    ValueError
+        If no sequence is long enough to be trimmed
+
+    Notes
+    -----
+    The sequences of all the demux files are written, in order, to the
+    seqs.fna, seqs.fastq and seqs.demux files in `out_dir`. They are trimmed
+    and written in chunks of `TRIMMING_CHUNK_SIZE` sequences of a sample, so
+    the demux file is created in the same pass, without parsing seqs.fastq.
+    With several jobs, the samples are trimmed in parallel and the outputs
+    are concatenated in the same order, so they are identical.
     """
-    length = int(parameters['length'])
-
-    id_fmt = (b"%(sample)s_%(idx)d orig_bc=%(bc_ori)s new_bc=%(bc_cor)s "
-              b"bc_diffs=%(bc_diff)d")
-    pd = partial(join, out_dir)
-    ffp = pd('seqs.fna')
-    qfp = pd('seqs.fastq')
-    for f in filepaths:
-        with open(ffp, 'w') as ffh, open(qfp, 'w') as qfh, File(f) as fh:
-            for samp, idx, seq, qual, bc_ori, bc_cor, bc_err in fetch(fh):
-                # only one of these comparisons should suffice but better
-                # safe than sorry
-                if len(seq) < length or len(qual) < length:
-                    continue
-                seq_id = id_fmt % {b'sample': samp, b'idx': idx,
-                                   b'bc_ori': bc_ori, b'bc_cor': bc_cor,
-                                   b'bc_diff': bc_err}
-                ffh.write(
-                    format_fasta_record(seq_id, seq[:length], qual[:length]))
-                qfh.write(
-                    format_fastq_record(seq_id, seq[:length], qual[:length]))
+    _write_trimming(filepaths, {int(parameters['length']): out_dir}, storage,
+                    num_jobs)
+    return join(out_dir, 'seqs.demux')
+
+
+def generate_multiple_trimming(filepaths, out_dir, lengths, storage='gzip',
+                               num_jobs=1):
+    """Generate the trimming of the filepaths to several lengths
+
+    Parameters
+    ----------
+    filepaths : list of str
+        The demux filepaths
+    out_dir : str
+        The job output directory
+    lengths : list of int
+        The trimming lengths
+    storage : str, optional
+        The HDF5 storage profile of the trimmed demux files, one of
+        `DEMUX_STORAGE_PROFILES`
+    num_jobs : int, optional
+        The number of processes trimming the samples. By default the samples
+        are trimmed serially, in this process
+
+    Returns
+    -------
+    dict of {int: str}
+        The output directory of each length, trimmed_<length> in `out_dir`
+
+    Raises
+    ------
+    ValueError
+        If no sequence is long enough to be trimmed to one of the lengths
+
+    Notes
+    -----
+    The demux files are read once, and each chunk of sequences is trimmed to
+    all the lengths, as `generate_trimming` does for a single length.
+    """
+    out_dirs = {}
+    for length in lengths:
+        out_dirs[length] = join(out_dir, 'trimmed_%d' % length)
+        makedirs(out_dirs[length])
+    _write_trimming(filepaths, out_dirs, storage, num_jobs)
+    return out_dirs
+
+
+def _artifact_info(output_name, out_dir):
+    """Creates the information of a trimmed artifact"""
+    pb = partial(join, out_dir)
+    return ArtifactInfo(
+        output_name, 'Demultiplexed',
+        [(pb('seqs.fna'), 'preprocessed_fasta'),
+         (pb('seqs.fastq'), 'preprocessed_fastq'),
+         (pb('seqs.demux'), 'preprocessed_demux')])
 
 
 def trimming(qclient, job_id, parameters, out_dir):
@@ -74,8 +568,15 @@ def trimming(qclient, job_id, parameters, out_dir):
             bool: if the job was successful
             list: artifacts created, can be None
             str: error message, "" if no error was generated
+
+    Notes
+    -----
+    If the parameters have `lengths` (a list or a comma separated string),
+    instead of a single `length`, the demux files are trimmed to all of them
+    in a single pass, creating a "Trimmed Demultiplexed <length>" artifact
+    per length. The lengths must be in `MULTIPLE_TRIMMING_LENGTHS`.
     """
-    qclient.update_job_step(job_id, "Step 1 of 3: Collecting information")
+    qclient.update_job_step(job_id, "Step 1 of 2: Collecting information")
     artifact_id = parameters['input_data']
     a_info = qclient.get("/qiita_db/artifacts/%s/" % artifact_id)
     fps = a_info['files']
@@ -83,18 +584,40 @@ def trimming(qclient, job_id, parameters, out_dir):
         error_msg = "Artifact doesn't contain a preprocessed demux"
         return False, None, error_msg
 
-    qclient.update_job_step(job_id, "Step 2 of 3: Executing Trimming")
-    generate_trimming(fps['preprocessed_demux'], out_dir, parameters)
+    lengths = parameters.get('lengths')
+    if lengths is not None:
+        if not isinstance(lengths, list):
+            lengths = str(lengths).split(',')
+        try:
+            lengths = sorted(set(int(length) for length in lengths))
+        except ValueError:
+            error_msg = ("Trimming lengths should be comma separated "
+                         "integers: %s" % parameters['lengths'])
+            return False, None, error_msg
+        unsupported = set(lengths) - set(MULTIPLE_TRIMMING_LENGTHS)
+        if unsupported:
+            error_msg = (
+                "Trimming lengths not supported: %s. Please, choose values "
+                "from %s" % (', '.join(map(str, sorted(unsupported))),
+                             ', '.join(map(str, MULTIPLE_TRIMMING_LENGTHS))))
+            return False, None, error_msg
 
-    qclient.update_job_step(job_id, "Step 3 of 3: Generating new Demuxed")
-    generate_demux_file(out_dir)
-
-    pb = partial(join, out_dir)
-    ainfo = [
-        ArtifactInfo(
-            'Trimmed Demultiplexed', 'Demultiplexed',
-            [(pb('seqs.fna'), 'preprocessed_fasta'),
-             (pb('seqs.fastq'), 'preprocessed_fastq'),
-             (pb('seqs.demux'), 'preprocessed_demux')])]
+    qclient.update_job_step(
+        job_id, "Step 2 of 2: Executing Trimming and generating new Demuxed")
+    # The pool of processes only pays off on large inputs, so the samples are
+    # trimmed in parallel only if QP_TARGET_GENE_NUM_JOBS is set
+    num_jobs = get_num_jobs(default=1)
+    if lengths is not None:
+        # A single pass over the demux files creates an artifact per length
+        out_dirs = generate_multiple_trimming(
+            fps['preprocessed_demux'], out_dir, lengths,
+            parameters['demux_storage'], num_jobs)
+        ainfo = [_artifact_info('Trimmed Demultiplexed %d' % length,
+                                out_dirs[length])
+                 for length in lengths]
+    else:
+        generate_trimming(fps['preprocessed_demux'], out_dir, parameters,
+                          parameters['demux_storage'], num_jobs)
+        ainfo = [_artifact_info('Trimmed Demultiplexed', out_dir)]
 
     return True, ainfo, ""
@@ -6,7 +6,17 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
+from os import environ, setsid, killpg
 from subprocess import Popen, PIPE
+from multiprocessing import cpu_count
+from tempfile import TemporaryFile
+from time import sleep, time
+from threading import Thread, Lock
+from collections import deque
+from logging import Formatter, makeLogRecord
+from logging.handlers import RotatingFileHandler
+import signal
+import re
 
 JOB_COMPLETED = False
 
@@ -41,3 +51,293 @@ def system_call(cmd):
     stdout, stderr = proc.communicate()
     return_value = proc.returncode
     return stdout, stderr, return_value
+
+
+def kill_process_group(proc, grace=10):
+    """Kills the process group of `proc`, giving it `grace` seconds to exit
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+        A process started with `preexec_fn=os.setsid`, so it leads its own
+        process group
+    grace : int, optional
+        The seconds to wait after SIGTERM before sending SIGKILL
+    """
+    for sig, wait in [(signal.SIGTERM, grace), (signal.SIGKILL, None)]:
+        try:
+            killpg(proc.pid, sig)
+        except OSError:
+            # The process group no longer exists
+            break
+        deadline = time() + (wait or 0)
+        while proc.poll() is None and time() < deadline:
+            sleep(0.1)
+        if proc.poll() is not None:
+            break
+    proc.wait()
+
+
+def _spool(pipe, tail, handler, progress):
+    """Reads the lines from `pipe` until it is closed
+
+    Parameters
+    ----------
+    pipe : file
+        The pipe to read from
+    tail : collections.deque
+        The bounded deque keeping the last lines
+    handler : logging.Handler or None
+        The handler writing the lines to disk
+    progress : callable or None
+        Function called with each line
+    """
+    for line in iter(pipe.readline, ''):
+        tail.append(line)
+        if handler is not None:
+            handler.handle(makeLogRecord({'msg': line.rstrip('\n')}))
+        if progress is not None:
+            progress(line)
+    pipe.close()
+
+
+def streaming_system_call(cmd, log_prefix=None, max_log_size=100 * 2 ** 20,
+                          log_backups=5, tail_lines=100, progress_re=None,
+                          progress_callback=None, progress_interval=30,
+                          timeout=None, kill_grace=10):
+    """Call command spooling its output to disk
+
+    Parameters
+    ----------
+    cmd : str
+        The command to be run
+    log_prefix : str, optional
+        If provided, the standard output and error of the command are written
+        to `<log_prefix>_stdout.txt` and `<log_prefix>_stderr.txt`
+    max_log_size : int, optional
+        The size, in bytes, at which the log files are rotated
+    log_backups : int, optional
+        The number of rotated log files to keep
+    tail_lines : int, optional
+        The number of output lines kept in memory and returned
+    progress_re : str, optional
+        Regular expression matching the progress lines in the standard output
+        and error. If not provided, all lines are considered progress lines
+    progress_callback : callable, optional
+        Function called with the last progress line (stripped), at most once
+        every `progress_interval` seconds
+    progress_interval : int, optional
+        The minimum number of seconds between two `progress_callback` calls
+    timeout : int, optional
+        The number of seconds after which the command is killed
+    kill_grace : int, optional
+        The number of seconds the command has to exit after being asked to
+        terminate, before being killed
+
+    Returns
+    -------
+    str, str, int
+        - The last `tail_lines` lines of the standard output of the command
+        - The last `tail_lines` lines of the standard error of the command
+        - The exit status of the command
+
+    Notes
+    -----
+    Contrary to `system_call`, the output of the command is never fully held
+    in memory. The command runs in its own process group, so all the
+    processes it starts are killed if it times out.
+    """
+    regex = re.compile(progress_re) if progress_re is not None else None
+    progress_lock = Lock()
+    last_progress = [0]
+
+    def progress(line):
+        line = line.strip()
+        if not line or (regex is not None and not regex.search(line)):
+            return
+        with progress_lock:
+            now = time()
+            if now - last_progress[0] < progress_interval:
+                return
+            last_progress[0] = now
+        progress_callback(line)
+
+    proc = Popen(cmd, universal_newlines=True, shell=True, stdout=PIPE,
+                 stderr=PIPE, preexec_fn=setsid)
+
+    tails = []
+    handlers = []
+    threads = []
+    for name, pipe in [('stdout', proc.stdout), ('stderr', proc.stderr)]:
+        tail = deque(maxlen=tail_lines)
+        handler = None
+        if log_prefix is not None:
+            handler = RotatingFileHandler(
+                '%s_%s.txt' % (log_prefix, name), maxBytes=max_log_size,
+                backupCount=log_backups)
+            handler.setFormatter(Formatter('%(message)s'))
+            handlers.append(handler)
+        thread = Thread(target=_spool, args=(
+            pipe, tail, handler,
+            progress if progress_callback is not None else None))
+        thread.daemon = True
+        thread.start()
+        tails.append(tail)
+        threads.append(thread)
+
+    timed_out = False
+    try:
+        start = time()
+        while proc.poll() is None:
+            if timeout is not None and time() - start > timeout:
+                timed_out = True
+                kill_process_group(proc, kill_grace)
+                break
+            sleep(0.1)
+    except BaseException:
+        kill_process_group(proc, kill_grace)
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        for handler in handlers:
+            handler.close()
+
+    std_out, std_err = [''.join(tail) for tail in tails]
+    if timed_out:
+        std_err += "Command timed out after %d seconds\n" % timeout
+    return std_out, std_err, proc.returncode
+
+
+def get_num_jobs(num_jobs=None, default=None):
+    """Returns the number of commands to execute concurrently
+
+    Parameters
+    ----------
+    num_jobs : int, optional
+        The requested number of concurrent jobs. If not provided, the value of
+        the QP_TARGET_GENE_NUM_JOBS environment variable is used or, if it is
+        not set, `default`
+    default : int, optional
+        The number of concurrent jobs if QP_TARGET_GENE_NUM_JOBS is not set.
+        Defaults to the number of available cores
+
+    Returns
+    -------
+    int
+        The number of concurrent jobs (at least 1)
+    """
+    if num_jobs is None:
+        num_jobs = (environ.get('QP_TARGET_GENE_NUM_JOBS') or default or
+                    cpu_count())
+    return max(1, int(num_jobs))
+
+
+def get_cache_dir():
+    """Returns the directory where the data reused across jobs is stored
+
+    Returns
+    -------
+    str or None
+        The value of the QP_TARGET_GENE_CACHE_DIR environment variable, or
+        None if it is not set, in which case nothing is cached
+    """
+    return environ.get('QP_TARGET_GENE_CACHE_DIR') or None
+
+
+def get_cache_size():
+    """Returns the maximum size of the data stored in the cache directory
+
+    Returns
+    -------
+    int or None
+        The value of the QP_TARGET_GENE_CACHE_SIZE environment variable, in
+        gigabytes, converted to bytes. None if it is not set, in which case
+        the cache is never evicted
+    """
+    size = environ.get('QP_TARGET_GENE_CACHE_SIZE')
+    if not size:
+        return None
+    return int(float(size) * 1024 ** 3)
+
+
+def parallel_system_call(cmds, num_jobs=None, requires=None):
+    """Call the commands in `cmds` using a bounded pool of processes
+
+    Parameters
+    ----------
+    cmds : list of str
+        The commands to be run
+    num_jobs : int, optional
+        The maximum number of commands running at the same time. Defaults to
+        the value returned by `get_num_jobs`
+    requires : dict of {int: list of int}, optional
+        The indices of the commands that need to finish successfully before
+        the command at a given index can start. Commands that depend on a
+        command that failed are never started.
+
+    Yields
+    ------
+    int, str, str, int
+        - The index of the command in `cmds`
+        - The standard output of the command
+        - The standard error of the command
+        - The exit status of the command
+
+    Notes
+    -----
+    The results are yielded as soon as each command finishes, so they are not
+    necessarily in the same order as `cmds`. The output of each command is
+    spooled to temporary files instead of pipes, so a command producing a lot
+    of output can't block the rest. If the caller stops consuming the results
+    (e.g. because one of the commands failed) no more commands are started and
+    the ones that are still running are killed, along with all the processes
+    they started.
+    """
+    num_jobs = get_num_jobs(num_jobs)
+    requires = {i: set(r) for i, r in (requires or {}).items()}
+    pending = list(enumerate(cmds))
+    succeeded = set()
+    failed = set()
+    running = {}
+    try:
+        while pending or running:
+            pending = [(i, cmd) for i, cmd in pending
+                       if not requires.get(i, set()) & failed]
+            ready = [(i, cmd) for i, cmd in pending
+                     if requires.get(i, set()) <= succeeded]
+            for i, cmd in ready[:num_jobs - len(running)]:
+                pending.remove((i, cmd))
+                out, err = TemporaryFile(mode='w+'), TemporaryFile(mode='w+')
+                proc = Popen(cmd, universal_newlines=True, shell=True,
+                             stdout=out, stderr=err, preexec_fn=setsid)
+                running[i] = (proc, out, err)
+
+            if not running:
+                # The remaining commands depend on commands that don't exist
+                break
+
+            finished = sorted(i for i, (proc, _, _) in running.items()
+                              if proc.poll() is not None)
+            if not finished:
+                sleep(0.1)
+                continue
+
+            for i in finished:
+                proc, out, err = running.pop(i)
+                out.seek(0)
+                err.seek(0)
+                std_out, std_err = out.read(), err.read()
+                out.close()
+                err.close()
+                if proc.returncode == 0:
+                    succeeded.add(i)
+                else:
+                    failed.add(i)
+                yield i, std_out, std_err, proc.returncode
+    finally:
+        for proc, out, err in running.values():
+            if proc.poll() is None:
+                kill_process_group(proc, grace=0)
+            out.close()
+            err.close()